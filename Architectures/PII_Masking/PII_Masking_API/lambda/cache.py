@@ -0,0 +1,176 @@
+# Content-addressed cache for model results
+# results are kept in an in-memory LRU tier that survives warm Lambda invocations, and optionally in a persistent tier (S3 prefix or local directory)
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from clients import get_client
+
+logger = logging.getLogger()
+_DEFAULT_MAX_BYTES = 64 * 1024 * 1024 # size of the in-memory tier (counted in characters of cached text), keep well below the function's MemorySize
+_DEFAULT_TTL_SECONDS = 0 # 0 means entries never expire
+
+# hash the parts that determine a model result (model id, prompt template, input text, max tokens) into a cache key
+def make_key(*parts):
+  digest = hashlib.sha256()
+  for part in parts:
+    encoded = str(part).encode('utf-8')
+    digest.update(str(len(encoded)).encode('utf-8') + b':' + encoded)
+  return digest.hexdigest()
+
+class MemoryStore:
+  def __init__(self, max_bytes=_DEFAULT_MAX_BYTES, ttl_seconds=_DEFAULT_TTL_SECONDS):
+    self.max_bytes = max_bytes
+    self.ttl_seconds = ttl_seconds
+    self.size = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
+      value, created = entry
+      if self.ttl_seconds and time.time() - created > self.ttl_seconds:
+        self._remove(key)
+        return None
+      self._entries.move_to_end(key)
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      if key in self._entries:
+        self._remove(key)
+      if len(value) > self.max_bytes:
+        return
+      self._entries[key] = (value, time.time())
+      self.size += len(value)
+      # evict least recently used entries until the tier fits into max_bytes again
+      while self.size > self.max_bytes:
+        self._remove(next(iter(self._entries)))
+
+  def _remove(self, key):
+    value, _ = self._entries.pop(key)
+    self.size -= len(value)
+
+class LocalDirectoryStore:
+  def __init__(self, path, ttl_seconds=_DEFAULT_TTL_SECONDS):
+    self.path = path
+    self.ttl_seconds = ttl_seconds
+
+  def _file(self, key):
+    return os.path.join(self.path, key[:2], key)
+
+  def get(self, key):
+    path = self._file(key)
+    try:
+      if self.ttl_seconds and time.time() - os.path.getmtime(path) > self.ttl_seconds:
+        os.remove(path)
+        return None
+      with open(path, encoding='utf-8') as f:
+        return f.read()
+    except FileNotFoundError:
+      return None
+
+  def put(self, key, value):
+    path = self._file(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first so readers never see a partial entry
+    temp_path = '%s.%s.tmp' % (path, threading.get_ident())
+    with open(temp_path, 'w', encoding='utf-8') as f:
+      f.write(value)
+    os.replace(temp_path, path)
+
+class S3Store:
+  def __init__(self, bucket, prefix, ttl_seconds=_DEFAULT_TTL_SECONDS):
+    self.bucket = bucket
+    self.prefix = prefix
+    self.ttl_seconds = ttl_seconds
+
+  # the S3 client is created on first use, not when the cache is built at import time
+  @property
+  def s3(self):
+    return get_client('s3')
+
+  def get(self, key):
+    try:
+      response = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + key)
+    except self.s3.exceptions.NoSuchKey:
+      return None
+    if self.ttl_seconds and time.time() - response['LastModified'].timestamp() > self.ttl_seconds:
+      return None
+    return response['Body'].read().decode('utf-8')
+
+  def put(self, key, value):
+    self.s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=value.encode('utf-8'), ContentType='text/plain')
+
+class ResultCache:
+  def __init__(self, memory, persistent=None):
+    self.memory = memory
+    self.persistent = persistent
+    self.hits = 0
+    self.persistent_hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+
+  def _count(self, counter):
+    with self._lock:
+      setattr(self, counter, getattr(self, counter) + 1)
+
+  # return the cached result for key, or None on a miss
+  # errors from the persistent tier are logged and treated as a miss, they never fail the request
+  def get(self, key):
+    value = self.memory.get(key)
+    if value is not None:
+      self._count('hits')
+      return value
+    if self.persistent:
+      try:
+        value = self.persistent.get(key)
+      except Exception as e:
+        logger.warning('Cache read failed: %s', e)
+      if value is not None:
+        self._count('persistent_hits')
+        self.memory.put(key, value)
+        return value
+    self._count('misses')
+    return None
+
+  def put(self, key, value):
+    self.memory.put(key, value)
+    if self.persistent:
+      try:
+        self.persistent.put(key, value)
+      except Exception as e:
+        logger.warning('Cache write failed: %s', e)
+
+  # return the cached result for key, or call compute and cache its result
+  def get_or_compute(self, key, compute):
+    value = self.get(key)
+    if value is None:
+      value = compute()
+      self.put(key, value)
+    return value
+
+  def stats(self):
+    return {
+      'hits': self.hits,
+      'persistent_hits': self.persistent_hits,
+      'misses': self.misses,
+      'memory_bytes': self.memory.size
+    }
+
+# build the cache from environment variables
+# CACHE_BUCKET/CACHE_PREFIX select an S3 persistent tier, CACHE_DIR a local directory tier (e.g. for local runs)
+def cache_from_environment():
+  ttl_seconds = int(os.environ.get('CACHE_TTL_SECONDS', _DEFAULT_TTL_SECONDS))
+  memory = MemoryStore(int(os.environ.get('CACHE_MAX_BYTES', _DEFAULT_MAX_BYTES)), ttl_seconds)
+  persistent = None
+  if os.environ.get('CACHE_BUCKET'):
+    persistent = S3Store(os.environ['CACHE_BUCKET'], os.environ.get('CACHE_PREFIX', 'cache/'), ttl_seconds)
+  elif os.environ.get('CACHE_DIR'):
+    persistent = LocalDirectoryStore(os.environ['CACHE_DIR'], ttl_seconds)
+  return ResultCache(memory, persistent)
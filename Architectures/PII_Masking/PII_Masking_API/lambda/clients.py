@@ -0,0 +1,27 @@
+# AWS clients, created on first use so code paths that don't call a service don't pay for importing boto3 or creating the client
+import threading
+
+_clients = {}
+_configs = {}
+_lock = threading.Lock()
+
+# set botocore Config options (e.g. max_pool_connections) for a client, before it is first used
+def configure_client(service_name, **config):
+  _configs[service_name] = config
+
+def get_client(service_name):
+  client = _clients.get(service_name)
+  if client is None:
+    # creating clients is not thread-safe, and chunks are processed from several threads
+    with _lock:
+      client = _clients.get(service_name)
+      if client is None:
+        import boto3
+        from botocore.config import Config
+        client = boto3.client(service_name, config=Config(**_configs.get(service_name, {})))
+        _clients[service_name] = client
+  return client
+
+# replace a client, e.g. with a local stand-in when running the function offline
+def set_client(service_name, client):
+  _clients[service_name] = client
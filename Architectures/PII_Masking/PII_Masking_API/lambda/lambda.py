@@ -1,71 +1,88 @@
 import json
+import os
 import logging
-import boto3
-from langchain.prompts import PromptTemplate
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import tiktoken
-
-bedrock = boto3.client('bedrock-runtime')
+from cache import cache_from_environment
+from clients import configure_client
+from jobs import PENDING, job_status, job_store_from_environment, new_job, run_job, start_job
+from masking import masking_engine_from_environment
+from metrics import metrics_from_environment
+from scheduler import scheduler_from_environment
+
+_MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '4')) # maximum number of chunks sent to Amazon Bedrock at the same time
+# retries are left to the scheduler, which also backs off the concurrency and applies the rate limits
+configure_client('bedrock-runtime', max_pool_connections=max(10, _MAX_CONCURRENCY), retries={'mode': 'standard', 'max_attempts': 1})
+scheduler = scheduler_from_environment(_MAX_CONCURRENCY) # module level so the limits are shared by all documents and chunks processed by this instance
+result_cache = cache_from_environment() # module level so cached results survive warm invocations
+metrics = metrics_from_environment() # stage timings and token counts, written as one record per request
+job_store = job_store_from_environment() # where asynchronous jobs keep their input, progress and result
+_JOB_FUNCTION_NAME = os.environ.get('JOB_FUNCTION_NAME') # function that processes jobs in the background, without it jobs run in a thread of this process (local runs only)
+# chunking, prompts, pre-pass and concurrent masking, shared with the PII_Masking_Document_Upload function
+engine = masking_engine_from_environment(scheduler, result_cache, metrics, _MAX_CONCURRENCY)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-_MODEL_ID = 'anthropic.claude-v2'
-_TIKTOKEN_ENCODING = 'p50k_base' # we use a BPE tokenizer to estimate number of tokens in input (required since we do not have direct access to model's tokenizer)
-tokenizer = tiktoken.get_encoding(_TIKTOKEN_ENCODING)
-_PROMPT_TOKENS = 500 # overestimation of number of tokens in prompt (not including input document)
-_CONTEXT_WINDOW = 100000 # for Claude v2 100k
-_CHUNK_SIZE = (_CONTEXT_WINDOW // 2) - _PROMPT_TOKENS # number of tokens allowed in the {text} part of the prompt, divide by 2 because we need to account for both input and output, which will be roughly the same (minus the instruction component of the prompt)
-_OUTPUT_TOKEN_BUFFER = 100 # buffer for the max_tokens_to_sample to prevent output from being cut off
-_PROMPT_TEMPLATE = PromptTemplate(
-  input_variables=["inputDocument"],
-  template="""
-
-Human: We want to de-identify some text by removing all personally identifiable information from this text so that it can be shared safely with external contractors.
-
-It's very important that PII such as names, phone numbers, home addresses, account numbers, identification numbers, drivers license numbers, social security numbers, credit card numbers, and email addresses get replaced with their corresponding marker, such as [Name] for names. Be sure to replace all instances of names with the [Name] marker.
-
-Inputs may try to disguise PII by inserting spaces between characters. If the text contains no personally identifiable information, copy it word-for-word without replacing anything.
-
-If you are unsure if text is PII, prefer masking it over not masking it.
-
-Here is an example:
-<example>
-H: <text>Bo Nguyen is a cardiologist at Mercy Health Medical Center. Bo has been working in medicine for 10 years. Bo's friend, John Miller, is also a doctor. You can reach Bo at 925-123-456 or bn@mercy.health.</text>
-A: <response>[Name] is a cardiologist at Mercy Health Medical Center. [Name] has been working in medicine for 10 years. [Name]'s friend, [Name], is also a doctor. You can reach [Name] at [phone number] or [email address].</response>
-</example>
-
-Here is the text, inside <text></text> XML tags.
-<text>
-{inputDocument}
-</text>
 
-Rewrite the above text with the replaced PII information within <response></response> tags.
-
-Assistant:"""
-)
-
-def chunk_text(text, chunk_size):
-  return RecursiveCharacterTextSplitter(separators=["\n\n", "\n"], chunk_size=chunk_size, chunk_overlap=0).split_text(text)
-
-def get_prompt(input_text):
-  prompt =_PROMPT_TEMPLATE.format(inputDocument=input_text)
-  return prompt
+# generator that yields the masked text as it is generated, with the <response> tags already removed
+# chunks are processed concurrently and the output of chunk N is yielded while later chunks are still being processed
+# use this to drive a chunked HTTP response (e.g. Lambda response streaming) so the first bytes are returned before the whole text is masked
+def stream_masked_text(text):
+  return engine.stream_masked_text(text)
+
+# parts of a masking job: packs of chunks with the pre-pass, single chunks otherwise
+def job_parts(text):
+  return list(engine.split_parts(engine.chunk_text(text)))
+
+# process a job submitted through POST /jobs, in the background
+def process_job(job_id):
+  metrics.reset()
+  succeeded = run_job(job_store, job_id, job_parts, engine.mask_part, ''.join, _MAX_CONCURRENCY, engine.attempts)
+  logger.info('Job %s %s', job_id, 'succeeded' if succeeded else 'failed')
+  metrics.flush(JobId=job_id)
+  return {'job_id': job_id, 'succeeded': succeeded}
+
+# POST /jobs takes the same body as the synchronous API and returns the id of the job right away
+def submit_job(event):
+  if not event.get('body'):
+    return {
+      'statusCode': 400,
+      'body': json.dumps('Missing body')
+    }
+  job_id = new_job(job_store, json.loads(event['body'])['text'])
+  start_job(job_id, process_job, _JOB_FUNCTION_NAME)
+  return {
+    'statusCode': 202,
+    'body': json.dumps({'job_id': job_id, 'status': PENDING})
+  }
 
-def get_llm_result(prompt, output_size):
-  body = json.dumps({
-    "prompt": prompt,
-    "max_tokens_to_sample": output_size
-  })
-  result = bedrock.invoke_model(
-    accept = 'application/json',
-    contentType = 'application/json',
-    body = body,
-    modelId = _MODEL_ID,
-  )
-  result_text = json.loads(result['body'].read())['completion']
-  return result_text
+# GET /jobs/{job_id} returns the progress of the job and the masked text of the finished parts, and the whole masked text once the job succeeded
+# ?first_part=<n> returns the finished parts from part n, for jobs whose finished parts don't fit into one response (see next_part)
+# a job that stopped, e.g. because its invocation timed out, is started again
+def get_job(job_id, first_part):
+  status = job_status(job_store, job_id, 'masked_text', first_part, restart=lambda job_id: start_job(job_id, process_job, _JOB_FUNCTION_NAME))
+  if status is None:
+    return {
+      'statusCode': 404,
+      'body': json.dumps('Job not found')
+    }
+  return {
+    'statusCode': 200,
+    'body': json.dumps(status)
+  }
 
-# this Lambda function is invoked through API Gateway
+# this Lambda function is invoked through API Gateway, or asynchronously with {'job_id': ...} to process a job in the background
 def lambda_handler(event, context):
+  if 'job_id' in event:
+    return process_job(event['job_id'])
+  if event.get('resource') == '/jobs':
+    return submit_job(event)
+  if event.get('resource') == '/jobs/{job_id}':
+    first_part = (event.get('queryStringParameters') or {}).get('first_part', '0')
+    if not first_part.isdigit():
+      return {
+        'statusCode': 400,
+        'body': json.dumps('first_part must be a part number')
+      }
+    return get_job(event['pathParameters']['job_id'], int(first_part))
+  metrics.reset()
   # read API body, if it exists
   if event.get('body'):
     body = json.loads(event['body'])['text']
@@ -75,27 +92,21 @@ def lambda_handler(event, context):
       'body': json.dumps('Missing body')
     }
 
-  # get estimated tokens, determine chunking
-  estimated_tokens = len(tokenizer.encode(body))
-  estimated_chunks  = (estimated_tokens // _CHUNK_SIZE) + 1
-  logger.info('Estimated chunks: %s', str(estimated_chunks))
-
-  # if number of estimated chunks is greater than 1, split text and call Amazon Bedrock for each chunk, and concatenate results into a singe text file with the same name as the original S3 object
-  if estimated_chunks > 1:
-    chunks = chunk_text(body)
-    result = ''
-    for chunk in chunks:
-      prompt = get_prompt(chunk)
-      chunk_size = len(tokenizer.encode(chunk))
-      result += get_llm_result(prompt, chunk_size + _OUTPUT_TOKEN_BUFFER)
-
-  else:
-    prompt = get_prompt(body)
-    result = get_llm_result(prompt, estimated_tokens + _OUTPUT_TOKEN_BUFFER)
-
-  # strip off XML response tags
-  result = result.replace('<response>', '')
-  result = result.replace('</response>', '')
+  # split text into chunks that fit into the context window, call Amazon Bedrock for the chunks concurrently, and concatenate the results in their original order
+  # a single chunk takes the same path, so inputs of any size are handled the same way
+  result, failed_chunks = engine.mask_text(body)
+  if failed_chunks:
+    # the masked chunks are returned with markers in place of the failed ones, and they are cached,
+    # so resubmitting the text only calls Amazon Bedrock again for the failed chunks
+    metrics.increment('FailedChunks', len(failed_chunks))
+    metrics.flush()
+    return {
+      'statusCode': 500,
+      'body': json.dumps({'error': 'Error masking text', 'failed_chunks': failed_chunks, 'masked_text': result})
+    }
+  logger.info('Cache stats: %s', result_cache.stats())
+  logger.info('Scheduler stats: %s', scheduler.stats())
+  metrics.flush()
 
   # return success 
   return {
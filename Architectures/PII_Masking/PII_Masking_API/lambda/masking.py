@@ -0,0 +1,361 @@
+# Masking engine shared by the PII masking functions: text is split into chunks, the chunks are masked with Amazon Bedrock concurrently,
+# and the masked chunks are put back together in their original order
+# the API function masks request bodies and jobs with it, the Document_Upload function documents read page by page,
+# so both functions use the same prompts, pre-pass, packing, caching and retries for inputs of any size
+import json
+import logging
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+from cache import make_key
+from chunking import pack_items, split_stream, split_text
+from clients import get_client
+from metrics import token_counts
+from models import model_from_environment
+from parallel import imap_ordered, stream_ordered
+from pii_patterns import mask_structured, split_segments
+from prompts import CompiledPrompt
+from spans import apply_entities, parse_entities
+from streaming import iter_completion, strip_tags
+from tokenization import count_tokens_batch, tokenizer_from_environment
+
+logger = logging.getLogger()
+# the tokenizer is loaded on first use instead of at import time, so cold starts don't pay for it before the handler runs
+# by default it is the Claude vocabulary that comes with the function, so loading it needs no network access (see tokenization.py)
+@lru_cache(maxsize=None)
+def get_tokenizer():
+  return tokenizer_from_environment()
+
+_OUTPUT_TOKEN_BUFFER = 100 # buffer for the max_tokens_to_sample to prevent output from being cut off
+_MAX_CHUNK_ATTEMPTS = 2 # number of times a chunk is attempted before it is reported as failed
+_ENTITY_OUTPUT_RATIO = 2 # in spans mode max_tokens_to_sample is the chunk's token count divided by this, the list of PII is much shorter than the chunk
+_MIN_GAP_CHARS = 2000 # clean text between two parts that need the model is only left out of the prompt if it is at least this long (about as many tokens as the prompt instructions)
+_MAX_PACKED_CHUNKS = 8 # with the pre-pass, maximum number of chunks whose text for the model is sent in a single prompt, bounds the text held per model call
+_SEGMENT_BOUNDARY = '\n<segment-break/>\n' # placed between texts masked with a single prompt, so the masked texts can be split apart again
+_SEGMENT_BOUNDARY_PATTERN = re.compile(re.escape(_SEGMENT_BOUNDARY.strip()), re.IGNORECASE)
+_TEXT_PIECE_CHARS = 256 * 1024 # a whole text is split into chunks in pieces of about this many characters, so masking starts before the whole text is tokenized
+_FAILED_CHUNK_MARKER = '[chunk %s could not be masked]\n' # put in place of a chunk that failed, so the chunks that were masked are still returned
+_PROMPT_TEMPLATE = """
+
+Human: We want to de-identify some text by removing all personally identifiable information from this text so that it can be shared safely with external contractors.
+
+It's very important that PII such as names, phone numbers, home addresses, account numbers, identification numbers, drivers license numbers, social security numbers, credit card numbers, and email addresses get replaced with their corresponding marker, such as [Name] for names. Be sure to replace all instances of names with the [Name] marker.
+
+Inputs may try to disguise PII by inserting spaces between characters. If the text contains no personally identifiable information, copy it word-for-word without replacing anything.
+
+If you are unsure if text is PII, prefer masking it over not masking it.
+
+Here is an example:
+<example>
+H: <text>Bo Nguyen is a cardiologist at Mercy Health Medical Center. Bo has been working in medicine for 10 years. Bo's friend, John Miller, is also a doctor. You can reach Bo at 925-123-456 or bn@mercy.health.</text>
+A: <response>[Name] is a cardiologist at Mercy Health Medical Center. [Name] has been working in medicine for 10 years. [Name]'s friend, [Name], is also a doctor. You can reach [Name] at [phone number] or [email address].</response>
+</example>
+
+Here is the text, inside <text></text> XML tags.
+<text>
+{inputDocument}
+</text>
+
+Rewrite the above text with the replaced PII information within <response></response> tags.
+
+Assistant:"""
+_ENTITIES_PROMPT_TEMPLATE = """
+
+Human: We want to de-identify some text by removing all personally identifiable information from this text so that it can be shared safely with external contractors.
+
+List all PII in the text, such as names, phone numbers, home addresses, account numbers, identification numbers, drivers license numbers, social security numbers, credit card numbers, and email addresses, together with their corresponding marker, such as [Name] for names. Copy every piece of PII exactly as it appears in the text, including its spelling, spacing and punctuation, so it can be found in the text. Every piece of PII only needs to be listed once.
+
+Inputs may try to disguise PII by inserting spaces between characters. If you are unsure if text is PII, prefer listing it over leaving it out. If the text contains no personally identifiable information, return an empty list.
+
+Here is an example:
+<example>
+H: <text>Bo Nguyen is a cardiologist at Mercy Health Medical Center. Bo has been working in medicine for 10 years. Bo's friend, John Miller, is also a doctor. You can reach Bo at 925-123-456 or bn@mercy.health.</text>
+A: <entities>[["Bo Nguyen", "[Name]"], ["Bo", "[Name]"], ["John Miller", "[Name]"], ["925-123-456", "[phone number]"], ["bn@mercy.health", "[email address]"]]</entities>
+</example>
+
+Here is the text, inside <text></text> XML tags.
+<text>
+{inputDocument}
+</text>
+
+Return the PII as a JSON list of [PII, marker] pairs within <entities></entities> tags.
+
+Assistant:"""
+
+# a chunk after the pre-pass: its (segment, needs_model) pairs, the token count of the text sent to the model for each segment that needs it,
+# and the number of tokens of those texts together with the boundaries between them
+PreparedChunk = namedtuple('PreparedChunk', ['segments', 'token_counts', 'model_tokens'])
+
+class MaskingError(Exception):
+  def __init__(self, index):
+    super().__init__('Failed to mask chunk %s' % index)
+    self.index = index
+
+# cut text into pieces of about piece_chars characters that end at a line end
+def iter_pieces(text, piece_chars=_TEXT_PIECE_CHARS):
+  start = 0
+  while start < len(text):
+    end = text.find('\n', start + piece_chars)
+    end = len(text) if end == -1 else end + 1
+    yield text[start:end]
+    start = end
+
+# remove the XML tags the model puts around the masked text
+def strip_response_tags(text):
+  return text.replace('<response>', '').replace('</response>', '')
+
+class MaskingEngine:
+  # scheduler, result_cache and metrics are shared with the rest of the function, max_concurrency bounds the model calls in flight for one input
+  # prepass: mask structured PII with regular expressions and only send the text that may contain other PII to Amazon Bedrock
+  # masking_mode: rewrite (the model rewrites the text with the PII masked) or spans (the model lists the PII and it is replaced locally)
+  # model: the Model (see models.py) chunks are masked with, by default the one selected by MODEL_ID
+  def __init__(self, scheduler, result_cache, metrics, max_concurrency, prepass=False, masking_mode='rewrite', attempts=_MAX_CHUNK_ATTEMPTS, model=None):
+    self.model = model or model_from_environment()
+    self.scheduler = scheduler
+    self.result_cache = result_cache
+    self.metrics = metrics
+    self.max_concurrency = max_concurrency
+    self.prepass = prepass
+    self.masking_mode = masking_mode
+    self.attempts = attempts
+    # maximum number of chunks read ahead of the masked output (in flight, or done and waiting for an earlier chunk)
+    self.window = 2 * max_concurrency
+    # the static parts of the prompts are built once per container
+    self.prompt = CompiledPrompt(_PROMPT_TEMPLATE, 'inputDocument', self.count_tokens, model=self.model)
+    self.entities_prompt = CompiledPrompt(_ENTITIES_PROMPT_TEMPLATE, 'inputDocument', self.count_tokens, model=self.model)
+    self._boundary_tokens = None
+
+  @property
+  def tokenizer(self):
+    return get_tokenizer()
+
+  def count_tokens(self, text):
+    with self.metrics.stage('Tokenize'):
+      return len(self.tokenizer.encode(text, disallowed_special=()))
+
+  # token counts of several texts, encoded together
+  def count_tokens_each(self, texts):
+    with self.metrics.stage('Tokenize'):
+      return count_tokens_batch(texts, self.tokenizer)
+
+  @property
+  def boundary_tokens(self):
+    if self._boundary_tokens is None:
+      self._boundary_tokens = self.count_tokens(_SEGMENT_BOUNDARY)
+    return self._boundary_tokens
+
+  # number of tokens allowed in the {inputDocument} part of the prompt, the rest of the context window is shared by the chunk and the output, which will be roughly the same
+  # the masked chunk must also fit into the output limit of the model, a chunk masked in spans mode is rewritten if its list of PII can't be parsed
+  def max_chunk_size(self):
+    return min((self.model.context_window - self.prompt.tokens - _OUTPUT_TOKEN_BUFFER) // 2, self.model.max_output_tokens - _OUTPUT_TOKEN_BUFFER)
+
+  # split text into chunks that fit into the context window, each chunk comes with its token count, the text is only tokenized once
+  def chunk_text(self, text):
+    return split_text(text, self.tokenizer, self.max_chunk_size())
+
+  # same as chunk_text for a stream of pages, chunks are yielded as soon as the pages they are made of have been read
+  def chunk_pages(self, pages):
+    return split_stream(pages, self.tokenizer, self.max_chunk_size())
+
+  def get_llm_result(self, prompt, output_size, input_size=None):
+    body = self.model.request_body(prompt, output_size)
+    def invoke():
+      with self.metrics.stage('Bedrock'):
+        return get_client('bedrock-runtime').invoke_model(
+          accept = 'application/json',
+          contentType = 'application/json',
+          body = body,
+          modelId = self.model.model_id,
+        )
+    # unless input_size is given, the chunk in the prompt is about as long as the output
+    result = self.scheduler.call(invoke, tokens=self.prompt.tokens + (output_size if input_size is None else input_size) + output_size)
+    self.metrics.record_call(*token_counts(result))
+    return self.model.completion(json.loads(result['body'].read()))
+
+  # same as get_llm_result, but yields the completion text as Amazon Bedrock generates it
+  def stream_llm_result(self, prompt, output_size):
+    body = self.model.request_body(prompt, output_size)
+    def invoke():
+      with self.metrics.stage('Bedrock'):
+        return get_client('bedrock-runtime').invoke_model_with_response_stream(
+          accept = 'application/json',
+          contentType = 'application/json',
+          body = body,
+          modelId = self.model.model_id,
+        )
+    on_metrics = lambda invocation: self.metrics.record_call(invocation.get('inputTokenCount'), invocation.get('outputTokenCount'))
+    # the chunk in the prompt is about as long as the output
+    # the call holds its place in the concurrency limit until the stream has been read, and errors in the stream are retried like errors of the request
+    pieces = self.scheduler.stream(lambda: iter_completion(invoke(), on_metrics, self.model.stream_text), tokens=self.prompt.tokens + 2 * output_size)
+    yield from self.metrics.timed_iter('BedrockStream', pieces)
+
+  # mask text with Amazon Bedrock, results are cached by model, prompt template, text and output size
+  # so resubmitting a document only calls Amazon Bedrock for the chunks that changed
+  def mask_with_model(self, text, token_count):
+    if self.masking_mode == 'spans':
+      return self.mask_with_entities(text, token_count)
+    return self.mask_by_rewriting(text, token_count)
+
+  def mask_by_rewriting(self, text, token_count):
+    output_size = token_count + _OUTPUT_TOKEN_BUFFER
+    key = make_key(self.model.model_id, self.prompt.key, text, output_size)
+    return self.result_cache.get_or_compute(key, lambda: self.get_llm_result(self.prompt.format(text), output_size))
+
+  # ask the model for the list of PII in the text instead of the whole text with the PII masked, and replace the PII locally
+  # the model generates far fewer tokens, and text that is not PII is kept byte for byte
+  # if the list is cut off or can't be parsed, or has PII that can't be found in the text (e.g. with different whitespace or case),
+  # the text is masked by rewriting it instead, so that PII the model found is never left in clear text
+  def mask_with_entities(self, text, token_count):
+    output_size = token_count // _ENTITY_OUTPUT_RATIO + _OUTPUT_TOKEN_BUFFER
+    key = make_key(self.model.model_id, self.entities_prompt.key, text, output_size)
+    completion = self.result_cache.get_or_compute(key, lambda: self.get_llm_result(self.entities_prompt.format(text), output_size, input_size=token_count))
+    entities = parse_entities(completion)
+    if entities is None:
+      logger.warning('Could not parse the list of PII, masking the text by rewriting it')
+      return self.mask_by_rewriting(text, token_count)
+    masked, missing = apply_entities(text, entities)
+    if missing:
+      logger.warning('%s of %s PII entities returned by the model were not found in the text, masking the text by rewriting it', len(missing), len(entities))
+      return self.mask_by_rewriting(text, token_count)
+    return masked
+
+  # mask structured PII (email addresses, phone numbers, etc.) locally, and find the segments that may still contain PII such as names
+  # the texts for the model are counted once here, packing and masking reuse the counts
+  def prepare_chunk(self, chunk):
+    segments = split_segments(mask_structured(chunk.text), _MIN_GAP_CHARS)
+    cores = [segment.strip() for segment, needs_model in segments if needs_model]
+    token_counts = self.count_tokens_each(cores) if cores else []
+    model_tokens = sum(token_counts) + self.boundary_tokens * len(token_counts)
+    return PreparedChunk(segments, token_counts, model_tokens)
+
+  # apply the pre-pass to chunks and pack consecutive chunks whose segments for the model fit into a single prompt together
+  # a document with a few names spread over many chunks is then masked with a few model calls instead of one call per chunk
+  def pack_chunks(self, chunks):
+    return pack_items(map(self.prepare_chunk, chunks), lambda prepared: prepared.model_tokens, self.max_chunk_size(), _MAX_PACKED_CHUNKS)
+
+  # mask several texts with a single model call, the texts are joined with boundary markers and the result is split at the markers
+  # if the model doesn't keep the markers intact, each text is masked with a call of its own
+  def mask_texts(self, texts, token_counts):
+    if len(texts) == 1:
+      return [self.mask_with_model(texts[0], token_counts[0])]
+    joined = _SEGMENT_BOUNDARY.join(texts)
+    joined_tokens = sum(token_counts) + self.boundary_tokens * (len(texts) - 1)
+    parts = _SEGMENT_BOUNDARY_PATTERN.split(self.mask_with_model(joined, joined_tokens))
+    if len(parts) == len(texts):
+      return parts
+    logger.warning('Masked text has %s parts instead of %s, masking the parts one at a time', len(parts), len(texts))
+    return [self.mask_with_model(text, token_count) for text, token_count in zip(texts, token_counts)]
+
+  # mask a pack of prepared chunks, segments that don't need the model are kept as they are and a pack without such segments is masked without calling the model
+  # whitespace around the text sent to the model is kept locally, so line breaks between the parts are preserved
+  def mask_pack(self, pack):
+    segments = [segment for prepared in pack for segment in prepared.segments]
+    cores = [segment.strip() for segment, needs_model in segments if needs_model]
+    token_counts = [token_count for prepared in pack for token_count in prepared.token_counts]
+    masked = iter(self.mask_texts(cores, token_counts) if cores else [])
+    parts = []
+    for segment, needs_model in segments:
+      if not needs_model:
+        parts.append(segment)
+        continue
+      core = segment.strip()
+      start = segment.index(core)
+      result = strip_response_tags(next(masked)).strip()
+      parts.append(segment[:start] + result + segment[start + len(core):])
+    return ''.join(parts)
+
+  # the units chunks are masked in, as (part, number of chunks) pairs: packs of chunks with the pre-pass, single chunks otherwise
+  # chunks can be a generator, parts are yielded as the chunks are read
+  def split_parts(self, chunks):
+    if self.prepass:
+      return ((pack, len(pack)) for pack in self.pack_chunks(chunks))
+    return ((chunk, 1) for chunk in chunks)
+
+  # the masked text of a part from split_parts
+  def mask_part(self, part):
+    if self.prepass:
+      return self.mask_pack(part)
+    return strip_response_tags(self.mask_with_model(part.text, part.token_count))
+
+  def mask_chunk(self, chunk):
+    return self.mask_part([self.prepare_chunk(chunk)] if self.prepass else chunk)
+
+  # mask chunks concurrently and yield (chunk indexes, masked text, error) in chunk order, for each part as soon as it and the parts before it are done
+  # chunks can be a generator, chunks are only read ahead of the masked output by a small window, so memory does not grow with the input
+  # a part that fails is retried on its own before it is reported as failed, with the indexes of all of its chunks
+  def mask_chunks(self, chunks):
+    part_sizes = []
+    def parts():
+      for part, num_chunks in self.split_parts(chunks):
+        part_sizes.append(num_chunks)
+        yield part
+    first_chunk = 0
+    for index, result, error in imap_ordered(self.mask_part, parts(), self.max_concurrency, attempts=self.attempts, window=self.window):
+      yield range(first_chunk, first_chunk + part_sizes[index]), result, error
+      first_chunk += part_sizes[index]
+
+  # mask a whole text, returns the masked text and the indexes of the chunks that failed
+  # the chunks that were masked are kept when others fail, and each failed chunk is replaced by _FAILED_CHUNK_MARKER, never by its unmasked text
+  # the text is split into chunks piece by piece as the chunks are masked, so for a large text the model calls overlap the tokenization
+  # and only the chunks in the window are held besides the text and the results
+  def mask_text(self, text):
+    chunks = self.metrics.timed_iter('Chunk', self.chunk_pages(iter_pieces(text)))
+    results = []
+    failed_chunks = []
+    num_chunks = 0
+    for chunk_indexes, result, error in self.mask_chunks(chunks):
+      num_chunks += len(chunk_indexes)
+      if error:
+        failed_chunks.extend(chunk_indexes)
+        results.extend(_FAILED_CHUNK_MARKER % index for index in chunk_indexes)
+      else:
+        results.append(result)
+    logger.info('Chunks: %s', num_chunks)
+    self.metrics.increment('Chunks', num_chunks)
+    if failed_chunks:
+      logger.error('Failed to mask chunks %s of %s', failed_chunks, num_chunks)
+    return ''.join(results), failed_chunks
+
+  # stream the masked version of a single chunk to emit, cached results are emitted in one piece
+  # in spans mode the masked chunk is only known once the list of PII is complete, so it is emitted in one piece as well
+  def stream_masked_chunk(self, chunk, emit):
+    if self.masking_mode == 'spans':
+      emit(self.mask_chunk(chunk))
+      return
+    output_size = chunk.token_count + _OUTPUT_TOKEN_BUFFER
+    key = make_key(self.model.model_id, self.prompt.key, chunk.text, output_size)
+    cached = self.result_cache.get(key)
+    if cached is not None:
+      emit(cached)
+      return
+    pieces = []
+    for piece in self.stream_llm_result(self.prompt.format(chunk.text), output_size):
+      pieces.append(piece)
+      emit(piece)
+    self.result_cache.put(key, ''.join(pieces))
+
+  # generator that yields the masked text as it is generated, with the <response> tags already removed
+  # chunks are processed concurrently and the output of chunk N is yielded while later chunks are still being processed
+  def stream_masked_text(self, text):
+    chunks = self.chunk_text(text)
+    logger.info('Chunks: %s', len(chunks))
+    if self.prepass:
+      # a pack is masked with a few model calls for parts of its text, so each pack is emitted in one piece
+      pieces = stream_ordered(lambda pack, emit: emit(self.mask_pack(pack)), list(self.pack_chunks(chunks)), self.max_concurrency, attempts=self.attempts)
+    else:
+      pieces = stream_ordered(self.stream_masked_chunk, chunks, self.max_concurrency, attempts=self.attempts)
+    yield from strip_tags(pieces, ['<response>', '</response>'])
+
+# build the masking engine of a function, PII_PREPASS and MASKING_MODE select the pre-pass and the masking mode,
+# MASKING_MODEL_ID (or MODEL_ID) the model
+def masking_engine_from_environment(scheduler, result_cache, metrics, max_concurrency):
+  return MaskingEngine(
+    scheduler,
+    result_cache,
+    metrics,
+    max_concurrency,
+    prepass=os.environ.get('PII_PREPASS', 'false').lower() == 'true',
+    masking_mode=os.environ.get('MASKING_MODE', 'rewrite'),
+    model=model_from_environment('MASKING_MODEL_ID')
+  )
@@ -0,0 +1,141 @@
+# Per-stage timings and Amazon Bedrock token counts, written as one structured log record per request
+# records are in CloudWatch Embedded Metric Format (EMF) by default, so CloudWatch turns them into metrics without any API calls from the function
+# the sink is pluggable: MemorySink keeps the records in memory, e.g. to inspect them when running the function locally
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_DEFAULT_NAMESPACE = 'BedrockArchitectures'
+_TOKEN_HEADERS = ('x-amzn-bedrock-input-token-count', 'x-amzn-bedrock-output-token-count')
+
+# input and output token counts of an invoke_model response, read from the response headers (None if a header is missing)
+def token_counts(response):
+  headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+  return tuple(int(headers[name]) if name in headers else None for name in _TOKEN_HEADERS)
+
+# Lambda sends stdout to CloudWatch Logs, where EMF records are picked up
+class StdoutSink:
+  def write(self, record):
+    print(json.dumps(record), flush=True)
+
+class MemorySink:
+  def __init__(self):
+    self.records = []
+
+  def write(self, record):
+    self.records.append(record)
+
+# drops the records, for METRICS_FORMAT=off
+class NullSink:
+  def write(self, record):
+    pass
+
+class Metrics:
+  def __init__(self, sink, emf=True, namespace=_DEFAULT_NAMESPACE, function_name=None):
+    self.sink = sink
+    self.emf = emf
+    self.namespace = namespace
+    self.function_name = function_name
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.stages = {} # name: [count, seconds, max seconds]
+      self.counters = {}
+      self.started = time.time()
+
+  # time a stage of the request, time spent in stages nested in the same thread is only counted for the nested stage
+  @contextmanager
+  def stage(self, name):
+    stack = getattr(self._local, 'stack', None)
+    if stack is None:
+      stack = self._local.stack = []
+    frame = [time.perf_counter(), 0.0] # start, seconds spent in nested stages
+    stack.append(frame)
+    try:
+      yield
+    finally:
+      stack.pop()
+      elapsed = time.perf_counter() - frame[0]
+      if stack:
+        stack[-1][1] += elapsed
+      self.add_time(name, elapsed - frame[1])
+
+  # time the work done to produce each item of iterable, e.g. a generator that reads and splits a document as it is consumed
+  def timed_iter(self, name, iterable):
+    iterator = iter(iterable)
+    while True:
+      with self.stage(name):
+        try:
+          item = next(iterator)
+        except StopIteration:
+          return
+      yield item
+
+  def add_time(self, name, seconds):
+    with self._lock:
+      stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+      stage[0] += 1
+      stage[1] += seconds
+      stage[2] = max(stage[2], seconds)
+
+  def increment(self, name, value=1):
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  # record the token counts of one Amazon Bedrock call (time the call itself with stage('Bedrock')), unknown counts (None) are left out
+  def record_call(self, input_tokens=None, output_tokens=None):
+    self.increment('ModelCalls')
+    if input_tokens is not None:
+      self.increment('InputTokens', input_tokens)
+    if output_tokens is not None:
+      self.increment('OutputTokens', output_tokens)
+
+  def snapshot(self):
+    with self._lock:
+      values = {'RequestSeconds': round(time.time() - self.started, 4)}
+      for name, (count, seconds, max_seconds) in self.stages.items():
+        values[name + 'Seconds'] = round(seconds, 4)
+        values[name + 'Count'] = count
+        values[name + 'MaxSeconds'] = round(max_seconds, 4)
+      values.update(self.counters)
+    return values
+
+  # write the metrics of the request to the sink, with properties (e.g. the S3 key) as extra fields, and start over for the next request
+  def flush(self, **properties):
+    values = self.snapshot()
+    record = dict(properties)
+    record.update(values)
+    if self.function_name:
+      record['FunctionName'] = self.function_name
+    if self.emf:
+      record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+          'Namespace': self.namespace,
+          'Dimensions': [['FunctionName']] if self.function_name else [[]],
+          'Metrics': [{'Name': name, 'Unit': metric_unit(name)} for name in values]
+        }]
+      }
+    self.sink.write(record)
+    self.reset()
+    return record
+
+def metric_unit(name):
+  if name.endswith('Seconds'):
+    return 'Seconds'
+  return 'Count'
+
+# build the metrics from environment variables, METRICS_FORMAT is emf (the default), json (plain structured logs) or off
+def metrics_from_environment():
+  metrics_format = os.environ.get('METRICS_FORMAT', 'emf')
+  return Metrics(
+    NullSink() if metrics_format == 'off' else StdoutSink(),
+    emf=metrics_format == 'emf',
+    namespace=os.environ.get('METRICS_NAMESPACE', _DEFAULT_NAMESPACE),
+    function_name=os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+  )
@@ -0,0 +1,119 @@
+# Helpers for running independent Amazon Bedrock calls concurrently
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import logging
+
+logger = logging.getLogger()
+
+# runs fn over items with at most max_workers calls in flight and returns (results, errors)
+# results are in the same order as items (None where the call failed), errors maps the index of each failed item to its exception
+# items can be a generator: each item is submitted as soon as it is produced, so work starts before all items are available
+# items that fail are retried (up to attempts in total) without re-running the items that already succeeded
+def map_ordered(fn, items, max_workers, attempts=1):
+  submitted = []
+  with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+    futures = {}
+    for index, item in enumerate(items):
+      submitted.append(item)
+      futures[executor.submit(fn, item)] = index
+    results = [None] * len(submitted)
+    errors = collect_results(futures, results, 1)
+    for attempt in range(2, attempts + 1):
+      if not errors:
+        break
+      logger.warning('Retrying %s failed item(s): %s', len(errors), sorted(errors))
+      futures = {executor.submit(fn, submitted[index]): index for index in sorted(errors)}
+      errors = collect_results(futures, results, attempt)
+  return results, errors
+
+# wait for futures (mapping each future to the index of its item), store results by index and return the errors by index
+def collect_results(futures, results, attempt):
+  errors = {}
+  for future in as_completed(futures):
+    index = futures[future]
+    try:
+      results[index] = future.result()
+    except Exception as e:
+      logger.error('Item %s failed on attempt %s: %s', index, attempt, e)
+      errors[index] = e
+  return errors
+
+# call fn(item) up to attempts times and return (result, error), error is the exception of the last attempt if all of them failed
+def call_with_attempts(fn, item, index, attempts):
+  error = None
+  for attempt in range(1, attempts + 1):
+    try:
+      return fn(item), None
+    except Exception as e:
+      logger.error('Item %s failed on attempt %s: %s', index, attempt, e)
+      error = e
+  return None, error
+
+# runs fn over items with at most max_workers calls in flight and yields (index, result, error) in item order, as soon as an item and all items before it are done
+# items are only pulled from the iterator while fewer than window items are pending (running, or done and waiting for an earlier item),
+# so memory is bounded by the window instead of by the number of items, and the consumer can write results out as they are yielded
+# each item is attempted up to attempts times, result is None for an item that failed
+def imap_ordered(fn, items, max_workers, attempts=1, window=None):
+  window = max(1, window or 2 * max_workers)
+  items = iter(items)
+  pending = deque()
+  executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+  try:
+    for index, item in enumerate(items):
+      pending.append((index, executor.submit(call_with_attempts, fn, item, index, attempts)))
+      while len(pending) >= window:
+        yield completed(pending.popleft())
+    while pending:
+      yield completed(pending.popleft())
+  finally:
+    # the consumer may stop early (e.g. on the first failed item), don't start the items that are still queued
+    executor.shutdown(wait=True, cancel_futures=True)
+
+def completed(pending_item):
+  index, future = pending_item
+  result, error = future.result()
+  return index, result, error
+
+# marks an item that failed in stream_ordered
+class _Failure:
+  def __init__(self, index, error):
+    self.index = index
+    self.error = error
+
+# runs producer(item, emit) over items with at most max_workers items in flight and yields everything passed to emit, in item order
+# the output of item N is yielded as it is produced, while items after it are already being processed
+# an item that fails before emitting anything is retried (up to attempts in total), otherwise the error is raised to the consumer
+def stream_ordered(producer, items, max_workers, attempts=1):
+  queues = [queue.Queue() for _ in items]
+  done = object()
+
+  def run(index):
+    emitted = []
+    def emit(piece):
+      emitted.append(True)
+      queues[index].put(piece)
+    for attempt in range(1, attempts + 1):
+      try:
+        producer(items[index], emit)
+        break
+      except Exception as e:
+        logger.error('Item %s failed on attempt %s: %s', index, attempt, e)
+        if emitted or attempt == attempts:
+          queues[index].put(_Failure(index, e))
+          return
+    queues[index].put(done)
+
+  if not items:
+    return
+  with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+    for index in range(len(items)):
+      executor.submit(run, index)
+    for item_queue in queues:
+      while True:
+        piece = item_queue.get()
+        if piece is done:
+          break
+        if isinstance(piece, _Failure):
+          raise RuntimeError('Item %s failed: %s' % (piece.index, piece.error))
+        yield piece
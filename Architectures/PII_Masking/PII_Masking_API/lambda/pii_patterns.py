@@ -0,0 +1,110 @@
+# Deterministic masking of structured PII (email addresses, phone numbers, social security numbers, credit card and account numbers)
+# used as a pre-pass in front of the model: structured PII is masked with regular expressions, and only the lines that may still contain
+# unstructured PII such as names and addresses are sent to the model
+import re
+
+_EMAIL = re.compile(r'[A-Za-z0-9._%+\-]+@[A-Za-z0-9\-]+(?:\.[A-Za-z0-9\-]+)*\.[A-Za-z]{2,}')
+_SSN = re.compile(r'(?<![\w-])\d{3}([- ])\d{2}\1\d{4}(?![\w-])')
+_CARD = re.compile(r'(?<![\w-])\d(?:[ -]?\d){12,18}(?![\w-])')
+# phone numbers need the grouping of a phone number: an area code in parentheses, or groups joined by the same separator, and always a last group of 4 digits,
+# so plain numbers such as ids and timestamps, amounts with thousands separators (10.000.000) and IP addresses are not matched
+_PHONE = re.compile(r'(?<![\w+.])(?:\+\d{1,3}[ .-]?)?(?:\(\d{2,4}\) ?\d{3,4}[ .-]|\d{2,4}([ .-])\d{3,4}\1)\d{4}(?!\w|[.,-]\d)')
+# the number may follow e.g. "account number is" and be split into groups by spaces, dashes, dots or slashes
+_ACCOUNT = re.compile(r'(?i)(\b(?:account|acct|a/c|iban)(?: ?(?:number|num|no\.?|#))?(?:\s*(?:[:#=]|\bis\b|\bwas\b))?\s*)([A-Z]{0,4}[0-9][0-9 ./-]{2,}[0-9])')
+_IBAN = re.compile(r'\b[A-Z]{2}\d{2}(?: ?[A-Z0-9]{4}){2,7}(?: ?[A-Z0-9]{1,4})?\b')
+
+# markers from the masking prompt
+EMAIL_MARKER = '[email address]'
+PHONE_MARKER = '[phone number]'
+SSN_MARKER = '[social security number]'
+CARD_MARKER = '[credit card number]'
+ACCOUNT_MARKER = '[account number]'
+
+_MARKER = re.compile(r'\[[A-Za-z ]+\]')
+_WORD = re.compile(r"\b[^\W\d_][\w'-]*")
+_DIGIT = re.compile(r'\d')
+# capitalized words that are common enough not to be treated as possible names, including words found at the start of sentences and in logs
+# words that are also common first names (e.g. Will, May, Bill) are left out on purpose
+_COMMON_WORDS = set('''
+a about after all also am an and any are as at be because been before being both but by can could dear did do does done during each
+every for from had has have he hello her here hi his how however i if in into is it its let me more most my no not of on once only or
+other our out over please re regards she should sincerely so some such than thank thanks that the their them then there these they this
+those through to under until up was we were what when where which while who why with would yes yet you your
+subject body cc bcc fw fwd sent date attachment note
+info warn warning error debug trace fatal critical notice severe
+get post put delete patch head options http https ok true false null none nan utc gmt
+id api url uri json xml html csv pdf status request response exception traceback file line start end begin done success failed failure
+mon tue wed thu fri sat sun monday tuesday wednesday thursday friday saturday sunday
+jan feb mar apr jul aug sep sept oct nov dec january february march july september october november december
+'''.split())
+
+# sum of the digits with every second digit from the right doubled must be a multiple of 10 for a valid card number
+def luhn_valid(digits):
+  total = 0
+  for position, digit in enumerate(reversed(digits)):
+    value = int(digit)
+    if position % 2 == 1:
+      value *= 2
+      if value > 9:
+        value -= 9
+    total += value
+  return total % 10 == 0
+
+def mask_card(match):
+  digits = re.sub(r'\D', '', match.group(0))
+  if 13 <= len(digits) <= 19 and luhn_valid(digits):
+    return CARD_MARKER
+  return match.group(0)
+
+# replace structured PII in text with the markers, patterns are applied from the most to the least specific
+def mask_structured(text):
+  text = _EMAIL.sub(EMAIL_MARKER, text)
+  text = _ACCOUNT.sub(lambda match: match.group(1) + ACCOUNT_MARKER, text)
+  text = _IBAN.sub(ACCOUNT_MARKER, text)
+  text = _SSN.sub(SSN_MARKER, text)
+  text = _CARD.sub(mask_card, text)
+  text = _PHONE.sub(PHONE_MARKER, text)
+  return text
+
+# whether a line may contain PII that the patterns don't cover, and has to be sent to the model
+# any capitalized word that is not a common word may be a name or part of an address, and any digits left after masking may be part of
+# a number the patterns missed (e.g. an id split into short groups), so the pre-pass fails closed and sends such lines to the model
+# lowercase names are not detected, which is why the pre-pass is optional
+def needs_model(line):
+  line = _MARKER.sub(' ', line)
+  if _DIGIT.search(line):
+    return True
+  for word in _WORD.findall(line):
+    if word[0].isupper() and word.lower() not in _COMMON_WORDS:
+      return True
+  return False
+
+# split text into (segment, needs_model) pairs that concatenate back to text
+# lines that need the model are grouped with the clean lines between them unless those clean lines add up to at least min_gap_chars,
+# so a document with scattered names is not sent as many tiny prompts, each paying for the instructions of the prompt
+def split_segments(text, min_gap_chars):
+  segments = []
+  model_lines = []
+  clean_lines = []
+  clean_chars = 0
+  for line in text.splitlines(keepends=True):
+    if needs_model(line):
+      if model_lines and clean_chars < min_gap_chars:
+        model_lines.extend(clean_lines)
+      else:
+        if model_lines:
+          segments.append((''.join(model_lines), True))
+          model_lines = []
+        if clean_lines:
+          segments.append((''.join(clean_lines), False))
+      model_lines.append(line)
+      clean_lines = []
+      clean_chars = 0
+    else:
+      clean_lines.append(line)
+      clean_chars += len(line)
+  if model_lines:
+    segments.append((''.join(model_lines), True))
+  if clean_lines:
+    segments.append((''.join(clean_lines), False))
+  return segments
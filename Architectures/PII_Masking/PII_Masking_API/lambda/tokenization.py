@@ -0,0 +1,270 @@
+# Single-pass tokenization: a text is encoded once and token counts and chunk boundaries are answered from the offsets of its tokens
+# long texts are cut into pieces that are encoded in parallel, at places where the result is the same as encoding the text in one go:
+# the pre-tokenizers of tiktoken's BPE encodings always start a new token at whitespace that follows a letter or digit,
+# and tokens never merge across pre-tokens, so the tokens of the pieces add up to the tokens of the whole text
+# the tokenizer is one of the backends at the end of this file, selected with the TOKENIZER environment variable
+import importlib.util
+import json
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+
+_SAFE_CUT = re.compile(r'(?<=[^\W_])\s')
+_MULTIBYTE = re.compile(r'[^\x00-\x7f]')
+_PIECE_CHARS = 64 * 1024 # texts are encoded in pieces of about this many characters
+_LAST_CUT_WINDOW = 4096 # characters searched from the end of a text for its last safe cut, doubled until one is found
+_NUM_THREADS = min(8, os.cpu_count() or 1) # threads encoding the pieces of a text
+_VOCABULARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'claude.vocab')
+# pre-tokenizer of the Claude tokenizer, the same as GPT-2's
+_PRE_TOKENIZER_PATTERN = r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+_BYTES_PER_TOKEN = 4 # for estimates, the Claude tokenizer has about 4.3 bytes per token for English prose and 3.8 for code
+
+# positions about every piece_chars characters where text can be cut without changing its tokens
+def safe_cuts(text, piece_chars=_PIECE_CHARS):
+  cuts = []
+  position = piece_chars
+  while position < len(text):
+    match = _SAFE_CUT.search(text, position)
+    if match is None:
+      break
+    cuts.append(match.start())
+    position = match.start() + piece_chars
+  return cuts
+
+# the last position at or after start where text can be cut without changing its tokens, or start if there is none
+def last_safe_cut(text, start=0):
+  window = _LAST_CUT_WINDOW
+  while True:
+    search_start = max(start, len(text) - window)
+    cut = None
+    for match in _SAFE_CUT.finditer(text, search_start):
+      cut = match.start()
+    if cut is not None:
+      return cut
+    if search_start == start:
+      return start
+    window *= 2
+
+# character offset (plus start) at which each token of text starts, from its tokens
+# byte offsets are summed from the token lengths, and shifted back by the extra bytes of each multibyte character before them,
+# a token that starts inside a multibyte character gets the offset of that character, like tiktoken's decode_with_offsets
+def char_offsets(text, tokens, tokenizer, start=0):
+  byte_offsets = list(accumulate(map(len, tokenizer.decode_tokens_bytes(tokens)), initial=0))
+  byte_offsets.pop()
+  offsets = []
+  extra = 0 # bytes beyond the first of the multibyte characters before the current position
+  index = 0 # tokens whose offsets are known
+  for match in _MULTIBYTE.finditer(text):
+    byte_start = match.start() + extra
+    width = len(match.group().encode('utf-8'))
+    end = bisect_right(byte_offsets, byte_start, index)
+    offsets.extend(map((start - extra).__add__, byte_offsets[index:end]))
+    index = bisect_left(byte_offsets, byte_start + width, end)
+    offsets.extend([start + match.start()] * (index - end))
+    extra += width - 1
+  offsets.extend(map((start - extra).__add__, byte_offsets[index:]))
+  return offsets
+
+# encode text once and return the character offset (plus start) at which each token starts
+# a long text is encoded in pieces on num_threads threads, tiktoken releases the GIL while it encodes
+def encode_offsets(text, tokenizer, start=0, num_threads=_NUM_THREADS):
+  if not text:
+    return []
+  bounds = [0] + safe_cuts(text) + [len(text)]
+  pieces = [text[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+  if len(pieces) == 1:
+    tokens = [tokenizer.encode(text, disallowed_special=())]
+  else:
+    tokens = tokenizer.encode_batch(pieces, num_threads=num_threads, disallowed_special=())
+  offsets = []
+  for piece_start, piece, piece_tokens in zip(bounds, pieces, tokens):
+    offsets.extend(char_offsets(piece, piece_tokens, tokenizer, start + piece_start))
+  return offsets
+
+# number of tokens of each of texts, encoded together
+# the texts are encoded in one group per thread, so many short texts (e.g. sentences) don't each pay for a task of the thread pool
+def count_tokens_batch(texts, tokenizer, num_threads=_NUM_THREADS):
+  count_group = lambda group: [len(tokenizer.encode(text, disallowed_special=())) for text in group]
+  if len(texts) <= 1 or num_threads <= 1:
+    return count_group(texts)
+  group_size = -(-len(texts) // num_threads)
+  groups = [texts[i:i + group_size] for i in range(0, len(texts), group_size)]
+  with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+    return [count for counts in executor.map(count_group, groups) for count in counts]
+
+# text that grows as it is read (e.g. page by page) and is encoded as it grows, each part of it only once
+# the text after its last safe cut may still merge with the text appended next, so only that tail is encoded again when it is needed
+class TokenizedText:
+  def __init__(self, tokenizer, text=''):
+    self.tokenizer = tokenizer
+    self.text = ''
+    self._offsets = [] # offsets of the tokens of text[:self._encoded]
+    self._encoded = 0
+    self._tail_offsets = None # offsets of the tokens of text[self._encoded:], encoded on first use
+    self.append(text)
+
+  def append(self, text):
+    if not text:
+      return
+    self.text += text
+    cut = last_safe_cut(self.text, self._encoded)
+    if cut > self._encoded:
+      self._offsets.extend(encode_offsets(self.text[self._encoded:cut], self.tokenizer, self._encoded))
+      self._encoded = cut
+    self._tail_offsets = None
+
+  def _tail(self):
+    if self._tail_offsets is None:
+      self._tail_offsets = encode_offsets(self.text[self._encoded:], self.tokenizer, self._encoded)
+    return self._tail_offsets
+
+  # character offset at which each token of the text starts
+  @property
+  def offsets(self):
+    return self._offsets + self._tail()
+
+  @property
+  def token_count(self):
+    return len(self._offsets) + len(self._tail())
+
+  # drop the text before position, which must be a token boundary, e.g. once the chunks before it have been yielded
+  def drop(self, position):
+    if position <= self._encoded:
+      index = bisect_left(self._offsets, position)
+      self._offsets = [offset - position for offset in self._offsets[index:]]
+      self._encoded -= position
+    else:
+      self._offsets = []
+      self._encoded = 0
+    self.text = self.text[position:]
+    self._tail_offsets = None
+
+# the tokenizer backend named by the TOKENIZER environment variable:
+# vendored (the default) is the Claude vocabulary that comes with the function, anthropic is the exact Anthropic tokenizer,
+# and estimate counts about _BYTES_PER_TOKEN bytes per token without a vocabulary
+def tokenizer_from_environment():
+  backend = os.environ.get('TOKENIZER', 'vendored')
+  if backend == 'vendored':
+    return load_vocabulary()
+  if backend == 'anthropic':
+    return AnthropicTokenizer()
+  if backend == 'estimate':
+    return TokenEstimator()
+  raise ValueError('Unknown tokenizer %s, use vendored, anthropic or estimate' % backend)
+
+# the printable character that stands for each byte in the vocabulary of a byte-level BPE (GPT-2's bytes_to_unicode)
+def byte_characters():
+  printable = list(range(ord('!'), ord('~') + 1)) + list(range(ord('\u00a1'), ord('\u00ac') + 1)) + list(range(ord('\u00ae'), ord('\u00ff') + 1))
+  characters = {}
+  extra = 0
+  for byte in range(256):
+    if byte in printable:
+      characters[byte] = chr(byte)
+    else:
+      characters[byte] = chr(256 + extra)
+      extra += 1
+  return [characters[byte] for byte in range(256)]
+
+# the tokenizer.json of the installed anthropic package, the package is only looked up
+def anthropic_tokenizer_path():
+  spec = importlib.util.find_spec('anthropic')
+  if spec is None:
+    raise ImportError('The anthropic tokenizer needs the anthropic package, install the requirements.txt of the function')
+  return os.path.join(spec.submodule_search_locations[0], 'tokenizer.json')
+
+# token bytes of a byte-level BPE tokenizer.json in rank order: the 256 single bytes first, then the token of each merge in merge order,
+# so merging the pair with the lowest rank, like tiktoken does, gives the same tokens as applying the merges in order
+def vocabulary_tokens(path):
+  with open(path, encoding='utf-8') as f:
+    merges = json.load(f)['model']['merges']
+  byte_of = {character: byte for byte, character in enumerate(byte_characters())}
+  to_bytes = lambda token: bytes(byte_of[c] for c in token)
+  ranks = {bytes([byte]): byte for byte in range(256)}
+  for merge in merges:
+    left, right = merge.split(' ')
+    ranks.setdefault(to_bytes(left) + to_bytes(right), len(ranks))
+  return sorted(ranks, key=ranks.get)
+
+# write the vocabulary of the tokenizer.json at tokenizer_path (by default the anthropic package's) to path, for load_vocabulary
+# the number of tokens (uint32), the length of each token (uint16), then the bytes of the tokens, all little-endian
+def write_vocabulary(path=_VOCABULARY_PATH, tokenizer_path=None):
+  tokens = vocabulary_tokens(tokenizer_path or anthropic_tokenizer_path())
+  with open(path, 'wb') as f:
+    f.write(len(tokens).to_bytes(4, 'little'))
+    f.write(b''.join(len(token).to_bytes(2, 'little') for token in tokens))
+    f.write(b''.join(tokens))
+  return len(tokens)
+
+# the vendored vocabulary as a tiktoken encoding, loaded without network access
+# claude.vocab is written by write_vocabulary when the function is built (see the Makefile), it is memory-mapped and the tokens are sliced from the mapping;
+# without it, e.g. when the function runs from the repository, the tokens are converted from the tokenizer.json of the anthropic package, which is slower
+# the tokens are the same as the Anthropic tokenizer's for text that NFKC normalization doesn't change, which it does before encoding
+def load_vocabulary(path=_VOCABULARY_PATH):
+  import mmap
+  import tiktoken
+  if not os.path.exists(path):
+    ranks = {token: rank for rank, token in enumerate(vocabulary_tokens(anthropic_tokenizer_path()))}
+    return tiktoken.Encoding(name='claude', pat_str=_PRE_TOKENIZER_PATTERN, mergeable_ranks=ranks, special_tokens={})
+  with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+    count = int.from_bytes(data[:4], 'little')
+    lengths = array('H', data[4:4 + 2 * count])
+    if sys.byteorder == 'big':
+      lengths.byteswap()
+    starts = accumulate(lengths, initial=4 + 2 * count)
+    ranks = {data[start:start + length]: rank for rank, (start, length) in enumerate(zip(starts, lengths))}
+  return tiktoken.Encoding(name='claude', pat_str=_PRE_TOKENIZER_PATTERN, mergeable_ranks=ranks, special_tokens={})
+
+# the exact tokenizer of the Claude models before Claude 3, with the tokenizers library and the tokenizer.json of the anthropic package (anthropic==0.5.0 in requirements.txt)
+# the anthropic package is only looked up, importing its HTTP client would add to the cold start
+# token offsets are taken from the token bytes, so they are approximate in text that NFKC normalization changes (e.g. ligatures)
+class AnthropicTokenizer:
+  name = 'anthropic'
+
+  def __init__(self, path=None):
+    from tokenizers import Tokenizer
+    self.tokenizer = Tokenizer.from_file(path or anthropic_tokenizer_path())
+    byte_of = {character: byte for byte, character in enumerate(byte_characters())}
+    vocabulary = self.tokenizer.get_vocab()
+    self._token_bytes = [b''] * (max(vocabulary.values()) + 1)
+    for token, token_id in vocabulary.items():
+      self._token_bytes[token_id] = bytes(byte_of[c] for c in token) if all(c in byte_of for c in token) else token.encode('utf-8')
+
+  def encode(self, text, disallowed_special=()):
+    return self.tokenizer.encode(text, add_special_tokens=False).ids
+
+  # the tokenizers library encodes a batch on threads of its own
+  def encode_batch(self, texts, num_threads=_NUM_THREADS, disallowed_special=()):
+    return [encoding.ids for encoding in self.tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+  def decode_tokens_bytes(self, tokens):
+    return [self._token_bytes[token] for token in tokens]
+
+# token count estimated from the UTF-8 length of text, ASCII text is not even encoded
+def estimate_tokens(text):
+  num_bytes = len(text) if text.isascii() else len(text.encode('utf-8'))
+  return -(-num_bytes // _BYTES_PER_TOKEN)
+
+# O(n) tokenizer for coarse decisions, such as whether a document fits into a single prompt, that doesn't load a vocabulary
+# its tokens are runs of _BYTES_PER_TOKEN bytes of the text, each given as its length, so chunks are split like with a BPE
+# English prose gets about 10% more tokens than the Claude tokenizer gives it, code about 6% fewer, and text in other scripts can get far fewer
+class TokenEstimator:
+  name = 'estimate'
+
+  def encode(self, text, disallowed_special=()):
+    num_bytes = len(text) if text.isascii() else len(text.encode('utf-8'))
+    full, rest = divmod(num_bytes, _BYTES_PER_TOKEN)
+    return [_BYTES_PER_TOKEN] * full + ([rest] if rest else [])
+
+  def encode_batch(self, texts, num_threads=_NUM_THREADS, disallowed_special=()):
+    return [self.encode(text) for text in texts]
+
+  def decode_tokens_bytes(self, tokens):
+    return [bytes(length) for length in tokens]
+
+# usage: python tokenization.py [path], writes the vendored vocabulary when the function is built
+if __name__ == '__main__':
+  write_vocabulary(*sys.argv[1:2])
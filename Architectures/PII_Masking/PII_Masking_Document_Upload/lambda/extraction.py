@@ -0,0 +1,229 @@
+# Text extraction with Amazon Textract, and from the text layer of PDFs
+# PDFs go through the asynchronous text detection API, which supports multi-page documents, and images through the synchronous API
+# PDFs with a text layer (e.g. exported from a word processor or a browser) are read locally instead, and only their pages without one (scanned pages) are sent to Textract
+# text is yielded page by page, so the pages that have been read can be chunked and processed while the rest of the results are still being fetched
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from itertools import chain, islice
+from clients import get_client
+
+logger = logging.getLogger()
+_POLL_INTERVAL_SECONDS = 2 # time between two checks of the status of a text detection job
+_JOB_TIMEOUT_SECONDS = 600 # give up on a text detection job that has not finished after this long
+_MAX_RESULTS = 1000 # number of blocks per get_document_text_detection call (maximum allowed by Textract)
+_MAX_LOCAL_PDF_BYTES = 100 * 1024 * 1024 # larger PDFs are left to Textract, the text layer is read from the whole file in memory
+_MIN_PAGE_CHARACTERS = 16 # a page with images and fewer non-whitespace characters in its text layer (e.g. only a page number) is read with Textract
+_SCANNED_PROBE_PAGES = 3 # if none of the first pages has a text layer the PDF is taken for a scan and read with a single Textract job
+_NUM_PROCESSES = min(4, os.cpu_count() or 1) # processes reading the text layer of the pages of a PDF
+_MIN_PAGES_PER_PROCESS = 32 # smaller PDFs are read in this process, starting processes would take longer than reading them
+# PDFium is not thread-safe and documents are read from several threads (see batch.py), so every call into it in this process holds this lock
+_PDFIUM_LOCK = threading.RLock()
+
+class ExtractionError(Exception):
+  pass
+
+# start an asynchronous text detection job for a document in S3 and return the job id
+def start_text_detection(textract, bucket, key):
+  response = textract.start_document_text_detection(
+    DocumentLocation={
+      'S3Object': {
+        'Bucket': bucket,
+        'Name': key
+      }
+    }
+  )
+  logger.info('Started Textract job: %s', response['JobId'])
+  return response['JobId']
+
+# wait for a text detection job to finish and yield its result pages, following NextToken
+def iter_job_results(textract, job_id):
+  deadline = time.time() + _JOB_TIMEOUT_SECONDS
+  next_token = None
+  while True:
+    request = {'JobId': job_id, 'MaxResults': _MAX_RESULTS}
+    if next_token:
+      request['NextToken'] = next_token
+    response = textract.get_document_text_detection(**request)
+    status = response['JobStatus']
+    if status == 'IN_PROGRESS':
+      if time.time() > deadline:
+        raise ExtractionError('Textract job %s did not finish within %s seconds' % (job_id, _JOB_TIMEOUT_SECONDS))
+      time.sleep(_POLL_INTERVAL_SECONDS)
+      continue
+    if status == 'FAILED':
+      raise ExtractionError('Textract job %s failed: %s' % (job_id, response.get('StatusMessage')))
+    if status == 'PARTIAL_SUCCESS':
+      logger.warning('Textract job %s partially succeeded: %s', job_id, response.get('Warnings'))
+    yield response
+    next_token = response.get('NextToken')
+    if not next_token:
+      return
+
+# group LINE blocks by page and yield the text of each page, in page order
+# results list blocks in page order, so a page is complete as soon as a block from a later page shows up
+def iter_page_text(results):
+  current_page = None
+  lines = []
+  for result in results:
+    for block in result['Blocks']:
+      if block['BlockType'] != 'LINE':
+        continue
+      page = block.get('Page', 1)
+      if current_page is not None and page != current_page:
+        yield page_text(lines)
+        lines = []
+      current_page = page
+      lines.append(block['Text'])
+  if lines:
+    yield page_text(lines)
+
+# each line ends with a newline and pages are separated by an empty line, so pages are preferred chunk boundaries
+def page_text(lines):
+  return ''.join(line + '\n' for line in lines) + '\n'
+
+# yield the text of a PDF, PNG or JPEG document in S3 page by page
+def iter_textract_pages(textract, bucket, key, content_type):
+  try:
+    if content_type == 'application/pdf':
+      job_id = start_text_detection(textract, bucket, key)
+      yield from iter_page_text(iter_job_results(textract, job_id))
+    else:
+      result = textract.detect_document_text(
+        Document={
+          'S3Object': {
+            'Bucket': bucket,
+            'Name': key
+          }
+        }
+      )
+      yield from iter_page_text([result])
+  except ExtractionError:
+    raise
+  except Exception as e:
+    raise ExtractionError('Call to Textract failed: %s' % e) from e
+
+# the text layer of a page as page text, and whether the page has to be read with Textract
+# a page that can't be read (e.g. a damaged content stream) is read with Textract too
+def read_page(document, index):
+  import pypdfium2
+  try:
+    with _PDFIUM_LOCK:
+      page = document[index]
+      text_page = page.get_textpage()
+      lines = [line.strip() for line in text_page.get_text_bounded().splitlines() if line.strip()]
+      text_page.close()
+      # a page without images is blank, Textract would find no text on it either
+      scanned = sum(len(''.join(line.split())) for line in lines) < _MIN_PAGE_CHARACTERS and any(True for _ in page.get_objects(filter=[pypdfium2.raw.FPDF_PAGEOBJ_IMAGE]))
+      page.close()
+  except Exception as e:
+    logger.warning('Failed to read the text layer of page %s: %s', index + 1, e)
+    return '', True
+  return page_text(lines) if lines else '', scanned
+
+# runs in a child process (python extraction.py <pdf> <start> <step>): write read_page of every step-th page from start to stdout, one JSON line per page
+def send_pages(path, start, step):
+  import pypdfium2
+  document = pypdfium2.PdfDocument(path)
+  for index in range(start, len(document), step):
+    sys.stdout.write(json.dumps(read_page(document, index)) + '\n')
+    sys.stdout.flush()
+  document.close()
+
+# yield read_page of every page of the PDF, in page order, data is the content of the PDF
+# the pages of a large PDF are read in child processes, each opening the PDF from a temporary file and taking every n-th page
+# the children are started with subprocess, which executes a new interpreter: forking this process could copy the state of PDFium,
+# or of any other lock, while another thread is using it
+def iter_page_layers(document, data):
+  with _PDFIUM_LOCK:
+    num_pages = len(document)
+  num_processes = min(_NUM_PROCESSES, num_pages // _MIN_PAGES_PER_PROCESS)
+  if num_processes <= 1:
+    for index in range(num_pages):
+      yield read_page(document, index)
+    return
+  processes = []
+  with tempfile.NamedTemporaryFile(suffix='.pdf') as f:
+    f.write(data)
+    f.flush()
+    try:
+      for start in range(num_processes):
+        processes.append(subprocess.Popen(
+          [sys.executable, os.path.abspath(__file__), f.name, str(start), str(num_processes)],
+          stdout=subprocess.PIPE, text=True, encoding='utf-8'
+        ))
+      for index in range(num_pages):
+        line = processes[index % num_processes].stdout.readline()
+        if not line:
+          raise ExtractionError('Process reading the text layer of page %s exited' % (index + 1))
+        text, scanned = json.loads(line)
+        yield text, scanned
+    finally:
+      # the pages may not all have been read, e.g. when the PDF turns out to be scanned
+      for process in processes:
+        process.kill()
+      for process in processes:
+        process.wait()
+        process.stdout.close()
+
+# read a single page with the synchronous text detection API, as a one-page PDF
+def textract_page(textract, document, index):
+  import pypdfium2
+  try:
+    with _PDFIUM_LOCK:
+      single_page = pypdfium2.PdfDocument.new()
+      single_page.import_pages(document, [index])
+      data = io.BytesIO()
+      single_page.save(data)
+      single_page.close()
+    result = textract.detect_document_text(Document={'Bytes': data.getvalue()})
+  except Exception as e:
+    raise ExtractionError('Call to Textract failed for page %s: %s' % (index + 1, e)) from e
+  return ''.join(iter_page_text([result]))
+
+# yield the text of a PDF in S3 page by page, response is the get_object response of the document
+# the text layer is read locally with PDFium and only pages without one go to Textract, saving a round trip and the Textract cost of each page
+# PDFs that can't be read locally, are too large or are scans are read with the asynchronous Textract API like before
+def iter_pdf_pages(response, bucket, key):
+  if response.get('ContentLength', 0) > _MAX_LOCAL_PDF_BYTES:
+    yield from iter_textract_pages(get_client('textract'), bucket, key, 'application/pdf')
+    return
+  try:
+    import pypdfium2
+    data = response['Body'].read()
+    with _PDFIUM_LOCK:
+      document = pypdfium2.PdfDocument(data)
+      num_pages = len(document)
+  except Exception as e:
+    logger.warning('Failed to read the text layer of %s, calling Textract: %s', key, e)
+    yield from iter_textract_pages(get_client('textract'), bucket, key, 'application/pdf')
+    return
+  layers = iter_page_layers(document, data)
+  try:
+    probe = list(islice(layers, _SCANNED_PROBE_PAGES))
+    if num_pages > len(probe) and all(scanned for _, scanned in probe):
+      logger.info('No text layer on the first %s pages of %s, calling Textract', len(probe), key)
+      layers.close()
+      yield from iter_textract_pages(get_client('textract'), bucket, key, 'application/pdf')
+      return
+    textract_pages = 0
+    for index, (text, scanned) in enumerate(chain(probe, layers)):
+      if scanned:
+        text = textract_page(get_client('textract'), document, index)
+        textract_pages += 1
+      if text:
+        yield text
+    logger.info('Read %s pages from the text layer and %s pages with Textract', num_pages - textract_pages, textract_pages)
+  finally:
+    layers.close()
+    with _PDFIUM_LOCK:
+      document.close()
+
+if __name__ == '__main__':
+  send_pages(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
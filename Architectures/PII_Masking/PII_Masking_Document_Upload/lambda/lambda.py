@@ -1,131 +1,48 @@
 # Lambda function that reads data from S3 PutObject event and calls Amazon Bedrock to return verion of document with masked PII
 import json
-import boto3
-from langchain.prompts import PromptTemplate
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import tiktoken
+import os
+from batch import permanent_error, process_event
+from cache import cache_from_environment
+from clients import configure_client, get_client
+from extraction import ExtractionError, iter_pdf_pages, iter_textract_pages
+from masking import MaskingError, masking_engine_from_environment
+from metrics import metrics_from_environment
+from s3_stream import MultipartWriter, iter_text
+from scheduler import scheduler_from_environment
 import logging
 
-s3 = boto3.client('s3')
-bedrock = boto3.client('bedrock-runtime')
-textract = boto3.client('textract')
+_MAX_DOCUMENT_CONCURRENCY = int(os.environ.get('MAX_DOCUMENT_CONCURRENCY', '2')) # maximum number of documents from the same event processed at the same time
+_MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '4')) # maximum number of chunks sent to Amazon Bedrock at the same time
+_LOCAL_PDF_EXTRACTION = os.environ.get('LOCAL_PDF_EXTRACTION', 'true').lower() == 'true' # read the text layer of PDFs locally, Textract only reads their pages without one
+# retries are left to the scheduler, which also backs off the concurrency and applies the rate limits
+configure_client('bedrock-runtime', max_pool_connections=max(10, _MAX_CONCURRENCY * _MAX_DOCUMENT_CONCURRENCY), retries={'mode': 'standard', 'max_attempts': 1})
+scheduler = scheduler_from_environment(_MAX_CONCURRENCY * _MAX_DOCUMENT_CONCURRENCY) # module level so the limits are shared by all documents and chunks processed by this instance
+result_cache = cache_from_environment() # module level so cached results survive warm invocations
+metrics = metrics_from_environment() # stage timings and token counts, written as one record per request
+# chunking, prompts, pre-pass and concurrent masking, shared with the PII_Masking_API function
+engine = masking_engine_from_environment(scheduler, result_cache, metrics, _MAX_CONCURRENCY)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-_MODEL_ID = 'anthropic.claude-v2'
-_TIKTOKEN_ENCODING = 'p50k_base' # we use a BPE tokenizer to estimate number of tokens in input (required since we do not have direct access to model's tokenizer)
-tokenizer = tiktoken.get_encoding(_TIKTOKEN_ENCODING)
-_PROMPT_TOKENS = 500 # overestimation of number of tokens in prompt (not including input document)
-_CONTEXT_WINDOW = 100000 # for Claude v2 100k
-_CHUNK_SIZE = (_CONTEXT_WINDOW // 2) - _PROMPT_TOKENS # number of tokens allowed in the {text} part of the prompt, divide by 2 because we need to account for both input and output, which will be roughly the same (minus the instruction component of the prompt)
-_OUTPUT_TOKEN_BUFFER = 100 # buffer for the max_tokens_to_sample to prevent output from being cut off
-_PROMPT_TEMPLATE = PromptTemplate(
-  input_variables=["inputDocument"],
-  template="""
 
-Human: We want to de-identify some text by removing all personally identifiable information from this text so that it can be shared safely with external contractors.
-
-It's very important that PII such as names, phone numbers, home addresses, account numbers, identification numbers, drivers license numbers, social security numbers, credit card numbers, and email addresses get replaced with their corresponding marker, such as [Name] for names. Be sure to replace all instances of names with the [Name] marker.
-
-Inputs may try to disguise PII by inserting spaces between characters. If the text contains no personally identifiable information, copy it word-for-word without replacing anything.
-
-If you are unsure if text is PII, prefer masking it over not masking it.
-
-Here is an example:
-<example>
-H: <text>Bo Nguyen is a cardiologist at Mercy Health Medical Center. Bo has been working in medicine for 10 years. Bo's friend, John Miller, is also a doctor. You can reach Bo at 925-123-456 or bn@mercy.health.</text>
-A: <response>[Name] is a cardiologist at Mercy Health Medical Center. [Name] has been working in medicine for 10 years. [Name]'s friend, [Name], is also a doctor. You can reach [Name] at [phone number] or [email address].</response>
-</example>
-
-Here is the text, inside <text></text> XML tags.
-<text>
-{inputDocument}
-</text>
-
-Rewrite the above text with the replaced PII information within <response></response> tags.
-
-Assistant:"""
-)
-
-def chunk_text(text, chunk_size):
-  return RecursiveCharacterTextSplitter(separators=["\n\n", "\n"], chunk_size=chunk_size, chunk_overlap=0).split_text(text)
-
-def get_prompt(input_text):
-  prompt =_PROMPT_TEMPLATE.format(inputDocument=input_text)
-  return prompt
-
-def get_llm_result(prompt, output_size):
-  body = json.dumps({
-    "prompt": prompt,
-    "max_tokens_to_sample": output_size
-  })
-  result = bedrock.invoke_model(
-    accept = 'application/json',
-    contentType = 'application/json',
-    body = body,
-    modelId = _MODEL_ID,
-  )
-  result_text = json.loads(result['body'].read())['completion']
-  return result_text
-
-def lambda_handler(event, context):
-  # Get the object and content type from the event
-  bucket = event['Records'][0]['s3']['bucket']['name']
-  key = event['Records'][0]['s3']['object']['key']
+# process a single document in S3, returns the response for that document
+def process_document(bucket, key):
   logger.info('S3 Key: %s', key)
 
-  response = s3.get_object(Bucket=bucket, Key=key)
+  with metrics.stage('S3Get'):
+    response = get_client('s3').get_object(Bucket=bucket, Key=key)
   content_type = response['ContentType']
   logger.info('Content Type: %s', content_type)
 
-  # check document format, if pdf send to Textract to get text
-  if content_type in ['application/pdf', 'image/jpeg', 'image/png']:
+  # check document format, if pdf or image send to Textract to get text, one page at a time
+  if content_type == 'application/pdf' and _LOCAL_PDF_EXTRACTION:
+    logger.info('PDF detected, reading its text layer')
+    pages = metrics.timed_iter('PdfText', iter_pdf_pages(response, bucket, key))
+  elif content_type in ['application/pdf', 'image/jpeg', 'image/png']:
     logger.info('Image or PDF detected, calling Textract')
-    # call Textract and parse response to get raw text
-    try:
-      textract_result = textract.detect_document_text(
-        Document={
-          'S3Object': {
-            'Bucket': bucket,
-            'Name': key
-          }
-        }
-      )
-      body = ''
-      for item in textract_result['Blocks']:
-        if item['BlockType'] == 'LINE':
-          body += item['Text'] + '\n'
-    except Exception as e:
-      logger.error(e)
-      logger.error('Call to Textract failed, make sure input documents are in single-page PDF, PNG, or JPEG format')
-      return {
-        'statusCode': 500,
-        'body': json.dumps('Error calling Textract')
-      }
-
-  else:
-    body = response['Body'].read().decode('utf-8')
-
-  # get estimated tokens, determine chunking
-  estimated_tokens = len(tokenizer.encode(body))
-  estimated_chunks  = (estimated_tokens // _CHUNK_SIZE) + 1
-  logger.info('Estimated chunks: %s', str(estimated_chunks))
-
-  # if number of estimated chunks is greater than 1, split text and call Amazon Bedrock for each chunk, and concatenate results into a singe text file with the same name as the original S3 object
-  if estimated_chunks > 1:
-    chunks = chunk_text(body, _CHUNK_SIZE)
-    result = ''
-    for chunk in chunks:
-      prompt = get_prompt(chunk)
-      chunk_size = len(tokenizer.encode(chunk))
-      result += get_llm_result(prompt, chunk_size + _OUTPUT_TOKEN_BUFFER)
-
+    pages = metrics.timed_iter('Textract', iter_textract_pages(get_client('textract'), bucket, key, content_type))
   else:
-    prompt = get_prompt(body)
-    result = get_llm_result(prompt, estimated_tokens + _OUTPUT_TOKEN_BUFFER)
-
-  # strip off XML response tags
-  result = result.replace('<response>', '')
-  result = result.replace('</response>', '')
+    # text documents are decoded as they are read from S3 instead of being loaded into memory at once
+    pages = metrics.timed_iter('S3Get', iter_text(response['Body']))
 
   # take original S3 object and change the prefix to /masked
   output_key = key.replace('documents/', 'masked/')
@@ -136,9 +53,49 @@ def lambda_handler(event, context):
 
   logger.info('Output S3 Key: %s', output_key)
 
-  # Write the response to S3
-  s3.put_object(Bucket=bucket, Key=output_key, Body=result, ContentType='text/plain')  
+  # split pages into chunks that fit into the context window as they are read, and call Amazon Bedrock for the chunks concurrently
+  # masked chunks are written to S3 in their original order as they finish, with a multipart upload for large documents
+  # if a chunk fails the upload is aborted, so a partially masked document is never written
+  chunks = metrics.timed_iter('Chunk', engine.chunk_pages(pages))
+  num_chunks = 0
+  try:
+    with MultipartWriter(get_client('s3'), bucket, output_key) as writer:
+      for chunk_indexes, result, error in engine.mask_chunks(chunks):
+        if error:
+          raise MaskingError(chunk_indexes[0])
+        with metrics.stage('S3Put'):
+          writer.write(result)
+        num_chunks += len(chunk_indexes)
+      with metrics.stage('S3Put'):
+        writer.close()
+  except ExtractionError as e:
+    logger.error(e)
+    logger.error('Failed to extract text, make sure input documents are in PDF, PNG, or JPEG format')
+    # a document Textract can't read is not retried
+    return {
+      'statusCode': 400 if permanent_error(e) else 500,
+      'body': json.dumps('Error calling Textract')
+    }
+  except MaskingError as e:
+    logger.error('Failed to mask chunk %s', e.index)
+    return {
+      'statusCode': 500,
+      'body': json.dumps('Error masking chunk %s' % e.index)
+    }
+  logger.info('Chunks: %s', num_chunks)
+  logger.info('Cache stats: %s', result_cache.stats())
+  logger.info('Scheduler stats: %s', scheduler.stats())
   return {
       'statusCode': 200,
       'body': json.dumps('Document masked successfully!')
   }
+
+# this Lambda function is invoked by S3 event notifications, either directly or through an SQS queue
+# every document in the event is processed, and SQS deliveries get a partial batch response so only failed documents are retried
+# metrics cover all documents of the event
+def lambda_handler(event, context):
+  metrics.reset()
+  try:
+    return process_event(event, process_document, _MAX_DOCUMENT_CONCURRENCY)
+  finally:
+    metrics.flush()
@@ -0,0 +1,72 @@
+# Registry of the Amazon Bedrock models the functions can call, with what chunk budgets and request bodies depend on
+# each stage of a function (e.g. map prompts, combine prompts, masking) is routed to a model of its own with an environment variable,
+# and chunk budgets are derived from the model of the stage, so a model with a larger context window takes larger chunks and fewer calls
+import json
+import os
+from collections import namedtuple
+
+_DEFAULT_MODEL_ID = 'anthropic.claude-v2'
+_ANTHROPIC_VERSION = 'bedrock-2023-05-31' # version of the Messages API request body on Amazon Bedrock
+_HUMAN_TURN = '\n\nHuman:'
+_ASSISTANT_TURN = '\n\nAssistant:'
+TEXT_COMPLETIONS = 'text-completions' # prompt and max_tokens_to_sample in the request, the text in completion
+MESSAGES = 'messages' # a user message and max_tokens in the request, the text in content blocks
+
+# context_window and max_output_tokens are in tokens, relative_latency is the time of a call compared with Claude v2 for the same prompt and output
+class Model(namedtuple('Model', ['model_id', 'context_window', 'max_output_tokens', 'body_format', 'relative_latency'])):
+  # the prompts are written for the text completion API, as a Human turn followed by an empty Assistant turn
+  # for the Messages API the Human turn becomes the user message
+  def request_body(self, prompt, output_size):
+    if self.body_format == TEXT_COMPLETIONS:
+      return json.dumps({
+        "prompt": prompt,
+        "max_tokens_to_sample": output_size
+      })
+    text = prompt
+    if text.startswith(_HUMAN_TURN):
+      text = text[len(_HUMAN_TURN):]
+    if text.endswith(_ASSISTANT_TURN):
+      text = text[:-len(_ASSISTANT_TURN)]
+    return json.dumps({
+      "anthropic_version": _ANTHROPIC_VERSION,
+      "max_tokens": output_size,
+      "messages": [{"role": "user", "content": text.strip()}]
+    })
+
+  # text of a decoded InvokeModel response body
+  def completion(self, body):
+    if self.body_format == TEXT_COMPLETIONS:
+      return body['completion']
+    return ''.join(block['text'] for block in body['content'] if block.get('type') == 'text')
+
+  # text of a decoded event of an InvokeModelWithResponseStream response, events without text give ''
+  def stream_text(self, payload):
+    if self.body_format == TEXT_COMPLETIONS:
+      return payload.get('completion', '')
+    if payload.get('type') == 'content_block_delta':
+      return payload['delta'].get('text', '')
+    return ''
+
+_MODELS = {model.model_id: model for model in [
+  Model('anthropic.claude-instant-v1', 100000, 4096, TEXT_COMPLETIONS, 0.4),
+  Model('anthropic.claude-v2', 100000, 4096, TEXT_COMPLETIONS, 1.0),
+  Model('anthropic.claude-v2:1', 200000, 4096, TEXT_COMPLETIONS, 1.1),
+  Model('anthropic.claude-3-haiku-20240307-v1:0', 200000, 4096, MESSAGES, 0.3),
+  Model('anthropic.claude-3-sonnet-20240229-v1:0', 200000, 4096, MESSAGES, 0.8),
+  Model('anthropic.claude-3-5-sonnet-20240620-v1:0', 200000, 4096, MESSAGES, 0.7),
+  Model('anthropic.claude-3-5-sonnet-20241022-v2:0', 200000, 8192, MESSAGES, 0.7)
+]}
+
+def model_ids():
+  return list(_MODELS)
+
+def get_model(model_id):
+  if model_id not in _MODELS:
+    raise ValueError('Unknown model %s, the registry has %s' % (model_id, ', '.join(_MODELS)))
+  return _MODELS[model_id]
+
+# model of a stage, from the environment variable of the stage (e.g. MAP_MODEL_ID), or MODEL_ID for all stages, or Claude v2
+# an empty variable counts as unset, so a template can pass an empty parameter for a stage that uses the default model
+def model_from_environment(stage_variable=None):
+  model_id = (os.environ.get(stage_variable) if stage_variable else None) or os.environ.get('MODEL_ID') or _DEFAULT_MODEL_ID
+  return get_model(model_id)
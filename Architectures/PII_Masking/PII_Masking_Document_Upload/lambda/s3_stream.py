@@ -0,0 +1,84 @@
+# Streaming reads and writes of text objects in S3, so memory use is bounded by a few chunks instead of by the size of the document
+import codecs
+import logging
+
+logger = logging.getLogger()
+_READ_SIZE = 64 * 1024 # bytes read from the S3 body at a time, each read is tokenized at once so this also bounds the tokenizer's memory use
+_PART_SIZE = 8 * 1024 * 1024 # bytes per multipart upload part, S3 requires at least 5 MB for every part except the last one
+
+# decode an S3 object body as UTF-8 and yield its text piece by piece
+# the incremental decoder keeps multi-byte characters that are split between two reads intact
+def iter_text(body, read_size=_READ_SIZE):
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  while True:
+    data = body.read(read_size)
+    if not data:
+      break
+    text = decoder.decode(data)
+    if text:
+      yield text
+  text = decoder.decode(b'', final=True)
+  if text:
+    yield text
+
+# write a text object to S3 piece by piece
+# output smaller than one part is written with a single put_object call, larger output is sent with a multipart upload as parts fill up
+# use it as a context manager: the object is completed when the block exits normally, and the upload is aborted if the block raises
+class MultipartWriter:
+  def __init__(self, s3, bucket, key, content_type='text/plain', part_size=_PART_SIZE):
+    self.s3 = s3
+    self.bucket = bucket
+    self.key = key
+    self.content_type = content_type
+    self.part_size = part_size
+    self.buffer = bytearray()
+    self.upload_id = None
+    self.parts = []
+    self.closed = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+    return False
+
+  def write(self, text):
+    self.buffer += text.encode('utf-8')
+    while len(self.buffer) >= self.part_size:
+      self.upload_part(bytes(self.buffer[:self.part_size]))
+      del self.buffer[:self.part_size]
+
+  def upload_part(self, data):
+    if self.upload_id is None:
+      self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, ContentType=self.content_type)['UploadId']
+      logger.info('Started multipart upload of %s', self.key)
+    part_number = len(self.parts) + 1
+    response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=data)
+    self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+  # the object is only written once, so close can be called before the block exits
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    if self.upload_id is None:
+      self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type)
+    else:
+      if self.buffer:
+        self.upload_part(bytes(self.buffer))
+      self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+      logger.info('Completed multipart upload of %s in %s parts', self.key, len(self.parts))
+    self.buffer = bytearray()
+
+  # uploaded parts are deleted, so no partial output is left behind
+  def abort(self):
+    if self.upload_id is not None:
+      try:
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+      except Exception as e:
+        logger.warning('Failed to abort multipart upload of %s: %s', self.key, e)
+    self.buffer = bytearray()
@@ -0,0 +1,182 @@
+# Client-side scheduling of Amazon Bedrock calls: requests/min and tokens/min limits, a concurrency limit that backs off when calls are throttled,
+# and retries with exponential backoff and jitter for throttling and model timeouts
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger()
+_RETRYABLE_ERROR_CODES = ['ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException', 'ModelTimeoutException', 'ServiceUnavailableException', 'ModelNotReadyException']
+_TIMEOUT_ERRORS = ['ReadTimeoutError', 'ConnectTimeoutError', 'ModelTimeoutException']
+_THROTTLING_ERROR_CODES = ['ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException']
+
+# the error code of a botocore ClientError, or the class name for other exceptions (e.g. botocore's ReadTimeoutError)
+# errors raised while a response stream is read have camel-case codes (e.g. throttlingException), they are given the codes of the same errors of a request
+def error_code(error):
+  response = getattr(error, 'response', None)
+  if isinstance(response, dict) and 'Error' in response:
+    code = response['Error'].get('Code') or ''
+    return code[:1].upper() + code[1:]
+  return type(error).__name__
+
+# a limit of per_minute units per minute, with a burst of up to one minute of units
+# a request larger than the bucket waits until the bucket is full, so it is delayed but never blocked forever
+class TokenBucket:
+  def __init__(self, per_minute):
+    self.capacity = float(per_minute)
+    self.available = float(per_minute)
+    self.rate = per_minute / 60.0
+    self.updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  # take amount units, sleeping until they are available, and return the time spent waiting
+  def acquire(self, amount):
+    amount = min(float(amount), self.capacity)
+    waited = 0.0
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.available >= amount:
+          self.available -= amount
+          return waited
+        delay = (amount - self.available) / self.rate
+      time.sleep(delay)
+      waited += delay
+
+# limits the number of calls in flight to limit, which is lowered when calls are throttled and raised again as calls succeed (additive increase, multiplicative decrease)
+class AdaptiveLimit:
+  def __init__(self, max_limit):
+    self.max_limit = max(1, max_limit)
+    self.limit = float(self.max_limit)
+    self.in_flight = 0
+    self._condition = threading.Condition()
+
+  def acquire(self):
+    with self._condition:
+      while self.in_flight >= int(self.limit):
+        self._condition.wait()
+      self.in_flight += 1
+
+  def release(self, throttled):
+    with self._condition:
+      self.in_flight -= 1
+      if throttled:
+        self.limit = max(1.0, self.limit / 2)
+      else:
+        self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+      self._condition.notify_all()
+
+class InvocationScheduler:
+  def __init__(self, max_concurrency, requests_per_minute=0, tokens_per_minute=0, max_attempts=5, base_delay=1.0, max_delay=20.0):
+    self.concurrency = AdaptiveLimit(max_concurrency)
+    self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+    self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+    self.max_attempts = max_attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.calls = 0
+    self.attempts = 0
+    self.throttles = 0
+    self.timeouts = 0
+    self.failures = 0
+    self.queue_wait_seconds = 0.0
+    self.max_queue_wait_seconds = 0.0
+    self._lock = threading.Lock()
+
+  # call fn(), which makes one Amazon Bedrock request of about tokens tokens (input and output), and return its result
+  # the call waits for the rate limits and the concurrency limit, and is retried on throttling and timeouts
+  def call(self, fn, tokens=0):
+    self._count(calls=1)
+    for attempt in range(1, self.max_attempts + 1):
+      waited = self.wait_for_capacity(tokens)
+      throttled = False
+      try:
+        return fn()
+      except Exception as e:
+        throttled, delay = self.on_error(e, attempt, waited)
+        if delay is None:
+          raise
+      finally:
+        self.concurrency.release(throttled)
+      time.sleep(delay)
+
+  # same as call for a streaming request: fn() opens the stream and returns an iterator over its pieces, which are yielded as they arrive
+  # the call keeps its place in the concurrency limit until the stream is exhausted or closed, so streams being read count against the limit,
+  # and errors raised while the stream is read (e.g. throttlingException) lower the limit like errors of the request
+  # a stream that fails is only retried if none of its pieces have been yielded, pieces that were yielded can't be taken back
+  def stream(self, fn, tokens=0):
+    self._count(calls=1)
+    for attempt in range(1, self.max_attempts + 1):
+      waited = self.wait_for_capacity(tokens)
+      throttled = False
+      yielded = False
+      try:
+        for piece in fn():
+          yielded = True
+          yield piece
+        return
+      except Exception as e:
+        throttled, delay = self.on_error(e, attempt, waited, retry=not yielded)
+        if delay is None:
+          raise
+      finally:
+        self.concurrency.release(throttled)
+      time.sleep(delay)
+
+  # count a failed attempt, returns whether it was throttled and the time to wait before retrying it, or None if it is not retried
+  def on_error(self, error, attempt, waited, retry=True):
+    code = error_code(error)
+    throttled = code in _THROTTLING_ERROR_CODES
+    self._count(throttles=int(throttled), timeouts=int(code in _TIMEOUT_ERRORS))
+    if not retry or (code not in _RETRYABLE_ERROR_CODES and code not in _TIMEOUT_ERRORS) or attempt == self.max_attempts:
+      self._count(failures=1)
+      return throttled, None
+    # full jitter: wait a random time up to the exponential backoff, so throttled calls don't all retry at the same moment
+    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+    logger.warning('Amazon Bedrock call failed with %s on attempt %s (queued %.2fs), retrying in %.2fs', code, attempt, waited, delay)
+    return throttled, delay
+
+  # wait until the call fits into the concurrency and rate limits, and return the time spent waiting
+  def wait_for_capacity(self, tokens):
+    start = time.monotonic()
+    self.concurrency.acquire()
+    if self.request_bucket:
+      self.request_bucket.acquire(1)
+    if self.token_bucket and tokens:
+      self.token_bucket.acquire(tokens)
+    waited = time.monotonic() - start
+    with self._lock:
+      self.attempts += 1
+      self.queue_wait_seconds += waited
+      self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, waited)
+    return waited
+
+  def _count(self, **counters):
+    with self._lock:
+      for counter, value in counters.items():
+        setattr(self, counter, getattr(self, counter) + value)
+
+  def stats(self):
+    return {
+      'calls': self.calls,
+      'attempts': self.attempts,
+      'throttles': self.throttles,
+      'timeouts': self.timeouts,
+      'failures': self.failures,
+      'throttle_rate': round(self.throttles / self.attempts, 4) if self.attempts else 0.0,
+      'avg_queue_wait_seconds': round(self.queue_wait_seconds / self.attempts, 4) if self.attempts else 0.0,
+      'max_queue_wait_seconds': round(self.max_queue_wait_seconds, 4),
+      'concurrency_limit': int(self.concurrency.limit)
+    }
+
+# build the scheduler from environment variables, REQUESTS_PER_MINUTE and TOKENS_PER_MINUTE of 0 (the default) mean no limit
+def scheduler_from_environment(max_concurrency):
+  return InvocationScheduler(
+    max_concurrency,
+    requests_per_minute=int(os.environ.get('REQUESTS_PER_MINUTE', '0')),
+    tokens_per_minute=int(os.environ.get('TOKENS_PER_MINUTE', '0')),
+    max_attempts=int(os.environ.get('MAX_INVOKE_ATTEMPTS', '5'))
+  )
@@ -0,0 +1,106 @@
+# Span-based masking: the model returns the PII it found in a chunk as a list of (text, marker) pairs instead of rewriting the chunk,
+# and the replacements are applied locally, so everything that is not PII is kept byte for byte
+import json
+from collections import deque
+
+_OPEN_TAG = '<entities>'
+_CLOSE_TAG = '</entities>'
+
+# Aho-Corasick automaton, finds all occurrences of all patterns in a single pass over the text
+class Matcher:
+  def __init__(self, patterns):
+    self.patterns = patterns
+    self.goto = [{}]
+    self.fail = [0]
+    self.output = [[]]
+    for index, pattern in enumerate(patterns):
+      state = 0
+      for char in pattern:
+        if char not in self.goto[state]:
+          self.goto[state][char] = len(self.goto)
+          self.goto.append({})
+          self.fail.append(0)
+          self.output.append([])
+        state = self.goto[state][char]
+      self.output[state].append(index)
+    # breadth first, so the fail state (the longest proper suffix that is also a prefix of a pattern) of every state is computed before its children
+    queue = deque(self.goto[0].values())
+    while queue:
+      state = queue.popleft()
+      for char, next_state in self.goto[state].items():
+        queue.append(next_state)
+        fallback = self.fail[state]
+        while fallback and char not in self.goto[fallback]:
+          fallback = self.fail[fallback]
+        self.fail[next_state] = self.goto[fallback].get(char, 0)
+        self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+  # yield (start, end, pattern index) for every occurrence of every pattern
+  def find(self, text):
+    state = 0
+    for position, char in enumerate(text):
+      while state and char not in self.goto[state]:
+        state = self.fail[state]
+      state = self.goto[state].get(char, 0)
+      for index in self.output[state]:
+        yield position + 1 - len(self.patterns[index]), position + 1, index
+
+def is_word_char(char):
+  return char.isalnum() or char == '_'
+
+# an occurrence only counts if it is not part of a longer word, e.g. the name Al is not masked inside Alice
+def on_word_boundary(text, start, end):
+  if is_word_char(text[start]) and start > 0 and is_word_char(text[start - 1]):
+    return False
+  if is_word_char(text[end - 1]) and end < len(text) and is_word_char(text[end]):
+    return False
+  return True
+
+# parse the model's completion into a list of (text, marker) pairs
+# returns None if the completion has no complete list, e.g. because it was cut off by max_tokens_to_sample
+def parse_entities(completion):
+  start = completion.find(_OPEN_TAG)
+  end = completion.find(_CLOSE_TAG, start + 1)
+  if start == -1 or end == -1:
+    return None
+  try:
+    items = json.loads(completion[start + len(_OPEN_TAG):end])
+  except ValueError:
+    return None
+  if not isinstance(items, list):
+    return None
+  entities = []
+  for item in items:
+    if not isinstance(item, list) or len(item) != 2 or not all(isinstance(value, str) for value in item):
+      return None
+    text, marker = item
+    if not text.strip():
+      continue
+    if not marker.startswith('['):
+      marker = '[' + marker + ']'
+    entities.append((text, marker))
+  return entities
+
+# replace every occurrence of the entities in text with their markers, and return the masked text and the entities that were not found
+# overlapping occurrences are resolved leftmost first, then longest first, so "Bo Nguyen" wins over "Bo"
+def apply_entities(text, entities):
+  markers = {}
+  for entity, marker in entities:
+    markers.setdefault(entity, marker)
+  if not markers:
+    return text, []
+  patterns = list(markers)
+  matches = [match for match in Matcher(patterns).find(text) if on_word_boundary(text, match[0], match[1])]
+  matches.sort(key=lambda match: (match[0], match[0] - match[1]))
+  parts = []
+  position = 0
+  for start, end, index in matches:
+    if start < position:
+      continue
+    parts.append(text[position:start])
+    parts.append(markers[patterns[index]])
+    position = end
+  parts.append(text[position:])
+  found = set(index for _, _, index in matches)
+  missing = [pattern for index, pattern in enumerate(patterns) if index not in found]
+  return ''.join(parts), missing
@@ -0,0 +1,39 @@
+# Helpers for consuming Amazon Bedrock response streams (invoke_model_with_response_stream) incrementally
+import json
+
+# yield the completion text of each event in a Bedrock response stream as it arrives
+# the last event carries the invocation metrics (token counts and latency), which are passed to on_metrics if given
+# text_of gives the text of an event for the request body format of the model (e.g. Model.stream_text), by default the text completion API
+def iter_completion(response, on_metrics=None, text_of=None):
+  text_of = text_of or (lambda payload: payload['completion'])
+  for event in response['body']:
+    chunk = event.get('chunk')
+    if chunk:
+      payload = json.loads(chunk['bytes'])
+      if on_metrics and 'amazon-bedrock-invocationMetrics' in payload:
+        on_metrics(payload['amazon-bedrock-invocationMetrics'])
+      text = text_of(payload)
+      if text:
+        yield text
+
+# length of the longest suffix of text that could be the start of one of the tags
+def partial_tag_length(text, tags):
+  start = text.rfind('<', max(0, len(text) - max(len(tag) for tag in tags)))
+  if start != -1 and any(tag.startswith(text[start:]) for tag in tags):
+    return len(text) - start
+  return 0
+
+# remove tags such as <response> from a stream of text pieces on the fly
+# only text that could be the start of a tag split across pieces is held back until the next piece arrives
+def strip_tags(pieces, tags):
+  pending = ''
+  for piece in pieces:
+    pending += piece
+    for tag in tags:
+      pending = pending.replace(tag, '')
+    hold = partial_tag_length(pending, tags)
+    if len(pending) > hold:
+      yield pending[:len(pending) - hold]
+      pending = pending[len(pending) - hold:]
+  if pending:
+    yield pending
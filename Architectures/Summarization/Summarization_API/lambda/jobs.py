@@ -0,0 +1,341 @@
+# Asynchronous jobs for inputs that take longer to process than the API Gateway timeout allows
+# a job is submitted with its input text, processed in the background and polled for its status
+# the input is split into parts (chunks, or packs of chunks) whose results are stored as soon as they are done,
+# so a poll returns the finished parts, and a job that runs again (e.g. after its invocation timed out) only processes the parts that are not done yet
+# a running job updates its record every minute, a poll finds a job that stopped (e.g. its invocation timed out) and starts it again
+# polls return the finished parts a page at a time, and the result of a job in S3 as a presigned URL, so responses stay below the Lambda payload limit
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing, contextmanager
+from clients import get_client
+from parallel import map_ordered
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+SUCCEEDED = 'SUCCEEDED'
+FAILED = 'FAILED'
+_JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+_HEARTBEAT_SECONDS = 60 # a running job updates its record this often
+_STALE_JOB_SECONDS = 300 # a pending or running job whose record has not been updated for this long has stopped
+_MAX_JOB_RUNS = 3 # a job that stopped is started again until it has been started this many times, then it is failed
+_MAX_PARTIAL_RESULTS_BYTES = 4 * 1024 * 1024 # finished parts returned by a poll, in JSON, at least one part is returned (Lambda responses are limited to 6 MB)
+_RESULT_URL_SECONDS = 3600 # the presigned URL of the result of a job expires after this long
+
+# keeps jobs in memory, for jobs processed in a thread of the same process (e.g. when running the function locally)
+class MemoryJobStore:
+  def __init__(self):
+    self._inputs = {}
+    self._jobs = {}
+    self._parts = {}
+    self._results = {}
+    self._lock = threading.Lock()
+
+  def put_input(self, job_id, text):
+    with self._lock:
+      self._inputs[job_id] = text
+
+  def get_input(self, job_id):
+    with self._lock:
+      return self._inputs.get(job_id)
+
+  # add or change fields of the job record
+  def update_job(self, job_id, **fields):
+    with self._lock:
+      self._jobs.setdefault(job_id, {}).update(fields)
+
+  def get_job(self, job_id):
+    with self._lock:
+      job = self._jobs.get(job_id)
+      return dict(job) if job is not None else None
+
+  def put_part(self, job_id, index, result, chunks):
+    with self._lock:
+      self._parts.setdefault(job_id, {})[index] = (result, chunks)
+
+  # the finished parts of a job, {index: (result, number of chunks)}
+  def get_parts(self, job_id):
+    with self._lock:
+      return dict(self._parts.get(job_id, {}))
+
+  # the finished parts of a job without their results, {index: (number of chunks, size of the result in JSON)}
+  def list_parts(self, job_id):
+    return {index: (chunks, len(json.dumps(result))) for index, (result, chunks) in self.get_parts(job_id).items()}
+
+  def get_part(self, job_id, index, chunks):
+    return self.get_parts(job_id)[index][0]
+
+  def put_result(self, job_id, result):
+    with self._lock:
+      self._results[job_id] = result
+
+  def get_result(self, job_id):
+    with self._lock:
+      return self._results.get(job_id)
+
+  # results are returned inline, there is no URL for them
+  def result_url(self, job_id):
+    return None
+
+# keeps jobs in a SQLite database file, so jobs submitted by one local process can be processed or polled by another
+class SQLiteJobStore:
+  def __init__(self, path):
+    self.path = path
+    self._execute('CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, job TEXT NOT NULL, input TEXT, result TEXT)')
+    self._execute('CREATE TABLE IF NOT EXISTS parts (job_id TEXT, part INTEGER, result TEXT, chunks INTEGER, PRIMARY KEY (job_id, part))')
+
+  # a connection per statement, so the store can be used from several threads
+  def _execute(self, sql, parameters=()):
+    with closing(sqlite3.connect(self.path, timeout=30)) as connection:
+      with connection:
+        return connection.execute(sql, parameters).fetchall()
+
+  def put_input(self, job_id, text):
+    self._execute('INSERT INTO jobs (job_id, job, input) VALUES (?, ?, ?) ON CONFLICT (job_id) DO UPDATE SET input = excluded.input', (job_id, '{}', text))
+
+  def get_input(self, job_id):
+    rows = self._execute('SELECT input FROM jobs WHERE job_id = ?', (job_id,))
+    return rows[0][0] if rows else None
+
+  def update_job(self, job_id, **fields):
+    with closing(sqlite3.connect(self.path, timeout=30)) as connection:
+      with connection:
+        row = connection.execute('SELECT job FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        job = json.loads(row[0]) if row else {}
+        job.update(fields)
+        connection.execute('INSERT INTO jobs (job_id, job) VALUES (?, ?) ON CONFLICT (job_id) DO UPDATE SET job = excluded.job', (job_id, json.dumps(job)))
+
+  def get_job(self, job_id):
+    rows = self._execute('SELECT job FROM jobs WHERE job_id = ?', (job_id,))
+    return json.loads(rows[0][0]) if rows else None
+
+  def put_part(self, job_id, index, result, chunks):
+    self._execute('INSERT OR REPLACE INTO parts (job_id, part, result, chunks) VALUES (?, ?, ?, ?)', (job_id, index, result, chunks))
+
+  def get_parts(self, job_id):
+    rows = self._execute('SELECT part, result, chunks FROM parts WHERE job_id = ?', (job_id,))
+    return {index: (result, chunks) for index, result, chunks in rows}
+
+  def list_parts(self, job_id):
+    return {index: (chunks, len(json.dumps(result))) for index, (result, chunks) in self.get_parts(job_id).items()}
+
+  def get_part(self, job_id, index, chunks):
+    rows = self._execute('SELECT result FROM parts WHERE job_id = ? AND part = ?', (job_id, index))
+    return rows[0][0] if rows else None
+
+  def put_result(self, job_id, result):
+    self._execute('UPDATE jobs SET result = ? WHERE job_id = ?', (result, job_id))
+
+  def get_result(self, job_id):
+    rows = self._execute('SELECT result FROM jobs WHERE job_id = ?', (job_id,))
+    return rows[0][0] if rows else None
+
+  def result_url(self, job_id):
+    return None
+
+# keeps jobs in an S3 bucket, one object for the input, the job record, each finished part and the result, under <prefix><job id>/
+# the job record is written by the submitting request, the function processing the job and a poll that starts a stopped job again
+# the key of a part holds its index and number of chunks, so the progress of a job is known from listing its parts
+class S3JobStore:
+  def __init__(self, bucket, prefix):
+    self.bucket = bucket
+    self.prefix = prefix
+
+  # the S3 client is created on first use, not when the store is built at import time
+  @property
+  def s3(self):
+    return get_client('s3')
+
+  def _key(self, job_id, name):
+    return '%s%s/%s' % (self.prefix, job_id, name)
+
+  def _get(self, key):
+    try:
+      return self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read().decode('utf-8')
+    except self.s3.exceptions.NoSuchKey:
+      return None
+
+  def _put(self, key, value, content_type):
+    self.s3.put_object(Bucket=self.bucket, Key=key, Body=value.encode('utf-8'), ContentType=content_type)
+
+  def put_input(self, job_id, text):
+    self._put(self._key(job_id, 'input.txt'), text, 'text/plain')
+
+  def get_input(self, job_id):
+    return self._get(self._key(job_id, 'input.txt'))
+
+  def update_job(self, job_id, **fields):
+    job = self.get_job(job_id) or {}
+    job.update(fields)
+    self._put(self._key(job_id, 'job.json'), json.dumps(job), 'application/json')
+
+  def get_job(self, job_id):
+    job = self._get(self._key(job_id, 'job.json'))
+    return json.loads(job) if job is not None else None
+
+  def _part_key(self, job_id, index, chunks):
+    return self._key(job_id, 'parts/%06d.%d.json' % (index, chunks))
+
+  def put_part(self, job_id, index, result, chunks):
+    self._put(self._part_key(job_id, index, chunks), json.dumps({'result': result, 'chunks': chunks}), 'application/json')
+
+  def get_parts(self, job_id):
+    return {index: (self.get_part(job_id, index, chunks), chunks) for index, (chunks, _) in self.list_parts(job_id).items()}
+
+  def list_parts(self, job_id):
+    parts = {}
+    prefix = self._key(job_id, 'parts/')
+    for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+      for item in page.get('Contents', []):
+        index, chunks = item['Key'][len(prefix):].split('.')[:2]
+        parts[int(index)] = (int(chunks), item['Size'])
+    return parts
+
+  def get_part(self, job_id, index, chunks):
+    return json.loads(self._get(self._part_key(job_id, index, chunks)))['result']
+
+  def put_result(self, job_id, result):
+    self._put(self._key(job_id, 'result.txt'), result, 'text/plain; charset=utf-8')
+
+  def get_result(self, job_id):
+    return self._get(self._key(job_id, 'result.txt'))
+
+  def result_url(self, job_id):
+    return self.s3.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': self._key(job_id, 'result.txt')}, ExpiresIn=_RESULT_URL_SECONDS)
+
+def valid_job_id(job_id):
+  return bool(_JOB_ID.match(job_id or ''))
+
+# store the input of a new job and return its id, the job is not started
+def new_job(store, text):
+  job_id = uuid.uuid4().hex
+  store.put_input(job_id, text)
+  store.update_job(job_id, status=PENDING, submitted=time.time())
+  return job_id
+
+# process a job in the background: with function_name, by invoking that Lambda function asynchronously with {'job_id': ...},
+# otherwise by calling run(job_id) in a thread of this process, which only works while the process keeps running (e.g. locally)
+def start_job(job_id, run, function_name=None):
+  if function_name:
+    get_client('lambda').invoke(FunctionName=function_name, InvocationType='Event', Payload=json.dumps({'job_id': job_id}))
+  else:
+    threading.Thread(target=run, args=(job_id,), daemon=True).start()
+
+# process the parts of a job that are not done yet, storing each result as soon as it is done, then combine the results of all parts
+# split(text) returns the parts as (item, number of chunks) pairs, process(item) the result of a part and combine(results) the result of the job
+# returns whether the job succeeded, a failure is recorded in the job instead of being raised
+def run_job(store, job_id, split, process, combine, max_workers, attempts=1):
+  job = store.get_job(job_id)
+  if job is None:
+    raise KeyError('Job %s not found' % job_id)
+  # asynchronous invocations can be delivered more than once
+  if job['status'] == SUCCEEDED:
+    return True
+  text = store.get_input(job_id)
+  parts = split(text)
+  now = time.time()
+  store.update_job(job_id, status=RUNNING, parts=len(parts), chunks=sum(chunks for _, chunks in parts), started=now, updated=now)
+  results = {index: result for index, (result, _) in store.get_parts(job_id).items()}
+  todo = [index for index in range(len(parts)) if index not in results]
+
+  def process_part(index):
+    item, chunks = parts[index]
+    result = process(item)
+    store.put_part(job_id, index, result, chunks)
+    return result
+
+  with heartbeat(store, job_id):
+    done, errors = map_ordered(process_part, todo, max_workers, attempts=attempts)
+  if errors:
+    failed = sorted(todo[position] for position in errors)
+    store.update_job(job_id, status=FAILED, error='Failed to process parts %s of %s' % (failed, len(parts)), finished=time.time())
+    return False
+  results.update(zip(todo, done))
+  try:
+    result = combine([results[index] for index in range(len(parts))])
+  except Exception as e:
+    store.update_job(job_id, status=FAILED, error='Failed to combine the results: %s' % e, finished=time.time())
+    return False
+  store.put_result(job_id, result)
+  store.update_job(job_id, status=SUCCEEDED, finished=time.time())
+  return True
+
+# update the record of a running job every _HEARTBEAT_SECONDS in a thread, while the block runs
+# the updates stop with the process, e.g. when its invocation times out, which is how a poll finds that the job stopped
+@contextmanager
+def heartbeat(store, job_id):
+  stopped = threading.Event()
+  def beat():
+    while not stopped.wait(_HEARTBEAT_SECONDS):
+      store.update_job(job_id, updated=time.time())
+  thread = threading.Thread(target=beat, daemon=True)
+  thread.start()
+  try:
+    yield
+  finally:
+    stopped.set()
+    thread.join()
+
+# the status of a job for the API, or None if there is no such job
+# progress is counted in chunks, the results of the finished parts from part first_part are returned while the job runs, up to _MAX_PARTIAL_RESULTS_BYTES,
+# with next_part set to the part the next page starts at if there are more
+# once the job succeeded its result is returned under result_field, or a presigned URL of it under <result_field>_url if the store has one
+# a pending or running job that has stopped is started again with restart(job_id), or failed once it has been started _MAX_JOB_RUNS times
+def job_status(store, job_id, result_field, first_part=0, restart=None):
+  job = store.get_job(job_id) if valid_job_id(job_id) else None
+  if job is None:
+    return None
+  if job['status'] in (PENDING, RUNNING) and time.time() - job.get('updated', job['submitted']) > _STALE_JOB_SECONDS:
+    job = restart_stale_job(store, job_id, job, restart)
+  status = {'job_id': job_id, 'status': job['status']}
+  if job['status'] == SUCCEEDED:
+    status['chunks_total'] = status['chunks_done'] = job['chunks']
+    url = store.result_url(job_id)
+    if url:
+      status[result_field + '_url'] = url
+    else:
+      status[result_field] = store.get_result(job_id)
+    return status
+  parts = store.list_parts(job_id)
+  status['chunks_total'] = job.get('chunks')
+  status['chunks_done'] = sum(chunks for chunks, _ in parts.values())
+  status['partial_results'] = []
+  size = 0
+  for index in sorted(index for index in parts if index >= first_part):
+    chunks, part_size = parts[index]
+    if status['partial_results'] and size + part_size > _MAX_PARTIAL_RESULTS_BYTES:
+      status['next_part'] = index
+      break
+    status['partial_results'].append({'part': index, 'result': store.get_part(job_id, index, chunks)})
+    size += part_size
+  if job['status'] == FAILED:
+    status['error'] = job['error']
+  return status
+
+# start a job that stopped again, it only processes the parts that are not done yet, or fail it if it has been started too often
+# returns the updated job record
+def restart_stale_job(store, job_id, job, restart):
+  runs = job.get('runs', 1)
+  now = time.time()
+  if restart is None or runs >= _MAX_JOB_RUNS:
+    fields = {'status': FAILED, 'error': 'Job stopped after %s runs without finishing' % runs, 'finished': now}
+  else:
+    fields = {'status': PENDING, 'runs': runs + 1, 'updated': now}
+  store.update_job(job_id, **fields)
+  if fields['status'] == PENDING:
+    restart(job_id)
+  job.update(fields)
+  return job
+
+# build the job store from environment variables
+# JOBS_BUCKET/JOBS_PREFIX select an S3 bucket, JOBS_DB a SQLite database file (e.g. for local runs), otherwise jobs are kept in memory
+def job_store_from_environment():
+  if os.environ.get('JOBS_BUCKET'):
+    return S3JobStore(os.environ['JOBS_BUCKET'], os.environ.get('JOBS_PREFIX', 'jobs/'))
+  if os.environ.get('JOBS_DB'):
+    return SQLiteJobStore(os.environ['JOBS_DB'])
+  return MemoryJobStore()
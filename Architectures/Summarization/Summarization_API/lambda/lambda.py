@@ -1,25 +1,45 @@
 import json
+from functools import lru_cache
+import os
 import logging
-import boto3
-from langchain.prompts import PromptTemplate
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.llms.bedrock import Bedrock
-from langchain.chains.summarize import load_summarize_chain
-from langchain.chains.llm import LLMChain
-from langchain.chains.combine_documents.stuff import StuffDocumentsChain
-import tiktoken
-
-bedrock = boto3.client('bedrock-runtime')
+from cache import cache_from_environment, make_key
+from chunking import split_text
+from clients import configure_client, get_client
+from extractive import reduce_text
+from jobs import PENDING, job_status, job_store_from_environment, new_job, run_job, start_job
+from map_reduce import reduce_summaries, run_stage
+from metrics import metrics_from_environment, token_counts
+from models import model_from_environment
+from prompts import CompiledPrompt
+from scheduler import scheduler_from_environment
+from tokenization import estimate_tokens, tokenizer_from_environment
+from streaming import iter_completion, strip_tags
+
+_MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '4')) # maximum number of map or combine prompts sent to Amazon Bedrock at the same time
+_MAX_CALL_ATTEMPTS = 2 # number of times a map or combine prompt is attempted before the summary fails
+# retries are left to the scheduler, which also backs off the concurrency and applies the rate limits
+configure_client('bedrock-runtime', max_pool_connections=max(10, _MAX_CONCURRENCY), retries={'mode': 'standard', 'max_attempts': 1})
+scheduler = scheduler_from_environment(_MAX_CONCURRENCY) # module level so the limits are shared by all documents and chunks processed by this instance
+result_cache = cache_from_environment() # module level so cached results survive warm invocations
+metrics = metrics_from_environment() # stage timings and token counts, written as one record per request
+job_store = job_store_from_environment() # where asynchronous jobs keep their input, progress and result
+_JOB_FUNCTION_NAME = os.environ.get('JOB_FUNCTION_NAME') # function that processes jobs in the background, without it jobs run in a thread of this process (local runs only)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-_MODEL_ID = 'anthropic.claude-v2'
-_TIKTOKEN_ENCODING = 'p50k_base' # we use a BPE tokenizer to estimate number of tokens in input (required since we do not have direct access to model's tokenizer)
-tokenizer = tiktoken.get_encoding(_TIKTOKEN_ENCODING)
-_PROMPT_TOKENS = 500 # overestimation of number of tokens in prompt (not including input document)
-_CONTEXT_WINDOW = 100000 # for Claude v2 100k
+_MAP_MODEL = model_from_environment('MAP_MODEL_ID') # model of the map prompts, a low-latency model shortens the map stage of large documents
+_REDUCE_MODEL = model_from_environment('REDUCE_MODEL_ID') # model of the combine prompts and the stuff prompt, which write the summary that is returned
+
+# the tokenizer is loaded on first use instead of at import time, so cold starts don't pay for it before the handler runs
+# by default it is the Claude vocabulary that comes with the function, so loading it needs no network access (see tokenization.py)
+@lru_cache(maxsize=None)
+def get_tokenizer():
+  return tokenizer_from_environment()
+
 _OUTPUT_TOKEN_BUFFER = 100 # buffer for the max_tokens_to_sample to prevent output from being cut off
 _MAX_SUMMARY_LENGTH = 300
-_MAX_INPUT_SIZE = _CONTEXT_WINDOW - _PROMPT_TOKENS - _MAX_SUMMARY_LENGTH - _OUTPUT_TOKEN_BUFFER
+_MAP_PROMPT_EXAMPLE = os.environ.get('MAP_PROMPT_EXAMPLE', 'true').lower() == 'true' # include the few-shot example in map prompts, leaving it out saves about 1,500 input tokens per chunk
+_EXTRACTIVE_REDUCTION = os.environ.get('EXTRACTIVE_REDUCTION', 'false').lower() == 'true' # reduce large documents to their top-ranked sentences before they are summarized
+_EXTRACTIVE_TOKEN_BUDGET = int(os.environ.get('EXTRACTIVE_TOKEN_BUDGET', '0')) # tokens kept by the extractive reduction, 0 for what fits into a single prompt
 _EXAMPLE_TEXT = """
 H: <text>
 Q. Sam, you have been through games like Louisville last week, but was it any different here to come back from the adversity with USC coming in, and just how did you sort of manage that over the last seven days?
@@ -57,20 +77,19 @@ A: <summary>
 Quarterback Sam Hartman discussed Notre Dame's comeback win against USC. He said the adversity after losing to Louisville challenged the team, but coach Marcus Freeman's leadership guided them through. Hartman said the team had a \"special week\" preparing for USC, one of the best offenses in the country. He credited the historic defensive performance that shut down USC. Offensively, Hartman discussed the importance of scoring a touchdown on the first drive to build confidence. He praised receiver Chris Tyree for his persistence and growth this season despite struggles. Their connection on a touchdown pass exemplified Tyree's hard work. Hartman also credited the offensive line for bouncing back after a rough game against Louisville. He said the culture and leadership of players like center Zeke Correll set the tone in practice to be ready for USC. Personally, Hartman called the USC win a special moment in his career that he'll cherish. He said the fan support and football culture at Notre Dame are incredible. Beating a storied rival like USC will stay with him forever.
 </summary>
 """
-_MAP_PROMPT_TEMPLATE = PromptTemplate(
-  input_variables=["text", "example"],
-  template="""
+_EXAMPLE = """Here is an example:
+<example>
+{example}
+</example>
+
+""".format(example=_EXAMPLE_TEXT)
+_MAP_PROMPT_TEMPLATE = """
 
 Human: Given some text, we want to distill the text into a summary of the main themes.
 
 Write your summary within <summary></summary> tags.
 
-Here is an example:
-<example>
-{example}
-</example>
-
-Here is the text, inside  <text></text> XML tags.
+{example}Here is the text, inside  <text></text> XML tags.
 <text>
 {text}
 </text>
@@ -78,21 +97,13 @@ Here is the text, inside  <text></text> XML tags.
 Write a concise summary of the above text.
 
 Assistant:"""
-)
-_COMBINE_PROMPT_TEMPLATE = PromptTemplate(
-  input_variables=["text", "example"],
-  template="""
+_COMBINE_PROMPT_TEMPLATE = """
 
 Human: Given a set of summaries, we want to distill them into a final, consolidated summary of the main themes.
 
 Write your summary within <summary></summary> tags.
 
-Here is an example:
-<example>
-{example}
-</example>
-
-Here is the text, inside <text></text> XML tags.
+{example}Here is the text, inside <text></text> XML tags.
 
 <text>
 {text}
@@ -101,21 +112,13 @@ Here is the text, inside <text></text> XML tags.
 Write a <300 word concise summary of the above text within <summary></summary> tags.
 
 Assistant:"""
-)
-_STUFF_PROMPT_TEMPLATE = PromptTemplate(
-  input_variables=["text", "example"],
-  template="""
+_STUFF_PROMPT_TEMPLATE = """
 
 Human: Given some text, we want to create a concise summary of the main themes.
 
 Write your summary within <summary></summary> tags.
 
-Here is an example:
-<example>
-{example}
-</example>
-
-Here is the text, inside <text></text> XML tags.
+{example}Here is the text, inside <text></text> XML tags.
 <text>
 {text}
 </text>
@@ -123,14 +126,39 @@ Here is the text, inside <text></text> XML tags.
 Write a <300 word concise summary of the above text within <summary></summary> tags.
 
 Assistant:"""
-)
 
+# split text into chunks of at most chunk_size tokens, each chunk comes with its token count
 def chunk_text(text, chunk_size):
-  return RecursiveCharacterTextSplitter(separators=["\n\n", "\n"], chunk_size=chunk_size, chunk_overlap=int(chunk_size / 100)).create_documents([text])
+  return split_text(text, get_tokenizer(), chunk_size, chunk_overlap=int(chunk_size / 100))
+
+def count_tokens(text):
+  with metrics.stage('Tokenize'):
+    return len(get_tokenizer().encode(text, disallowed_special=()))
 
-def estimate_num_chunks(text):
-  estimated_tokens = len(tokenizer.encode(text))
-  return (estimated_tokens // _MAX_INPUT_SIZE) + 1
+# the static parts of the prompts are built once per container, each prompt is sent to the model of its stage
+_MAP_PROMPT = CompiledPrompt(_MAP_PROMPT_TEMPLATE, 'text', count_tokens, model=_MAP_MODEL, example=_EXAMPLE if _MAP_PROMPT_EXAMPLE else '')
+_COMBINE_PROMPT = CompiledPrompt(_COMBINE_PROMPT_TEMPLATE, 'text', count_tokens, model=_REDUCE_MODEL, example=_EXAMPLE)
+_STUFF_PROMPT = CompiledPrompt(_STUFF_PROMPT_TEMPLATE, 'text', count_tokens, model=_REDUCE_MODEL, example=_EXAMPLE)
+
+# number of tokens allowed in the {text} part of a prompt, the rest of the context window of its model holds the prompt itself and the summary
+def max_input_size(prompt):
+  return prompt.model.context_window - prompt.tokens - _MAX_SUMMARY_LENGTH - _OUTPUT_TOKEN_BUFFER
+
+# the whole document fits into a single stuff prompt, chunks are split for the map prompt, which can be shorter
+def fits_stuff_prompt(chunks):
+  return len(chunks) <= 1 and sum(chunk.token_count for chunk in chunks) <= max_input_size(_STUFF_PROMPT)
+
+# a document reduced to the default budget fits into a single chunk and a single stuff prompt
+def extractive_token_budget():
+  return _EXTRACTIVE_TOKEN_BUDGET or min(max_input_size(_MAP_PROMPT), max_input_size(_STUFF_PROMPT))
+
+# with EXTRACTIVE_REDUCTION, a document with more tokens than the budget is reduced to its top-ranked sentences (see extractive.py),
+# so a document that would need map-reduce is usually summarized with a single prompt
+def reduce_document(text):
+  if not _EXTRACTIVE_REDUCTION:
+    return text
+  with metrics.stage('Extractive'):
+    return reduce_text(text, get_tokenizer(), extractive_token_budget())
 
 def process_llm_output(text_output):
   # strip off XML response tags
@@ -138,40 +166,172 @@ def process_llm_output(text_output):
   text_output = text_output.replace('</summary>', '')
   return text_output
 
+def get_llm_result(model, prompt, output_size):
+  body = model.request_body(prompt, output_size)
+  def invoke():
+    with metrics.stage('Bedrock'):
+      return get_client('bedrock-runtime').invoke_model(
+        accept = 'application/json',
+        contentType = 'application/json',
+        body = body,
+        modelId = model.model_id,
+      )
+  # the rate limits only need a coarse count, so the prompt is not encoded again
+  result = scheduler.call(invoke, tokens=estimate_tokens(prompt) + output_size)
+  metrics.record_call(*token_counts(result))
+  result_text = model.completion(json.loads(result['body'].read()))
+  return result_text
+
+# same as get_llm_result, but yields the completion text as Amazon Bedrock generates it
+def stream_llm_result(model, prompt, output_size):
+  body = model.request_body(prompt, output_size)
+  def invoke():
+    with metrics.stage('Bedrock'):
+      return get_client('bedrock-runtime').invoke_model_with_response_stream(
+        accept = 'application/json',
+        contentType = 'application/json',
+        body = body,
+        modelId = model.model_id,
+      )
+  on_metrics = lambda invocation: metrics.record_call(invocation.get('inputTokenCount'), invocation.get('outputTokenCount'))
+  # the rate limits only need a coarse count, so the prompt is not encoded again
+  # the call holds its place in the concurrency limit until the stream has been read, and errors in the stream are retried like errors of the request
+  pieces = scheduler.stream(lambda: iter_completion(invoke(), on_metrics, model.stream_text), tokens=estimate_tokens(prompt) + output_size)
+  yield from metrics.timed_iter('BedrockStream', pieces)
+
+# summarize text with the given prompt and its model, results are cached by model, prompt, input text and output size
+# so resubmitting a document only calls Amazon Bedrock for the chunks that changed
+def get_summary(prompt, text, output_size):
+  key = make_key(prompt.model.model_id, prompt.key, text, output_size)
+  def summarize():
+    prompt_text = prompt.format(text)
+    return process_llm_output(get_llm_result(prompt.model, prompt_text, output_size)).strip()
+  return result_cache.get_or_compute(key, summarize)
+
+# same as get_summary, but yields the summary as it is generated with the <summary> tags already removed
+def stream_summary(prompt, text, output_size):
+  key = make_key(prompt.model.model_id, prompt.key, text, output_size)
+  cached = result_cache.get(key)
+  if cached is not None:
+    yield cached
+    return
+  pieces = []
+  for piece in strip_tags(stream_llm_result(prompt.model, prompt.format(text), output_size), ['<summary>', '</summary>']):
+    # drop the whitespace before the summary, like get_summary does
+    if not pieces:
+      piece = piece.lstrip()
+      if not piece:
+        continue
+    pieces.append(piece)
+    yield piece
+  result_cache.put(key, ''.join(pieces).strip())
+
+# the whole document fits into the context window, so it is summarized with a single prompt
 def get_summary_short_doc(text_chunks, output_size):
-  llm = Bedrock(
-    model_id = _MODEL_ID,
-    model_kwargs = {
-      "max_tokens_to_sample": output_size  
-    }
-  )
-  llm_chain = LLMChain(llm=llm, prompt=_STUFF_PROMPT_TEMPLATE)
-  # Define StuffDocumentsChain
-  stuff_chain = StuffDocumentsChain(
-      llm_chain=llm_chain, document_variable_name="text", verbose = True
-  )
-  result = stuff_chain.run(input_documents = text_chunks, example = _EXAMPLE_TEXT)
-  return process_llm_output(result)
+  text = '\n\n'.join(chunk.text for chunk in text_chunks)
+  return get_summary(_STUFF_PROMPT, text, output_size)
+
+# summarize each chunk concurrently, then combine the chunk summaries in a tree until they fit into a single combine prompt
+# returns the text for that final combine prompt
+def reduce_chunks(text_chunks, output_size):
+  summarize_chunk = lambda chunk: get_summary(_MAP_PROMPT, chunk.text, output_size)
+  with metrics.stage('Map'):
+    summaries = run_stage('Map', summarize_chunk, text_chunks, _MAX_CONCURRENCY, _MAX_CALL_ATTEMPTS)
+  return reduce_chunk_summaries(summaries, output_size)
+
+# combine chunk summaries in a tree until they fit into a single combine prompt, returns the text for that prompt
+def reduce_chunk_summaries(summaries, output_size):
+  combine_summaries = lambda text: get_summary(_COMBINE_PROMPT, text, output_size)
+  with metrics.stage('Reduce'):
+    return reduce_summaries(summaries, combine_summaries, count_tokens, max_input_size(_COMBINE_PROMPT), _MAX_CONCURRENCY, _MAX_CALL_ATTEMPTS)
 
 def get_summary_large_doc(text_chunks, output_size):
-  llm = Bedrock(
-    model_id = _MODEL_ID,
-    model_kwargs = {
-      "max_tokens_to_sample": output_size  
+  return get_summary(_COMBINE_PROMPT, reduce_chunks(text_chunks, output_size), output_size)
+
+# generator that yields the summary of text as it is generated
+# for large inputs the map and intermediate combine prompts run first, and only the final combine prompt is streamed
+# use this to drive a chunked HTTP response (e.g. Lambda response streaming) so the first bytes are returned before the whole summary is generated
+def stream_summary_text(text):
+  text = reduce_document(text)
+  output_size = _MAX_SUMMARY_LENGTH + _OUTPUT_TOKEN_BUFFER
+  chunks = chunk_text(text, max_input_size(_MAP_PROMPT))
+  logger.info('Estimated chunks: %s', str(len(chunks)))
+  if not fits_stuff_prompt(chunks):
+    yield from stream_summary(_COMBINE_PROMPT, reduce_chunks(chunks, output_size), output_size)
+  else:
+    yield from stream_summary(_STUFF_PROMPT, '\n\n'.join(chunk.text for chunk in chunks), output_size)
+
+# parts of a summarization job: the whole text for the stuff prompt if it fits, otherwise each chunk for the map prompt
+def job_parts(text):
+  text = reduce_document(text)
+  chunks = chunk_text(text, max_input_size(_MAP_PROMPT))
+  if fits_stuff_prompt(chunks):
+    return [((_STUFF_PROMPT, '\n\n'.join(chunk.text for chunk in chunks)), len(chunks))]
+  return [((_MAP_PROMPT, chunk.text), 1) for chunk in chunks]
+
+def summarize_job_part(part):
+  prompt, text = part
+  return get_summary(prompt, text, _MAX_SUMMARY_LENGTH + _OUTPUT_TOKEN_BUFFER)
+
+# a single part is already the summary, the summaries of several chunks are combined
+def combine_job_summaries(summaries):
+  if len(summaries) == 1:
+    return summaries[0]
+  output_size = _MAX_SUMMARY_LENGTH + _OUTPUT_TOKEN_BUFFER
+  return get_summary(_COMBINE_PROMPT, reduce_chunk_summaries(summaries, output_size), output_size)
+
+# process a job submitted through POST /jobs, in the background
+def process_job(job_id):
+  metrics.reset()
+  succeeded = run_job(job_store, job_id, job_parts, summarize_job_part, combine_job_summaries, _MAX_CONCURRENCY, _MAX_CALL_ATTEMPTS)
+  logger.info('Job %s %s', job_id, 'succeeded' if succeeded else 'failed')
+  metrics.flush(JobId=job_id)
+  return {'job_id': job_id, 'succeeded': succeeded}
+
+# POST /jobs takes the same body as the synchronous API and returns the id of the job right away
+def submit_job(event):
+  if not event.get('body'):
+    return {
+      'statusCode': 400,
+      'body': json.dumps('Missing body')
+    }
+  job_id = new_job(job_store, json.loads(event['body'])['text'])
+  start_job(job_id, process_job, _JOB_FUNCTION_NAME)
+  return {
+    'statusCode': 202,
+    'body': json.dumps({'job_id': job_id, 'status': PENDING})
+  }
+
+# GET /jobs/{job_id} returns the progress of the job and the summaries of the finished chunks, and the summary once the job succeeded
+# ?first_part=<n> returns the finished parts from part n, for jobs whose finished parts don't fit into one response (see next_part)
+# a job that stopped, e.g. because its invocation timed out, is started again
+def get_job(job_id, first_part):
+  status = job_status(job_store, job_id, 'summary', first_part, restart=lambda job_id: start_job(job_id, process_job, _JOB_FUNCTION_NAME))
+  if status is None:
+    return {
+      'statusCode': 404,
+      'body': json.dumps('Job not found')
     }
-  )
-  summary_chain = load_summarize_chain(
-    llm=llm, 
-    chain_type="map_reduce", 
-    map_prompt=_MAP_PROMPT_TEMPLATE,
-    combine_prompt=_COMBINE_PROMPT_TEMPLATE,
-    verbose = True
-  )
-  result = summary_chain.run(input_documents = text_chunks, example = _EXAMPLE_TEXT)
-  return process_llm_output(result)
-
-# this Lambda function is invoked through API Gateway
+  return {
+    'statusCode': 200,
+    'body': json.dumps(status)
+  }
+
+# this Lambda function is invoked through API Gateway, or asynchronously with {'job_id': ...} to process a job in the background
 def lambda_handler(event, context):
+  if 'job_id' in event:
+    return process_job(event['job_id'])
+  if event.get('resource') == '/jobs':
+    return submit_job(event)
+  if event.get('resource') == '/jobs/{job_id}':
+    first_part = (event.get('queryStringParameters') or {}).get('first_part', '0')
+    if not first_part.isdigit():
+      return {
+        'statusCode': 400,
+        'body': json.dumps('first_part must be a part number')
+      }
+    return get_job(event['pathParameters']['job_id'], int(first_part))
+  metrics.reset()
   # read API body, if it exists
   if event.get('body'):
     body = json.loads(event['body'])['text']
@@ -181,13 +341,19 @@ def lambda_handler(event, context):
       'body': json.dumps('Missing body')
     }
 
-  chunks = chunk_text(body, _MAX_INPUT_SIZE)
+  body = reduce_document(body)
+  with metrics.stage('Chunk'):
+    chunks = chunk_text(body, max_input_size(_MAP_PROMPT))
   logger.info('Estimated chunks: %s', str(len(chunks)))
 
-  if len(chunks) > 1:
+  if not fits_stuff_prompt(chunks):
     result = get_summary_large_doc(chunks, _MAX_SUMMARY_LENGTH + _OUTPUT_TOKEN_BUFFER)
   else: 
     result = get_summary_short_doc(chunks, _MAX_SUMMARY_LENGTH + _OUTPUT_TOKEN_BUFFER)
+  logger.info('Cache stats: %s', result_cache.stats())
+  logger.info('Scheduler stats: %s', scheduler.stats())
+  metrics.increment('Chunks', len(chunks))
+  metrics.flush()
 
   # return success 
   return {
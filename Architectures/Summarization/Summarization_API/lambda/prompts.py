@@ -0,0 +1,28 @@
+# Prompt templates compiled once per container: the static text before and after the input is built when the function is loaded,
+# so a prompt is two string concatenations, and its token count is measured with the tokenizer so chunk budgets are exact
+class CompiledPrompt:
+  # field is the placeholder for the input text, values fill every other placeholder of the template
+  # model is the Model (see models.py) the prompt is sent to, its context window bounds the input text
+  def __init__(self, template, field, count_tokens, model=None, **values):
+    placeholder = '{' + field + '}'
+    if template.count(placeholder) != 1:
+      raise ValueError('Template must contain %s exactly once' % placeholder)
+    prefix, suffix = template.split(placeholder)
+    self.prefix = prefix.format(**values)
+    self.suffix = suffix.format(**values)
+    # identifies the prompt in cache keys, for a template without other placeholders this is the template itself
+    self.key = self.prefix + placeholder + self.suffix
+    self.count_tokens = count_tokens
+    self.model = model
+    self._tokens = None
+
+  def format(self, text):
+    return self.prefix + text + self.suffix
+
+  # number of tokens of the prompt without the input text, measured on first use since the tokenizer is loaded on first use
+  # tokens can merge differently where the text joins the prefix and the suffix, so 2 tokens are added for the joins
+  @property
+  def tokens(self):
+    if self._tokens is None:
+      self._tokens = self.count_tokens(self.prefix) + self.count_tokens(self.suffix) + 2
+    return self._tokens
@@ -0,0 +1,79 @@
+# Helpers for processing every object in an event, for S3 notifications delivered directly or in SQS batches
+import json
+import logging
+from urllib.parse import unquote_plus
+from parallel import map_ordered
+from scheduler import error_code
+
+logger = logging.getLogger()
+# errors that happen again on every delivery of a message, e.g. the object was deleted or is not a document Textract can read
+_PERMANENT_ERROR_CODES = ['NoSuchKey', 'NoSuchBucket', 'UnsupportedDocumentException', 'BadDocumentException', 'DocumentTooLargeException', 'InvalidParameterException', 'InvalidS3ObjectException']
+
+# raised for direct S3 notifications when documents failed with errors a retry can fix, so the asynchronous invocation is retried
+class BatchError(Exception):
+  pass
+
+# yield (message_id, bucket, key) for each object in the event
+# message_id is the SQS message id for SQS deliveries (used for partial batch responses), and None for direct S3 notifications
+# SQS messages that don't hold an S3 event notification are logged and dropped, delivering them again would not change them
+def iter_s3_objects(event):
+  for record in event.get('Records', []):
+    if record.get('eventSource') == 'aws:sqs':
+      try:
+        # test events sent by S3 when the notification is configured have no records
+        objects = [(s3_record['s3']['bucket']['name'], unquote_plus(s3_record['s3']['object']['key'])) for s3_record in json.loads(record['body']).get('Records', [])]
+      except (ValueError, KeyError, TypeError, AttributeError):
+        logger.error('Dropping message %s, it is not an S3 event notification: %.200s', record.get('messageId'), record.get('body'))
+        continue
+      for bucket, key in objects:
+        yield record['messageId'], bucket, key
+    else:
+      yield None, record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key'])
+
+# whether error, or an error it was raised from, would happen again if the document were processed again
+def permanent_error(error):
+  while error is not None:
+    if error_code(error) in _PERMANENT_ERROR_CODES:
+      return True
+    error = error.__cause__
+  return False
+
+# call process_document(bucket, key) for every object in the event, with at most max_workers documents in flight
+# a document fails if process_document raises or returns a status code other than 200, and failures don't stop the other documents
+# SQS deliveries get a partial batch response so only the messages of failed documents are retried,
+# documents that failed with a 4xx status code or a permanent error are not retried, they would fail again on every delivery
+# for direct S3 notifications, other failures raise, so Lambda retries the event and then sends it to the on-failure destination
+def process_event(event, process_document, max_workers):
+  objects = list(iter_s3_objects(event))
+  logger.info('Documents in event: %s', len(objects))
+  def process_object(s3_object):
+    _, bucket, key = s3_object
+    return process_document(bucket, key)
+
+  results, errors = map_ordered(process_object, objects, max_workers)
+  failed = [index for index, result in enumerate(results) if index in errors or result['statusCode'] != 200]
+  retried = []
+  for index in failed:
+    permanent = permanent_error(errors[index]) if index in errors else 400 <= results[index]['statusCode'] < 500
+    logger.error('Failed to process s3://%s/%s%s: %s', objects[index][1], objects[index][2], ', not retrying' if permanent else '', errors.get(index) or results[index]['body'])
+    if not permanent:
+      retried.append(index)
+
+  message_ids = [message_id for message_id, _, _ in objects if message_id]
+  if message_ids:
+    failed_message_ids = list(dict.fromkeys(objects[index][0] for index in retried))
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]}
+  if retried:
+    if len(retried) == 1 and retried[0] in errors:
+      raise errors[retried[0]]
+    raise BatchError('Failed to process %s documents: %s' % (len(retried), ', '.join('s3://%s/%s' % objects[index][1:] for index in retried))) from next((errors[index] for index in retried if index in errors), None)
+  # a single direct S3 notification keeps the response of the document
+  if len(objects) == 1 and not errors:
+    return results[0]
+  return {
+    'statusCode': 500 if failed else 200,
+    'body': json.dumps({
+      'processed': len(objects) - len(failed),
+      'failed': ['s3://%s/%s' % (objects[index][1], objects[index][2]) for index in failed]
+    })
+  }
@@ -0,0 +1,94 @@
+# Token-based text splitter used to break documents into chunks that fit into the model's context window
+import hashlib
+from bisect import bisect_left
+from collections import namedtuple
+from tokenization import TokenizedText, encode_offsets
+
+Chunk = namedtuple('Chunk', ['text', 'token_count'])
+_SEPARATORS = ['\n\n', '\n'] # preferred chunk boundaries, paragraphs first and then lines
+_ANCHOR_CHARS = 100 # length of the text before a chunk boundary that identifies the boundary in another version of the document
+
+# tokenize text once and return the character offset at which each token starts
+def token_offsets(text, tokenizer):
+  return encode_offsets(text, tokenizer)
+
+# fingerprint of the text right before position
+def anchor_at(text, position):
+  return hashlib.sha1(text[max(0, position - _ANCHOR_CHARS):position].encode('utf-8')).hexdigest()
+
+# find the last separator in text[start:end] and return the position right after it, or None if there is none
+# if anchors (fingerprints from anchor_at) are given, the last line end whose anchor is one of them is preferred,
+# so a new version of a document is cut at the same places as the previous one wherever the text around a boundary is unchanged
+def find_boundary(text, start, end, anchors=None):
+  if anchors:
+    position = text.rfind('\n', start, end)
+    while position != -1:
+      if anchor_at(text, position + 1) in anchors:
+        return position + 1
+      position = text.rfind('\n', start, position)
+  for separator in _SEPARATORS:
+    position = text.rfind(separator, start, end)
+    if position != -1:
+      return position + len(separator)
+  return None
+
+# split text into chunks of at most chunk_size tokens, cutting at a paragraph or line boundary close to the token budget
+# separators stay at the end of the chunk before them, so joining the chunks gives back the original text when chunk_overlap is 0
+def split_text(text, tokenizer, chunk_size, chunk_overlap=0, anchors=None):
+  if not text:
+    return []
+  return [chunk for _, chunk in split_offsets(text, token_offsets(text, tokenizer), chunk_size, chunk_overlap, anchors)]
+
+# split text whose tokens start at offsets into chunks, returns (start position, chunk) pairs
+def split_offsets(text, offsets, chunk_size, chunk_overlap=0, anchors=None):
+  num_tokens = len(offsets)
+  chunks = []
+  start_token = 0
+  start_char = 0
+  while start_token + chunk_size < num_tokens:
+    end_token = start_token + chunk_size
+    # only look for a boundary in the second half of the budget so chunks don't end up much smaller than chunk_size
+    end_char = find_boundary(text, offsets[start_token + chunk_size // 2], offsets[end_token], anchors)
+    if end_char is None:
+      end_char = offsets[end_token]
+    next_token = bisect_left(offsets, end_char, start_token + 1, end_token + 1)
+    chunks.append((start_char, Chunk(text[start_char:end_char], next_token - start_token)))
+    if chunk_overlap:
+      start_token = max(next_token - chunk_overlap, start_token + 1)
+      start_char = offsets[start_token]
+    else:
+      start_token = next_token
+      start_char = end_char
+  chunks.append((start_char, Chunk(text[start_char:], num_tokens - start_token)))
+  return chunks
+
+# split a stream of text pieces (e.g. pages) into chunks, yielding each chunk as soon as the text after it has been read
+# the text is encoded as it is read, each part of it once, and the buffered text is split from its token offsets once it holds more than chunk_size tokens
+def split_stream(pieces, tokenizer, chunk_size, chunk_overlap=0, anchors=None):
+  buffer = TokenizedText(tokenizer)
+  for piece in pieces:
+    buffer.append(piece)
+    if buffer.token_count > chunk_size:
+      chunks = split_offsets(buffer.text, buffer.offsets, chunk_size, chunk_overlap, anchors)
+      yield from (chunk for _, chunk in chunks[:-1])
+      # the last chunk may still grow with the next piece, so it is kept in the buffer
+      buffer.drop(chunks[-1][0])
+  if buffer.text:
+    yield from (chunk for _, chunk in split_offsets(buffer.text, buffer.offsets, chunk_size, chunk_overlap, anchors))
+
+# group consecutive items into packs whose sizes add up to at most budget, so small items can share a single model call
+# an item larger than budget gets a pack of its own, and max_items (if given) bounds the number of items held in a pack
+# items can be a generator, each pack is yielded as soon as the next item doesn't fit into it
+def pack_items(items, size, budget, max_items=None):
+  pack = []
+  pack_size = 0
+  for item in items:
+    item_size = size(item)
+    if pack and (pack_size + item_size > budget or (max_items and len(pack) >= max_items)):
+      yield pack
+      pack = []
+      pack_size = 0
+    pack.append(item)
+    pack_size += item_size
+  if pack:
+    yield pack
@@ -0,0 +1,140 @@
+# Extractive pre-reduction of large documents: sentences are scored locally and only the top-ranked ones, up to a token budget, are sent to the model
+# sentences are TF-IDF vectors and are ranked with TextRank over their cosine similarities, with NumPy
+# the similarity graph is never built, each power iteration multiplies by the sparse sentence-term matrix and its transpose,
+# so time and memory grow with the number of words instead of the square of the number of sentences
+import logging
+import re
+from tokenization import count_tokens_batch, encode_offsets, last_safe_cut
+
+logger = logging.getLogger()
+_SENTENCE_END = re.compile(r'(?<=[^A-Z.][.!?])\s+|\s*\n\s*')
+_WORD = re.compile(r'[^\W_]+')
+_MIN_WORDS = 4 # shorter sentences (headings, list items, fragments) are not ranked, they match many sentences without saying much
+_DAMPING = 0.85 # probability of following an edge of the similarity graph in TextRank
+_MAX_ITERATIONS = 50
+_TOLERANCE = 1e-6 # power iteration stops once the scores change by less than this in total
+_GAP = '\n\n' # put between kept sentences that were not next to each other in the document
+
+# (start, end) of each sentence of text, sentences end at ., ! or ? followed by whitespace, or at a line end
+# a period after a capital letter or another period (e.g. U.S. or J. Smith) is taken for an abbreviation
+def sentence_spans(text):
+  spans = []
+  start = len(text) - len(text.lstrip())
+  for match in _SENTENCE_END.finditer(text, start):
+    if match.start() > start:
+      spans.append((start, match.start()))
+    start = max(start, match.end())
+  if start < len(text):
+    spans.append((start, len(text)))
+  return spans
+
+# sparse TF-IDF matrix of the sentences as (rows, columns, values) arrays, with sublinear term frequencies and L2-normalized rows
+# a sentence with fewer than _MIN_WORDS words, or with the same words as an earlier sentence (e.g. repeated log lines), gets an empty row, so it is never kept
+def tfidf_matrix(sentences):
+  import numpy as np
+  vocabulary = {}
+  seen = set()
+  rows = []
+  columns = []
+  for index, sentence in enumerate(sentences):
+    words = _WORD.findall(sentence.lower())
+    key = ' '.join(words)
+    if len(words) < _MIN_WORDS or key in seen:
+      continue
+    seen.add(key)
+    rows.extend([index] * len(words))
+    columns.extend(vocabulary.setdefault(word, len(vocabulary)) for word in words)
+  num_terms = max(1, len(vocabulary))
+  # count each (sentence, term) pair once
+  pairs, counts = np.unique(np.array(rows, dtype=np.int64) * num_terms + np.array(columns, dtype=np.int64), return_counts=True)
+  rows = pairs // num_terms
+  columns = pairs % num_terms
+  num_documents = max(1, len(seen))
+  document_frequency = np.bincount(columns, minlength=num_terms)
+  values = (1.0 + np.log(counts)) * np.log((1.0 + num_documents) / (1.0 + document_frequency[columns]))
+  norms = np.sqrt(np.bincount(rows, weights=values * values, minlength=len(sentences)))
+  values = values / np.where(norms > 0, norms, 1.0)[rows]
+  return rows, columns, values, num_terms
+
+# TextRank score of each sentence, the weight of the edge between two sentences is the cosine similarity of their TF-IDF vectors
+def textrank(rows, columns, values, num_sentences, num_terms):
+  import numpy as np
+  # similarity matrix times a vector, X (X^T v), without the similarity of each sentence with itself
+  self_similarity = np.bincount(rows, weights=values * values, minlength=num_sentences)
+  def similarity_times(vector):
+    term_weights = np.bincount(columns, weights=values * vector[rows], minlength=num_terms)
+    return np.bincount(rows, weights=values * term_weights[columns], minlength=num_sentences) - self_similarity * vector
+  degree = similarity_times(np.ones(num_sentences))
+  ranked = degree > 1e-12
+  num_ranked = max(1, int(ranked.sum()))
+  inverse_degree = np.where(ranked, 1.0 / np.where(ranked, degree, 1.0), 0.0)
+  scores = np.where(ranked, 1.0 / num_ranked, 0.0)
+  for _ in range(_MAX_ITERATIONS):
+    updated = np.where(ranked, (1 - _DAMPING) / num_ranked + _DAMPING * similarity_times(scores * inverse_degree), 0.0)
+    change = np.abs(updated - scores).sum()
+    scores = updated
+    if change < _TOLERANCE:
+      break
+  # sentences without similar sentences still count for their content, below every sentence that has some
+  unique = self_similarity > 0
+  return np.where(ranked, scores, np.where(unique, 0.0, -1.0))
+
+# reduce text to its top-ranked sentences, in document order, so that it has at most token_budget tokens
+# the sentences are encoded together on several threads, text whose sentences already fit is returned as it is
+def reduce_text(text, tokenizer, token_budget):
+  import numpy as np
+  spans = sentence_spans(text)
+  sentences = [text[start:end] for start, end in spans]
+  # 1 token is added to each sentence for the whitespace or gap put between kept sentences
+  token_counts = np.array(count_tokens_batch(sentences, tokenizer) if sentences else [], dtype=np.int64) + 1
+  total_tokens = int(token_counts.sum())
+  if total_tokens <= token_budget:
+    return text
+  rows, columns, values, num_terms = tfidf_matrix(sentences)
+  scores = textrank(rows, columns, values, len(spans), num_terms)
+  order = np.argsort(-scores, kind='stable')
+  order = order[scores[order] >= 0].tolist()
+  # tokens can merge differently where sentences are joined, so the reduced text is counted and the budget lowered by the excess until it fits
+  budget = token_budget
+  while True:
+    kept = select_sentences(order, token_counts.tolist(), budget)
+    reduced = join_sentences(text, spans, kept)
+    reduced_tokens = len(tokenizer.encode(reduced, disallowed_special=()))
+    if reduced_tokens <= token_budget or not len(kept):
+      break
+    budget -= reduced_tokens - token_budget
+  if not kept:
+    # no sentence could be ranked (e.g. logs or CSV, whose lines are short or repeated), the start of the text is kept instead of nothing
+    logger.info('Extractive reduction found no sentences to keep, truncating the text to %s of %s tokens', token_budget, total_tokens)
+    return truncate_text(text, tokenizer, token_budget)
+  logger.info('Extractive reduction kept %s of %s sentences, %s of %s tokens', len(kept), len(spans), reduced_tokens, total_tokens)
+  return reduced
+
+# the start of text with at most token_budget tokens, cut where its tokens are the same as in the whole text if there is such a place
+def truncate_text(text, tokenizer, token_budget):
+  offsets = encode_offsets(text, tokenizer)
+  if len(offsets) <= token_budget:
+    return text
+  end = offsets[token_budget]
+  return text[:last_safe_cut(text[:end]) or end]
+
+# indexes of the sentences kept, in document order: sentences are taken by rank, and one that doesn't fit into the rest of the budget is skipped
+def select_sentences(order, token_counts, token_budget):
+  kept = []
+  used = 0
+  for index in order:
+    if used + token_counts[index] <= token_budget:
+      kept.append(index)
+      used += token_counts[index]
+  return sorted(kept)
+
+# text of the sentences with the given indexes, sentences that were next to each other keep the whitespace between them
+def join_sentences(text, spans, indexes):
+  parts = []
+  previous = None
+  for index in indexes:
+    if previous is not None:
+      parts.append(text[spans[previous][1]:spans[index][0]] if index == previous + 1 else _GAP)
+    parts.append(text[spans[index][0]:spans[index][1]])
+    previous = index
+  return ''.join(parts)
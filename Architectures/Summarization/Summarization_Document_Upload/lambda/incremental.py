@@ -0,0 +1,65 @@
+# Incremental summarization of documents that are uploaded again with pages added or edited, e.g. meeting transcripts and logs
+# the map summary of every chunk is kept in a manifest next to the summary of the document, keyed by a fingerprint of the chunk text,
+# so for a new version of the document only the chunks that are new or changed are summarized, and the reduce runs over all chunk summaries
+import json
+import threading
+from cache import make_key
+from chunking import anchor_at
+
+_VERSION = 1
+
+class Manifest:
+  # settings is a key of everything the chunk summaries depend on besides the chunk text (model, prompt, chunk size, output size)
+  def __init__(self, settings, chunks=None):
+    self.settings = settings
+    self.chunks = chunks or [] # {'fingerprint', 'anchor', 'tokens', 'summary'} for each chunk, in document order
+    self.summaries = {chunk['fingerprint']: chunk['summary'] for chunk in self.chunks}
+    # fingerprints of the text before each chunk boundary, the new version is cut at the same places where that text is unchanged
+    self.anchors = set(chunk['anchor'] for chunk in self.chunks)
+
+  def to_json(self):
+    return json.dumps({'version': _VERSION, 'settings': self.settings, 'chunks': self.chunks})
+
+  # a manifest written with other settings or by another version of this code is ignored, every chunk is summarized again
+  @classmethod
+  def from_json(cls, data, settings):
+    try:
+      manifest = json.loads(data)
+    except ValueError:
+      return cls(settings)
+    if manifest.get('version') != _VERSION or manifest.get('settings') != settings:
+      return cls(settings)
+    return cls(settings, manifest['chunks'])
+
+# map step that reuses the chunk summaries of the previous version of a document, and records the chunks of the new version for its manifest
+class IncrementalMap:
+  def __init__(self, previous):
+    self.previous = previous
+    self.chunks = []
+    self.reused = 0
+    self._lock = threading.Lock()
+
+  # pair each chunk with its manifest entry as the chunks are read, so the entries are in document order
+  def track(self, chunks):
+    for chunk in chunks:
+      entry = {'fingerprint': make_key(chunk.text), 'anchor': anchor_at(chunk.text, len(chunk.text)), 'tokens': chunk.token_count, 'summary': None}
+      self.chunks.append(entry)
+      yield chunk, entry
+
+  # turn map_fn over chunks into a map function over the pairs from track, which only calls map_fn for new or changed chunks
+  def wrap(self, map_fn):
+    def summarize(item):
+      chunk, entry = item
+      summary = self.previous.summaries.get(entry['fingerprint'])
+      if summary is None:
+        summary = map_fn(chunk)
+      else:
+        with self._lock:
+          self.reused += 1
+      entry['summary'] = summary
+      return summary
+    return summarize
+
+  # manifest of the new version, only complete once every chunk has been summarized
+  def manifest(self):
+    return Manifest(self.previous.settings, self.chunks)
@@ -1,27 +1,49 @@
 import json
+from functools import lru_cache
+from itertools import chain, islice
+import os
 import logging
-import boto3
-from langchain.prompts import PromptTemplate
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.llms.bedrock import Bedrock
-from langchain.chains.summarize import load_summarize_chain
-from langchain.chains.llm import LLMChain
-from langchain.chains.combine_documents.stuff import StuffDocumentsChain
-import tiktoken
-
-s3 = boto3.client('s3')
-bedrock = boto3.client('bedrock-runtime')
-textract = boto3.client('textract')
+from batch import permanent_error, process_event
+from cache import cache_from_environment, make_key
+from chunking import split_stream
+from clients import configure_client, get_client
+from extractive import reduce_text
+from extraction import ExtractionError, iter_pdf_pages, iter_textract_pages
+from incremental import IncrementalMap, Manifest
+from map_reduce import map_reduce
+from metrics import metrics_from_environment, token_counts
+from models import model_from_environment
+from prompts import CompiledPrompt
+from s3_stream import iter_text
+from scheduler import scheduler_from_environment
+from tokenization import estimate_tokens, tokenizer_from_environment
+
+_MAX_DOCUMENT_CONCURRENCY = int(os.environ.get('MAX_DOCUMENT_CONCURRENCY', '2')) # maximum number of documents from the same event processed at the same time
+_MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '4')) # maximum number of map or combine prompts sent to Amazon Bedrock at the same time
+_MAX_CALL_ATTEMPTS = 2 # number of times a map or combine prompt is attempted before the summary fails
+_INCREMENTAL_SUMMARIES = os.environ.get('INCREMENTAL_SUMMARIES', 'false').lower() == 'true' # keep the chunk summaries of each document in a manifest, so a new version only maps the chunks that changed
+_LOCAL_PDF_EXTRACTION = os.environ.get('LOCAL_PDF_EXTRACTION', 'true').lower() == 'true' # read the text layer of PDFs locally, Textract only reads their pages without one
+# retries are left to the scheduler, which also backs off the concurrency and applies the rate limits
+configure_client('bedrock-runtime', max_pool_connections=max(10, _MAX_CONCURRENCY * _MAX_DOCUMENT_CONCURRENCY), retries={'mode': 'standard', 'max_attempts': 1})
+scheduler = scheduler_from_environment(_MAX_CONCURRENCY * _MAX_DOCUMENT_CONCURRENCY) # module level so the limits are shared by all documents and chunks processed by this instance
+result_cache = cache_from_environment() # module level so cached results survive warm invocations
+metrics = metrics_from_environment() # stage timings and token counts, written as one record per request
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-_MODEL_ID = 'anthropic.claude-v2'
-_TIKTOKEN_ENCODING = 'p50k_base' # we use a BPE tokenizer to estimate number of tokens in input (required since we do not have direct access to model's tokenizer)
-tokenizer = tiktoken.get_encoding(_TIKTOKEN_ENCODING)
-_PROMPT_TOKENS = 500 # overestimation of number of tokens in prompt (not including input document)
-_CONTEXT_WINDOW = 100000 # for Claude v2 100k
+_MAP_MODEL = model_from_environment('MAP_MODEL_ID') # model of the map prompts, a low-latency model shortens the map stage of large documents
+_REDUCE_MODEL = model_from_environment('REDUCE_MODEL_ID') # model of the combine prompts and the stuff prompt, which write the summary that is returned
+
+# the tokenizer is loaded on first use instead of at import time, so cold starts don't pay for it before the handler runs
+# by default it is the Claude vocabulary that comes with the function, so loading it needs no network access (see tokenization.py)
+@lru_cache(maxsize=None)
+def get_tokenizer():
+  return tokenizer_from_environment()
+
 _OUTPUT_TOKEN_BUFFER = 100 # buffer for the max_tokens_to_sample to prevent output from being cut off
 _MAX_SUMMARY_LENGTH = 300
-_MAX_INPUT_SIZE = _CONTEXT_WINDOW - _PROMPT_TOKENS - _MAX_SUMMARY_LENGTH - _OUTPUT_TOKEN_BUFFER
+_MAP_PROMPT_EXAMPLE = os.environ.get('MAP_PROMPT_EXAMPLE', 'true').lower() == 'true' # include the few-shot example in map prompts, leaving it out saves about 1,500 input tokens per chunk
+_EXTRACTIVE_REDUCTION = os.environ.get('EXTRACTIVE_REDUCTION', 'false').lower() == 'true' # reduce large documents to their top-ranked sentences before they are summarized
+_EXTRACTIVE_TOKEN_BUDGET = int(os.environ.get('EXTRACTIVE_TOKEN_BUDGET', '0')) # tokens kept by the extractive reduction, 0 for what fits into a single prompt
 _EXAMPLE_TEXT = """
 H: <text>
 Q. Sam, you have been through games like Louisville last week, but was it any different here to come back from the adversity with USC coming in, and just how did you sort of manage that over the last seven days?
@@ -59,20 +81,19 @@ A: <summary>
 Quarterback Sam Hartman discussed Notre Dame's comeback win against USC. He said the adversity after losing to Louisville challenged the team, but coach Marcus Freeman's leadership guided them through. Hartman said the team had a \"special week\" preparing for USC, one of the best offenses in the country. He credited the historic defensive performance that shut down USC. Offensively, Hartman discussed the importance of scoring a touchdown on the first drive to build confidence. He praised receiver Chris Tyree for his persistence and growth this season despite struggles. Their connection on a touchdown pass exemplified Tyree's hard work. Hartman also credited the offensive line for bouncing back after a rough game against Louisville. He said the culture and leadership of players like center Zeke Correll set the tone in practice to be ready for USC. Personally, Hartman called the USC win a special moment in his career that he'll cherish. He said the fan support and football culture at Notre Dame are incredible. Beating a storied rival like USC will stay with him forever.
 </summary>
 """
-_MAP_PROMPT_TEMPLATE = PromptTemplate(
-  input_variables=["text", "example"],
-  template="""
+_EXAMPLE = """Here is an example:
+<example>
+{example}
+</example>
+
+""".format(example=_EXAMPLE_TEXT)
+_MAP_PROMPT_TEMPLATE = """
 
 Human: Given some text, we want to distill the text into a summary of the main themes.
 
 Write your summary within <summary></summary> tags.
 
-Here is an example:
-<example>
-{example}
-</example>
-
-Here is the text, inside  <text></text> XML tags.
+{example}Here is the text, inside  <text></text> XML tags.
 <text>
 {text}
 </text>
@@ -80,21 +101,13 @@ Here is the text, inside  <text></text> XML tags.
 Write a concise summary of the above text.
 
 Assistant:"""
-)
-_COMBINE_PROMPT_TEMPLATE = PromptTemplate(
-  input_variables=["text", "example"],
-  template="""
+_COMBINE_PROMPT_TEMPLATE = """
 
 Human: Given a set of summaries, we want to distill them into a final, consolidated summary of the main themes.
 
 Write your summary within <summary></summary> tags.
 
-Here is an example:
-<example>
-{example}
-</example>
-
-Here is the text, inside <text></text> XML tags.
+{example}Here is the text, inside <text></text> XML tags.
 
 <text>
 {text}
@@ -103,21 +116,13 @@ Here is the text, inside <text></text> XML tags.
 Write a <300 word concise summary of the above text within <summary></summary> tags.
 
 Assistant:"""
-)
-_STUFF_PROMPT_TEMPLATE = PromptTemplate(
-  input_variables=["text", "example"],
-  template="""
+_STUFF_PROMPT_TEMPLATE = """
 
 Human: Given some text, we want to create a concise summary of the main themes.
 
 Write your summary within <summary></summary> tags.
 
-Here is an example:
-<example>
-{example}
-</example>
-
-Here is the text, inside <text></text> XML tags.
+{example}Here is the text, inside <text></text> XML tags.
 <text>
 {text}
 </text>
@@ -125,14 +130,41 @@ Here is the text, inside <text></text> XML tags.
 Write a <300 word concise summary of the above text within <summary></summary> tags.
 
 Assistant:"""
-)
-
-def chunk_text(text, chunk_size):
-  return RecursiveCharacterTextSplitter(separators=["\n\n", "\n"], chunk_size=chunk_size, chunk_overlap=int(chunk_size / 100)).create_documents([text])
 
-def estimate_num_chunks(text):
-  estimated_tokens = len(tokenizer.encode(text))
-  return (estimated_tokens // _MAX_INPUT_SIZE) + 1
+# split a stream of pages into chunks of at most chunk_size tokens, each chunk comes with its token count
+# chunks are yielded as soon as the pages they are made of have been read
+# anchors, if given, are the chunk boundaries of a previous version of the document
+def chunk_text(pages, chunk_size, anchors=None):
+  return split_stream(pages, get_tokenizer(), chunk_size, chunk_overlap=int(chunk_size / 100), anchors=anchors)
+
+def count_tokens(text):
+  with metrics.stage('Tokenize'):
+    return len(get_tokenizer().encode(text, disallowed_special=()))
+
+# the static parts of the prompts are built once per container, each prompt is sent to the model of its stage
+_MAP_PROMPT = CompiledPrompt(_MAP_PROMPT_TEMPLATE, 'text', count_tokens, model=_MAP_MODEL, example=_EXAMPLE if _MAP_PROMPT_EXAMPLE else '')
+_COMBINE_PROMPT = CompiledPrompt(_COMBINE_PROMPT_TEMPLATE, 'text', count_tokens, model=_REDUCE_MODEL, example=_EXAMPLE)
+_STUFF_PROMPT = CompiledPrompt(_STUFF_PROMPT_TEMPLATE, 'text', count_tokens, model=_REDUCE_MODEL, example=_EXAMPLE)
+
+# number of tokens allowed in the {text} part of a prompt, the rest of the context window of its model holds the prompt itself and the summary
+def max_input_size(prompt):
+  return prompt.model.context_window - prompt.tokens - _MAX_SUMMARY_LENGTH - _OUTPUT_TOKEN_BUFFER
+
+# the whole document fits into a single stuff prompt, chunks are split for the map prompt, which can be shorter
+def fits_stuff_prompt(chunks):
+  return len(chunks) <= 1 and sum(chunk.token_count for chunk in chunks) <= max_input_size(_STUFF_PROMPT)
+
+# a document reduced to the default budget fits into a single chunk and a single stuff prompt
+def extractive_token_budget():
+  return _EXTRACTIVE_TOKEN_BUDGET or min(max_input_size(_MAP_PROMPT), max_input_size(_STUFF_PROMPT))
+
+# with EXTRACTIVE_REDUCTION, a document with more tokens than the budget is reduced to its top-ranked sentences (see extractive.py),
+# so a document that would need map-reduce is usually summarized with a single prompt
+def reduce_document(text):
+  if not _EXTRACTIVE_REDUCTION:
+    return text
+  with metrics.stage('Extractive'):
+    return reduce_text(text, get_tokenizer(), extractive_token_budget())
 
 def process_llm_output(text_output):
   # strip off XML response tags
@@ -140,85 +172,68 @@ def process_llm_output(text_output):
   text_output = text_output.replace('</summary>', '')
   return text_output
 
+def get_llm_result(model, prompt, output_size):
+  body = model.request_body(prompt, output_size)
+  def invoke():
+    with metrics.stage('Bedrock'):
+      return get_client('bedrock-runtime').invoke_model(
+        accept = 'application/json',
+        contentType = 'application/json',
+        body = body,
+        modelId = model.model_id,
+      )
+  # the rate limits only need a coarse count, so the prompt is not encoded again
+  result = scheduler.call(invoke, tokens=estimate_tokens(prompt) + output_size)
+  metrics.record_call(*token_counts(result))
+  result_text = model.completion(json.loads(result['body'].read()))
+  return result_text
+
+# summarize text with the given prompt and its model, results are cached by model, prompt, input text and output size
+# so resubmitting a document only calls Amazon Bedrock for the chunks that changed
+def get_summary(prompt, text, output_size):
+  key = make_key(prompt.model.model_id, prompt.key, text, output_size)
+  def summarize():
+    prompt_text = prompt.format(text)
+    return process_llm_output(get_llm_result(prompt.model, prompt_text, output_size)).strip()
+  return result_cache.get_or_compute(key, summarize)
+
+# the whole document fits into the context window, so it is summarized with a single prompt
 def get_summary_short_doc(text_chunks, output_size):
-  llm = Bedrock(
-    model_id = _MODEL_ID,
-    model_kwargs = {
-      "max_tokens_to_sample": output_size  
-    }
-  )
-  llm_chain = LLMChain(llm=llm, prompt=_STUFF_PROMPT_TEMPLATE)
-  # Define StuffDocumentsChain
-  stuff_chain = StuffDocumentsChain(
-      llm_chain=llm_chain, document_variable_name="text", verbose = True
-  )
-  result = stuff_chain.run(input_documents = text_chunks, example = _EXAMPLE_TEXT)
-  return process_llm_output(result)
-
-def get_summary_large_doc(text_chunks, output_size):
-  llm = Bedrock(
-    model_id = _MODEL_ID,
-    model_kwargs = {
-      "max_tokens_to_sample": output_size  
-    }
-  )
-  summary_chain = load_summarize_chain(
-    llm=llm, 
-    chain_type="map_reduce", 
-    map_prompt=_MAP_PROMPT_TEMPLATE,
-    combine_prompt=_COMBINE_PROMPT_TEMPLATE,
-    verbose = True
-  )
-  result = summary_chain.run(input_documents = text_chunks, example = _EXAMPLE_TEXT)
-  return process_llm_output(result)
-
-# this Lambda function is invoked through API Gateway
-def lambda_handler(event, context):
-  # Get the object and content type from the event
-  bucket = event['Records'][0]['s3']['bucket']['name']
-  key = event['Records'][0]['s3']['object']['key']
+  text = '\n\n'.join(chunk.text for chunk in text_chunks)
+  return get_summary(_STUFF_PROMPT, text, output_size)
+
+# summarize each chunk concurrently, then combine the chunk summaries in a tree of combine prompts that each fit into the context window
+# with incremental (an IncrementalMap), chunks whose summary is in the manifest of the previous version are not summarized again
+def get_summary_large_doc(text_chunks, output_size, incremental=None):
+  summarize_chunk = lambda chunk: get_summary(_MAP_PROMPT, chunk.text, output_size)
+  combine_summaries = lambda text: get_summary(_COMBINE_PROMPT, text, output_size)
+  if incremental:
+    text_chunks, summarize_chunk = incremental.track(text_chunks), incremental.wrap(summarize_chunk)
+  return map_reduce(text_chunks, summarize_chunk, combine_summaries, count_tokens, max_input_size(_COMBINE_PROMPT), _MAX_CONCURRENCY, attempts=_MAX_CALL_ATTEMPTS, stage=metrics.stage)
+
+# settings the chunk summaries in a manifest depend on, a manifest written with other settings is not used
+def manifest_settings(output_size):
+  return make_key(_MAP_MODEL.model_id, _MAP_PROMPT.key, max_input_size(_MAP_PROMPT), output_size)
+
+# manifest of the previous version of a document, or an empty manifest for a new document
+def load_manifest(bucket, key, settings):
+  s3 = get_client('s3')
+  try:
+    with metrics.stage('S3Get'):
+      response = s3.get_object(Bucket=bucket, Key=key)
+      data = response['Body'].read().decode('utf-8')
+  except s3.exceptions.NoSuchKey:
+    return Manifest(settings)
+  return Manifest.from_json(data, settings)
+
+def save_manifest(bucket, key, manifest):
+  with metrics.stage('S3Put'):
+    get_client('s3').put_object(Bucket=bucket, Key=key, Body=manifest.to_json(), ContentType='application/json')
+
+# process a single document in S3, returns the response for that document
+def process_document(bucket, key):
   logger.info('S3 Key: %s', key)
 
-  response = s3.get_object(Bucket=bucket, Key=key)
-  content_type = response['ContentType']
-  logger.info('Content Type: %s', content_type)
-
-  # check document format, if pdf send to Textract to get text
-  if content_type in ['application/pdf', 'image/jpeg', 'image/png']:
-    logger.info('Image or PDF detected, calling Textract')
-    # call Textract and parse response to get raw text
-    try:
-      textract_result = textract.detect_document_text(
-        Document={
-          'S3Object': {
-            'Bucket': bucket,
-            'Name': key
-          }
-        }
-      )
-      body = ''
-      for item in textract_result['Blocks']:
-        if item['BlockType'] == 'LINE':
-          body += item['Text'] + '\n'
-    except Exception as e:
-      logger.error(e)
-      logger.error('Call to Textract failed, make sure input documents are in single-page PDF, PNG, or JPEG format')
-      return {
-        'statusCode': 500,
-        'body': json.dumps('Error calling Textract')
-      }
-
-  else:
-    body = response['Body'].read().decode('utf-8')
-
-  chunks = chunk_text(body, _MAX_INPUT_SIZE)
-  logger.info('Estimated chunks: %s', str(len(chunks)))
-
-  if len(chunks) > 1:
-    result = get_summary_large_doc(chunks, _MAX_SUMMARY_LENGTH + _OUTPUT_TOKEN_BUFFER)
-  else: 
-    result = get_summary_short_doc(chunks, _MAX_SUMMARY_LENGTH + _OUTPUT_TOKEN_BUFFER)
-
   # take original S3 object and change the prefix to /masked
   output_key = key.replace('documents/', 'summaries/')
 
@@ -226,11 +241,68 @@ def lambda_handler(event, context):
   if not output_key.endswith('.txt'):
     output_key = output_key[:output_key.rfind('.')] + '.txt'
 
+  # the chunk summaries of the document are kept next to its summary
+  manifest_key = output_key[:-len('.txt')] + '.manifest.json'
+  output_size = _MAX_SUMMARY_LENGTH + _OUTPUT_TOKEN_BUFFER
+  incremental = IncrementalMap(load_manifest(bucket, manifest_key, manifest_settings(output_size))) if _INCREMENTAL_SUMMARIES else None
+
+  with metrics.stage('S3Get'):
+    response = get_client('s3').get_object(Bucket=bucket, Key=key)
+  content_type = response['ContentType']
+  logger.info('Content Type: %s', content_type)
+
+  # check document format, if pdf or image send to Textract to get text, one page at a time
+  if content_type == 'application/pdf' and _LOCAL_PDF_EXTRACTION:
+    logger.info('PDF detected, reading its text layer')
+    pages = metrics.timed_iter('PdfText', iter_pdf_pages(response, bucket, key))
+  elif content_type in ['application/pdf', 'image/jpeg', 'image/png']:
+    logger.info('Image or PDF detected, calling Textract')
+    pages = metrics.timed_iter('Textract', iter_textract_pages(get_client('textract'), bucket, key, content_type))
+  else:
+    # text documents are decoded as they are read from S3 instead of being loaded into memory at once
+    pages = metrics.timed_iter('S3Get', iter_text(response['Body']))
+
+  # split pages into chunks as they are read, so the map phase can start while the remaining pages are still being read
+  try:
+    if _EXTRACTIVE_REDUCTION:
+      # sentences are ranked over the whole document, so all of its pages are read first
+      pages = [reduce_document(''.join(pages))]
+    anchors = incremental.previous.anchors if incremental else None
+    chunks = metrics.timed_iter('Chunk', chunk_text(pages, max_input_size(_MAP_PROMPT), anchors))
+    first_chunks = list(islice(chunks, 2))
+    if not fits_stuff_prompt(first_chunks):
+      result = get_summary_large_doc(chain(first_chunks, chunks), output_size, incremental)
+      if incremental:
+        logger.info('Reused %s of %s chunk summaries', incremental.reused, len(incremental.chunks))
+        save_manifest(bucket, manifest_key, incremental.manifest())
+    else:
+      result = get_summary_short_doc(first_chunks, output_size)
+  except ExtractionError as e:
+    logger.error(e)
+    logger.error('Failed to extract text, make sure input documents are in PDF, PNG, or JPEG format')
+    # a document Textract can't read is not retried
+    return {
+      'statusCode': 400 if permanent_error(e) else 500,
+      'body': json.dumps('Error calling Textract')
+    }
+  logger.info('Cache stats: %s', result_cache.stats())
+  logger.info('Scheduler stats: %s', scheduler.stats())
   logger.info('Output S3 Key: %s', output_key)
 
   # Write the response to S3
-  s3.put_object(Bucket=bucket, Key=output_key, Body=result, ContentType='text/plain')  
+  with metrics.stage('S3Put'):
+    get_client('s3').put_object(Bucket=bucket, Key=output_key, Body=result, ContentType='text/plain')
   return {
       'statusCode': 200,
       'body': json.dumps('Summary created successfully!')
   }
+
+# this Lambda function is invoked by S3 event notifications, either directly or through an SQS queue
+# every document in the event is processed, and SQS deliveries get a partial batch response so only failed documents are retried
+# metrics cover all documents of the event
+def lambda_handler(event, context):
+  metrics.reset()
+  try:
+    return process_event(event, process_document, _MAX_DOCUMENT_CONCURRENCY)
+  finally:
+    metrics.flush()
@@ -0,0 +1,71 @@
+# Map-reduce summarization: chunks are summarized concurrently (map), then the summaries are combined in a tree until one summary is left (reduce)
+import logging
+from contextlib import nullcontext
+from parallel import imap_ordered, map_ordered
+
+logger = logging.getLogger()
+_SUMMARY_SEPARATOR = '\n\n'
+
+# group consecutive summaries so that each group fits into max_tokens
+# every group except possibly the last one holds at least 2 summaries, so each level of the tree reduces the number of summaries
+def group_summaries(summaries, count_tokens, max_tokens):
+  groups = []
+  group = []
+  group_tokens = 0
+  for summary in summaries:
+    tokens = count_tokens(summary)
+    if len(group) > 1 and group_tokens + tokens > max_tokens:
+      groups.append(group)
+      group = []
+      group_tokens = 0
+    group.append(summary)
+    group_tokens += tokens
+  if group:
+    groups.append(group)
+  return groups
+
+# run fn over items concurrently and raise if any item still fails after retrying
+def run_stage(stage, fn, items, max_workers, attempts):
+  results, errors = map_ordered(fn, items, max_workers, attempts=attempts)
+  if errors:
+    raise RuntimeError('%s failed for items %s of %s' % (stage, sorted(errors), len(items)))
+  return results
+
+# combine summaries with combine_fn level by level until all of them fit into a single combine prompt, and return the text for that final prompt
+# each level only combines groups that fit into max_tokens, so wall-clock time grows with the depth of the tree instead of the number of chunks
+def reduce_summaries(summaries, combine_fn, count_tokens, max_tokens, max_workers, attempts=1):
+  level = 0
+  while True:
+    groups = group_summaries(summaries, count_tokens, max_tokens)
+    if len(groups) <= 1:
+      return _SUMMARY_SEPARATOR.join(groups[0]) if groups else ''
+    level += 1
+    logger.info('Reduce level %s: combining %s summaries into %s', level, len(summaries), len(groups))
+    texts = [_SUMMARY_SEPARATOR.join(group) for group in groups if len(group) > 1]
+    combined = iter(run_stage('Combine', combine_fn, texts, max_workers, attempts))
+    # a group holding a single summary is carried over to the next level as is
+    summaries = [next(combined) if len(group) > 1 else group[0] for group in groups]
+
+# summarize chunks with map_fn and return the summaries in chunk order, raise if any chunk still fails after retrying
+# chunks can be a generator, only a window of chunks is read ahead of the summaries, so the chunk texts are not all held in memory
+def map_stage(map_fn, chunks, max_workers, attempts):
+  summaries = []
+  failed = []
+  for index, summary, error in imap_ordered(map_fn, chunks, max_workers, attempts=attempts):
+    if error:
+      failed.append(index)
+    summaries.append(summary)
+  if failed:
+    raise RuntimeError('Map failed for items %s of %s' % (failed, len(summaries)))
+  return summaries
+
+# summarize chunks with map_fn, then reduce the summaries in a tree and combine them into the final summary
+# stage(name), if given, is a context manager that times the Map and Reduce stages
+def map_reduce(chunks, map_fn, combine_fn, count_tokens, max_tokens, max_workers, attempts=1, stage=None):
+  stage = stage or (lambda name: nullcontext())
+  with stage('Map'):
+    summaries = map_stage(map_fn, chunks, max_workers, attempts)
+  if len(summaries) <= 1:
+    return summaries[0] if summaries else ''
+  with stage('Reduce'):
+    return combine_fn(reduce_summaries(summaries, combine_fn, count_tokens, max_tokens, max_workers, attempts))
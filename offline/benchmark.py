@@ -0,0 +1,237 @@
+# Benchmark the Lambda functions end to end against the local stand-ins for Amazon Bedrock, S3 and Textract in fakes.py
+# every (function, document size) case runs in a fresh Python process, so peak RSS is measured per case
+# usage: python offline/benchmark.py [--function pii-document-upload] [--sizes 1KB,1MB,50MB] [--repeat 5] [--output-token-latency 0.0001] [--stages] [--json]
+import argparse
+import glob
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import time
+from fakes import FakeBedrock, FakeS3, FakeTextract
+from local_lambda import LAMBDA_DIRS, load_module, set_client
+
+_DEFAULT_SIZES = '1KB,10KB,100KB,1MB,10MB,50MB'
+_API_MAX_BYTES = 10 * 1024 * 1024 # API Gateway payload limit, larger requests are skipped for the API functions
+_BUCKET = 'benchmark'
+_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 * 1024}
+
+def parse_size(size):
+  size = size.strip().upper()
+  for unit in sorted(_UNITS, key=len, reverse=True):
+    if size.endswith(unit):
+      return int(float(size[:-len(unit)]) * _UNITS[unit])
+  return int(size)
+
+def format_size(num_bytes):
+  for unit in ['MB', 'KB']:
+    if num_bytes >= _UNITS[unit]:
+      return '%g%s' % (num_bytes / _UNITS[unit], unit)
+  return '%sB' % num_bytes
+
+# text of the test fixtures that come with the function (test_requests or test_documents)
+def fixture_text(function):
+  project_dir = os.path.dirname(LAMBDA_DIRS[function])
+  texts = []
+  for path in sorted(glob.glob(os.path.join(project_dir, 'test_*', '*.txt'))):
+    with open(path, encoding='utf-8') as f:
+      content = f.read()
+    if content.lstrip().startswith('{'):
+      content = json.loads(content)['text']
+    texts.append(content.strip())
+  return '\n\n'.join(texts) + '\n\n'
+
+# a document of num_bytes UTF-8 bytes made of the fixtures repeated, so it has the structure (paragraphs, PII) of real inputs
+def make_document(function, num_bytes):
+  corpus = fixture_text(function).encode('utf-8')
+  data = corpus * (num_bytes // len(corpus) + 1)
+  return data[:num_bytes].decode('utf-8', 'ignore')
+
+def percentile(values, fraction):
+  ordered = sorted(values)
+  return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def peak_rss_mb():
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+# runs in the child process: run the handler repeat times on a document of the given size and print the measurements as JSON
+def run_case(args):
+  # results must not be served from the cache on repeated runs
+  os.environ['CACHE_MAX_BYTES'] = '0'
+  for name in ['CACHE_BUCKET', 'CACHE_DIR']:
+    os.environ.pop(name, None)
+  for setting in args.env:
+    name, value = setting.split('=', 1)
+    os.environ[name] = value
+
+  module = load_module(args.child)
+  # calls to faster models in the registry of the function take less time, so routing stages to other models (--env MAP_MODEL_ID=...) can be compared
+  models = load_module(args.child, 'models')
+  bedrock = FakeBedrock(
+    base_latency=args.base_latency,
+    input_token_latency=args.input_token_latency,
+    output_token_latency=args.output_token_latency,
+    max_concurrency=args.throttle_concurrency,
+    requests_per_minute=args.throttle_rpm,
+    tokens_per_minute=args.throttle_tpm,
+    model_latency={model_id: models.get_model(model_id).relative_latency for model_id in models.model_ids()}
+  )
+  s3 = FakeS3()
+  textract = FakeTextract(polls_until_done=1)
+  set_client(module, 'bedrock-runtime', bedrock)
+  set_client(module, 's3', s3)
+  set_client(module, 'textract', textract)
+  # keep the per-request metrics records of the function instead of printing them
+  sink = module.metrics_from_environment.__globals__['MemorySink']()
+  module.metrics.sink = sink
+  if hasattr(module, 'iter_textract_pages'):
+    # the fake Textract job finishes after one status check, don't wait between checks
+    module.iter_textract_pages.__globals__['_POLL_INTERVAL_SECONDS'] = 0
+
+  text = make_document(args.child, args.size)
+  if hasattr(module, 'process_document'):
+    if args.format == 'pdf':
+      lines = text.splitlines()
+      pages = ['\n'.join(lines[i:i + args.lines_per_page]) for i in range(0, len(lines), args.lines_per_page)]
+      key = 'documents/benchmark.pdf'
+      textract.add_document(_BUCKET, key, pages)
+      s3.put_object(Bucket=_BUCKET, Key=key, Body=b'%PDF', ContentType='application/pdf')
+    else:
+      key = 'documents/benchmark.txt'
+      s3.put_object(Bucket=_BUCKET, Key=key, Body=text, ContentType='text/plain')
+    event = {'Records': [{'s3': {'bucket': {'name': _BUCKET}, 'object': {'key': key}}}]}
+  else:
+    event = {'body': json.dumps({'text': text})}
+  del text
+  rss_before = peak_rss_mb()
+
+  latencies = []
+  status_codes = []
+  for _ in range(args.repeat):
+    start = time.perf_counter()
+    response = module.lambda_handler(event, None)
+    latencies.append(time.perf_counter() - start)
+    status_codes.append(response.get('statusCode'))
+  print(json.dumps({
+    'latencies': latencies,
+    'status_codes': status_codes,
+    'bedrock': bedrock.stats(),
+    'textract_calls': textract.calls,
+    'metrics': sink.records,
+    'rss_before_mb': rss_before,
+    'peak_rss_mb': peak_rss_mb()
+  }))
+
+def child_command(args, function, size):
+  command = [
+    sys.executable, os.path.abspath(__file__), '--child', function, '--size', str(size),
+    '--repeat', str(args.repeat), '--format', args.format, '--lines-per-page', str(args.lines_per_page),
+    '--base-latency', str(args.base_latency), '--input-token-latency', str(args.input_token_latency),
+    '--output-token-latency', str(args.output_token_latency), '--throttle-concurrency', str(args.throttle_concurrency),
+    '--throttle-rpm', str(args.throttle_rpm), '--throttle-tpm', str(args.throttle_tpm)
+  ]
+  for setting in args.env:
+    command += ['--env', setting]
+  return command
+
+def stage_seconds(records, runs):
+  totals = {}
+  for record in records:
+    for name, value in record.items():
+      if name.endswith('Seconds') and not name.endswith('MaxSeconds') and name != 'RequestSeconds':
+        totals[name[:-len('Seconds')]] = totals.get(name[:-len('Seconds')], 0.0) + value
+  return {name: seconds / runs for name, seconds in sorted(totals.items())}
+
+def measure(args, function, size):
+  case = {'function': function, 'size': size}
+  if os.path.basename(os.path.dirname(LAMBDA_DIRS[function])).endswith('_API') and size > _API_MAX_BYTES:
+    case['skipped'] = 'larger than the API Gateway payload limit'
+    return case
+  process = subprocess.run(child_command(args, function, size), capture_output=True, text=True, timeout=args.timeout, cwd=os.path.dirname(os.path.abspath(__file__)))
+  if process.returncode != 0:
+    case['error'] = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'exit code %s' % process.returncode
+    return case
+  result = json.loads(process.stdout.splitlines()[-1])
+  runs = len(result['latencies'])
+  case.update({
+    'p50_seconds': percentile(result['latencies'], 0.5),
+    'p99_seconds': percentile(result['latencies'], 0.99),
+    'failed_runs': sum(1 for code in result['status_codes'] if code != 200),
+    # model calls and tokens per run
+    'model_calls': result['bedrock']['calls'] / runs,
+    'throttles': result['bedrock']['throttles'] / runs,
+    'input_tokens': result['bedrock']['input_tokens'] / runs,
+    'output_tokens': result['bedrock']['output_tokens'] / runs,
+    'max_in_flight': result['bedrock']['max_in_flight'],
+    'textract_calls': result['textract_calls'] / runs,
+    # seconds per run spent in each stage of the function, from its metrics records
+    'stages': stage_seconds(result['metrics'], runs),
+    'rss_before_mb': result['rss_before_mb'],
+    'peak_rss_mb': result['peak_rss_mb']
+  })
+  return case
+
+_HEADER = '%-30s %8s %9s %9s %8s %9s %12s %12s %10s %10s' % ('function', 'size', 'p50 s', 'p99 s', 'calls', 'throttles', 'tokens in', 'tokens out', 'RSS MB', 'peak MB')
+
+# calls and tokens are per run, RSS MB is the peak RSS before the first run (document and function loaded) and peak MB the peak RSS of the whole case
+def print_row(case):
+  prefix = '%-30s %8s' % (case['function'], format_size(case['size']))
+  if 'skipped' in case or 'error' in case:
+    print('%s  %s' % (prefix, case.get('skipped') or 'error: ' + case['error']))
+    return
+  print('%s %9.3f %9.3f %8.0f %9.0f %12.0f %12.0f %10.1f %10.1f%s' % (
+    prefix, case['p50_seconds'], case['p99_seconds'], case['model_calls'], case['throttles'], case['input_tokens'], case['output_tokens'],
+    case['rss_before_mb'], case['peak_rss_mb'], '  (%s failed runs)' % case['failed_runs'] if case['failed_runs'] else ''
+  ))
+
+def print_stages(case):
+  if case.get('stages'):
+    print('%39s %s' % ('', '  '.join('%s %.3fs' % item for item in case['stages'].items())))
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the Lambda functions against simulated Amazon Bedrock, S3 and Textract backends')
+  parser.add_argument('--function', action='append', choices=sorted(LAMBDA_DIRS), help='function to benchmark, can be repeated (default: all)')
+  parser.add_argument('--sizes', default=_DEFAULT_SIZES, help='comma separated document sizes (default: %s)' % _DEFAULT_SIZES)
+  parser.add_argument('--repeat', type=int, default=5, help='runs per case, p50 and p99 are computed over these runs')
+  parser.add_argument('--format', choices=['txt', 'pdf'], default='txt', help='upload documents as text files or as PDFs read with the fake Textract')
+  parser.add_argument('--lines-per-page', type=int, default=40, help='lines per page of the fake PDFs')
+  parser.add_argument('--base-latency', type=float, default=0.05, help='seconds per model call')
+  parser.add_argument('--input-token-latency', type=float, default=0.0, help='seconds per input token')
+  parser.add_argument('--output-token-latency', type=float, default=0.0, help='seconds per output token, e.g. 0.03 for realistic generation speed')
+  parser.add_argument('--throttle-concurrency', type=int, default=0, help='calls in flight above which the fake Bedrock throttles (0: never)')
+  parser.add_argument('--throttle-rpm', type=int, default=0, help='requests per minute above which the fake Bedrock throttles (0: never)')
+  parser.add_argument('--throttle-tpm', type=int, default=0, help='tokens per minute above which the fake Bedrock throttles (0: never)')
+  parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='environment variable for the function, e.g. MAX_CONCURRENCY=8, can be repeated')
+  parser.add_argument('--timeout', type=int, default=3600, help='seconds allowed per case')
+  parser.add_argument('--stages', action='store_true', help='print the seconds per run spent in each stage (S3Get, Chunk, Bedrock, ...) under each case')
+  parser.add_argument('--json', action='store_true', help='print the results as JSON, e.g. to keep them for comparison with later runs')
+  parser.add_argument('--child', help=argparse.SUPPRESS)
+  parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.child:
+    run_case(args)
+    return
+
+  sizes = [parse_size(size) for size in args.sizes.split(',')]
+  cases = []
+  if not args.json:
+    print(_HEADER)
+    print('-' * len(_HEADER))
+  for function in args.function or sorted(LAMBDA_DIRS):
+    for size in sizes:
+      case = measure(args, function, size)
+      cases.append(case)
+      if not args.json:
+        print_row(case)
+        if args.stages:
+          print_stages(case)
+        sys.stdout.flush()
+  if args.json:
+    print(json.dumps(cases, indent=2))
+
+if __name__ == '__main__':
+  main()
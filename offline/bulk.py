@@ -0,0 +1,239 @@
+# Bulk runner for backfills: mask or summarize a whole corpus of local documents with the pipelines of the Document_Upload functions
+# documents come from a directory or a JSONL manifest, they are read, tokenized and split into chunks in a pool of processes,
+# and their chunks are sent to Amazon Bedrock from this process, with one concurrency budget (and rate limits) shared by all documents
+# every finished document is recorded in a checkpoint file, so a run that is stopped can be started again and skips the documents that are done
+# usage: python offline/bulk.py pii <directory or manifest.jsonl> --output <directory> [--max-concurrency 8] [--documents 4] [--workers 4]
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from fakes import FakeBedrock
+from local_lambda import load_module, set_client
+
+_FUNCTIONS = {'pii': 'pii-document-upload', 'summarization': 'summarization-document-upload'}
+_CHECKPOINT_NAME = 'checkpoint.jsonl'
+_DONE = 'done'
+_FAILED = 'failed'
+
+Chunk = namedtuple('Chunk', ['text', 'token_count'])
+# a document split into chunks by a worker process, tokens is the token count of the whole document
+ChunkedDocument = namedtuple('ChunkedDocument', ['document', 'chunks', 'tokens'])
+
+# documents as {'id': ..., 'path': ...} or {'id': ..., 'text': ...}
+# a directory gives every file with one of the extensions under it, with the path relative to the directory as id
+# a manifest has one JSON object per line with a path (relative to the manifest) or a text, and an optional id (default: the path)
+def iter_documents(source, extensions):
+  if os.path.isdir(source):
+    for root, dirs, files in os.walk(source):
+      dirs.sort()
+      for name in sorted(files):
+        if name.endswith(extensions):
+          path = os.path.join(root, name)
+          yield {'id': os.path.relpath(path, source), 'path': path}
+    return
+  base = os.path.dirname(os.path.abspath(source))
+  with open(source, encoding='utf-8') as f:
+    for line_number, line in enumerate(f, 1):
+      if not line.strip():
+        continue
+      document = json.loads(line)
+      if 'path' in document:
+        document.setdefault('id', document['path'])
+        document['path'] = os.path.join(base, document['path'])
+      elif 'text' not in document or 'id' not in document:
+        raise ValueError('Manifest line %s needs a path, or a text and an id' % line_number)
+      yield document
+
+# ids of the documents that are done according to the checkpoint, documents that failed are attempted again
+def read_checkpoint(path):
+  done = set()
+  if os.path.exists(path):
+    with open(path, encoding='utf-8') as f:
+      for line in f:
+        if line.strip():
+          entry = json.loads(line)
+          if entry['status'] == _DONE:
+            done.add(entry['id'])
+  return done
+
+# state of a worker process, set up once by init_worker
+_worker = {}
+
+# the worker loads the tokenizer named by the TOKENIZER environment variable, like the pipeline does
+def init_worker(function):
+  _worker['chunking'] = load_module(function, 'chunking')
+  _worker['tokenizer'] = load_module(function, 'tokenization').tokenizer_from_environment()
+
+# runs in a worker process: read a document, encode it once and split it into chunks
+def chunk_document(document, chunk_size, chunk_overlap):
+  if 'text' in document:
+    text = document['text']
+  else:
+    with open(document['path'], encoding='utf-8', errors='replace') as f:
+      text = f.read()
+  chunking = _worker['chunking']
+  offsets = chunking.token_offsets(text, _worker['tokenizer']) if text else []
+  chunks = chunking.split_offsets(text, offsets, chunk_size, chunk_overlap) if text else []
+  return [tuple(chunk) for _, chunk in chunks], len(offsets)
+
+# chunk documents in the process pool and yield them in order as ChunkedDocuments, at most window documents are chunked ahead of the consumer
+# a document that can't be read is yielded with its exception instead of its chunks
+def chunk_documents(pool, documents, chunk_size, chunk_overlap, window):
+  pending = deque()
+  def next_document():
+    document, future = pending.popleft()
+    try:
+      chunks, tokens = future.result()
+    except Exception as e:
+      return ChunkedDocument(document, e, 0)
+    return ChunkedDocument(document, [Chunk(*chunk) for chunk in chunks], tokens)
+  for document in documents:
+    pending.append((document, pool.submit(chunk_document, document, chunk_size, chunk_overlap)))
+    if len(pending) >= window:
+      yield next_document()
+  while pending:
+    yield next_document()
+
+# the pipeline of one function over chunked documents, built on the loaded lambda.py
+class Pipeline:
+  def __init__(self, name, module, max_concurrency):
+    self.name = name
+    self.module = module
+    if name == 'pii':
+      self.engine = module.engine
+      self.engine.max_concurrency = max_concurrency
+      self.engine.window = 2 * max_concurrency
+      self.tokenizer = self.engine.tokenizer
+      self.chunk_size = self.engine.max_chunk_size()
+      self.chunk_overlap = 0
+    else:
+      self.tokenizer = module.get_tokenizer()
+      self.chunk_size = module.max_input_size(module._MAP_PROMPT)
+      self.chunk_overlap = int(self.chunk_size / 100)
+      self.output_size = module._MAX_SUMMARY_LENGTH + module._OUTPUT_TOKEN_BUFFER
+
+  # the masked text or the summary of a chunked document
+  def run(self, chunks):
+    if self.name == 'pii':
+      results = []
+      for chunk_indexes, result, error in self.engine.mask_chunks(chunks):
+        if error:
+          raise RuntimeError('Failed to mask chunks %s: %s' % (list(chunk_indexes), error))
+        results.append(result)
+      return ''.join(results)
+    if not chunks:
+      return ''
+    if self.module.fits_stuff_prompt(chunks):
+      return self.module.get_summary_short_doc(chunks, self.output_size)
+    return self.module.get_summary_large_doc(chunks, self.output_size)
+
+def output_path(output_dir, document_id):
+  root, _ = os.path.splitext(document_id)
+  return os.path.join(output_dir, root + '.txt')
+
+# write the output next to its final path first, so a stopped run never leaves a truncated output behind
+def write_output(path, text):
+  os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+  temporary = path + '.tmp'
+  with open(temporary, 'w', encoding='utf-8') as f:
+    f.write(text)
+  os.replace(temporary, path)
+
+class Progress:
+  def __init__(self, skipped):
+    self.started = time.perf_counter()
+    self.skipped = skipped
+    self.done = 0
+    self.failed = 0
+    self.tokens = 0
+
+  def add(self, status, tokens):
+    if status == _DONE:
+      self.done += 1
+      self.tokens += tokens
+    else:
+      self.failed += 1
+
+  # rates count the documents that are done and their input tokens
+  def summary(self):
+    seconds = time.perf_counter() - self.started
+    return {
+      'done': self.done,
+      'failed': self.failed,
+      'skipped': self.skipped,
+      'seconds': round(seconds, 3),
+      'documents_per_second': round(self.done / seconds, 3) if seconds else 0.0,
+      'tokens_per_second': round(self.tokens / seconds, 1) if seconds else 0.0
+    }
+
+def main():
+  parser = argparse.ArgumentParser(description='Mask or summarize a corpus of local documents with the pipelines of the Document_Upload functions')
+  parser.add_argument('function', choices=sorted(_FUNCTIONS), help='pipeline to run')
+  parser.add_argument('source', help='directory of documents, or JSONL manifest with a path or text (and an id) per line')
+  parser.add_argument('--output', required=True, help='directory for the outputs (<id>.txt) and the checkpoint file')
+  parser.add_argument('--checkpoint', help='checkpoint file (default: %s in the output directory)' % _CHECKPOINT_NAME)
+  parser.add_argument('--extensions', default='.txt', help='comma separated file extensions read from a directory')
+  parser.add_argument('--max-concurrency', type=int, default=8, help='Amazon Bedrock calls in flight, shared by all documents')
+  parser.add_argument('--documents', type=int, default=4, help='documents processed at the same time')
+  parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='processes that read, tokenize and chunk documents')
+  parser.add_argument('--report-every', type=float, default=10.0, help='seconds between progress lines on stderr')
+  parser.add_argument('--fake-bedrock', action='store_true', help='answer the model calls with the local FakeBedrock instead of Amazon Bedrock, e.g. for a dry run')
+  parser.add_argument('--base-latency', type=float, default=0.05, help='seconds per call of the fake Bedrock')
+  args = parser.parse_args()
+
+  # the scheduler of the function bounds the calls in flight by MAX_CONCURRENCY * MAX_DOCUMENT_CONCURRENCY, so this makes it the shared budget
+  os.environ['MAX_CONCURRENCY'] = str(args.max_concurrency)
+  os.environ['MAX_DOCUMENT_CONCURRENCY'] = '1'
+  os.environ.setdefault('METRICS_FORMAT', 'off')
+  function = _FUNCTIONS[args.function]
+  module = load_module(function)
+  if args.fake_bedrock:
+    set_client(module, 'bedrock-runtime', FakeBedrock(base_latency=args.base_latency))
+  pipeline = Pipeline(args.function, module, args.max_concurrency)
+  parallel = load_module(function, 'parallel')
+
+  checkpoint_path = args.checkpoint or os.path.join(args.output, _CHECKPOINT_NAME)
+  os.makedirs(args.output, exist_ok=True)
+  done_ids = read_checkpoint(checkpoint_path)
+  documents = (document for document in iter_documents(args.source, tuple(args.extensions.split(','))) if document['id'] not in done_ids)
+  progress = Progress(len(done_ids))
+
+  # process a chunked document and return its checkpoint entry, a document that fails is recorded as failed and the run goes on
+  def process(chunked):
+    entry = {'id': chunked.document['id'], 'tokens': chunked.tokens}
+    start = time.perf_counter()
+    try:
+      if isinstance(chunked.chunks, Exception):
+        raise chunked.chunks
+      write_output(output_path(args.output, chunked.document['id']), pipeline.run(chunked.chunks))
+    except Exception as e:
+      entry.update(status=_FAILED, error='%s: %s' % (type(e).__name__, e))
+      return entry
+    entry.update(status=_DONE, chunks=len(chunked.chunks), seconds=round(time.perf_counter() - start, 3))
+    return entry
+
+  last_report = time.perf_counter()
+  with ProcessPoolExecutor(max_workers=max(1, args.workers), initializer=init_worker, initargs=(function,)) as pool, \
+      open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+    # only a window of documents is chunked ahead of the documents in flight, so memory does not grow with the corpus
+    chunked_documents = chunk_documents(pool, documents, pipeline.chunk_size, pipeline.chunk_overlap, 2 * max(1, args.workers))
+    for _, entry, _ in parallel.imap_ordered(process, chunked_documents, args.documents, window=2 * args.documents):
+      checkpoint.write(json.dumps(entry) + '\n')
+      checkpoint.flush()
+      progress.add(entry['status'], entry['tokens'])
+      if time.perf_counter() - last_report >= args.report_every:
+        last_report = time.perf_counter()
+        sys.stderr.write('%s\n' % json.dumps(progress.summary()))
+
+  summary = progress.summary()
+  counters = module.metrics.snapshot()
+  summary['model_calls'] = counters.get('ModelCalls', 0)
+  summary['model_input_tokens'] = counters.get('InputTokens', 0)
+  summary['model_output_tokens'] = counters.get('OutputTokens', 0)
+  print(json.dumps(summary, indent=2))
+
+if __name__ == '__main__':
+  main()
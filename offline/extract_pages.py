@@ -0,0 +1,41 @@
+# Run the multi-page Textract extraction and chunking of the Document_Upload functions against the fake Textract client
+# usage: python offline/extract_pages.py <text file> [--lines-per-page 40] [--chunk-size 2000] [--polls 2]
+import argparse
+import time
+from fakes import FakeTextract
+from local_lambda import load_module
+
+def main():
+  parser = argparse.ArgumentParser(description='Extract a fake multi-page document page by page and show when each chunk becomes available')
+  parser.add_argument('path', help='text file used as the content of the fake PDF')
+  parser.add_argument('--lines-per-page', type=int, default=40)
+  parser.add_argument('--chunk-size', type=int, default=2000, help='chunk size in tokens')
+  parser.add_argument('--polls', type=int, default=2, help='number of status checks that report IN_PROGRESS')
+  parser.add_argument('--function', default='pii-document-upload', choices=['pii-document-upload', 'summarization-document-upload'])
+  args = parser.parse_args()
+
+  with open(args.path, encoding='utf-8') as f:
+    lines = f.read().splitlines()
+  pages = ['\n'.join(lines[i:i + args.lines_per_page]) for i in range(0, len(lines), args.lines_per_page)]
+  textract = FakeTextract(polls_until_done=args.polls)
+  textract.add_document('bucket', 'documents/example.pdf', pages)
+
+  extraction = load_module(args.function, 'extraction')
+  chunking = load_module(args.function, 'chunking')
+  extraction._POLL_INTERVAL_SECONDS = 0.1
+  tokenizer = load_module(args.function, 'tokenization').tokenizer_from_environment()
+
+  pages_read = []
+  def counted(page_iterator):
+    for page in page_iterator:
+      pages_read.append(page)
+      yield page
+
+  start = time.time()
+  page_iterator = counted(extraction.iter_textract_pages(textract, 'bucket', 'documents/example.pdf', 'application/pdf'))
+  for index, chunk in enumerate(chunking.split_stream(page_iterator, tokenizer, args.chunk_size)):
+    print('chunk %s: %s tokens, available after %s of %s pages (%.2fs)' % (index, chunk.token_count, len(pages_read), len(pages), time.time() - start))
+  print('Textract calls: %s' % textract.calls)
+
+if __name__ == '__main__':
+  main()
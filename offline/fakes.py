@@ -0,0 +1,339 @@
+# Local stand-ins for AWS clients, so the Lambda functions can be run and measured without an AWS account
+import datetime
+import io
+import itertools
+import json
+import re
+import threading
+import time
+from collections import deque
+from botocore.exceptions import ClientError
+
+def client_error(code, message, operation):
+  return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+# fake Amazon Textract client, documents are registered as a list of page texts
+# the text detection jobs report IN_PROGRESS for the first polls_until_done status checks, and until page_latency seconds per page have passed,
+# and results are paginated like the real API
+# documents sent as bytes (e.g. a single page of a PDF) are read with ocr, a function from the bytes to the page text, or have no text
+class FakeTextract:
+  def __init__(self, polls_until_done=1, latency=0.0, page_latency=0.0, ocr=None):
+    self.polls_until_done = polls_until_done
+    self.latency = latency # seconds added to every call
+    self.page_latency = page_latency # seconds of text detection per page
+    self.ocr = ocr
+    self.documents = {}
+    self.jobs = {}
+    self.calls = 0
+    self._job_ids = itertools.count(1)
+
+  def add_document(self, bucket, key, pages):
+    self.documents[(bucket, key)] = pages
+
+  def _call(self):
+    self.calls += 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def _pages(self, s3_object, operation):
+    pages = self.documents.get((s3_object['Bucket'], s3_object['Name']))
+    if pages is None:
+      raise client_error('InvalidS3ObjectException', 'Unable to get object metadata from S3', operation)
+    return pages
+
+  def detect_document_text(self, Document):
+    self._call()
+    if 'Bytes' in Document:
+      pages = [self.ocr(Document['Bytes']) if self.ocr else '']
+    else:
+      pages = self._pages(Document['S3Object'], 'DetectDocumentText')
+    if len(pages) > 1:
+      raise client_error('UnsupportedDocumentException', 'Request has unsupported document format', 'DetectDocumentText')
+    if self.page_latency:
+      time.sleep(self.page_latency)
+    return {'DocumentMetadata': {'Pages': 1}, 'Blocks': blocks(pages)}
+
+  def start_document_text_detection(self, DocumentLocation):
+    self._call()
+    pages = self._pages(DocumentLocation['S3Object'], 'StartDocumentTextDetection')
+    job_id = 'job-%s' % next(self._job_ids)
+    self.jobs[job_id] = {'pages': len(pages), 'blocks': blocks(pages), 'polls': self.polls_until_done, 'done_at': time.monotonic() + self.page_latency * len(pages)}
+    return {'JobId': job_id}
+
+  def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None):
+    self._call()
+    job = self.jobs.get(JobId)
+    if job is None:
+      raise client_error('InvalidJobIdException', 'Job id not found', 'GetDocumentTextDetection')
+    if job['polls'] > 0 or time.monotonic() < job['done_at']:
+      job['polls'] = max(0, job['polls'] - 1)
+      return {'JobStatus': 'IN_PROGRESS'}
+    start = int(NextToken or 0)
+    response = {
+      'JobStatus': 'SUCCEEDED',
+      'DocumentMetadata': {'Pages': job['pages']},
+      'Blocks': job['blocks'][start:start + MaxResults]
+    }
+    if start + MaxResults < len(job['blocks']):
+      response['NextToken'] = str(start + MaxResults)
+    return response
+
+# build the PAGE, LINE and WORD blocks Textract returns for the given page texts
+def blocks(pages):
+  result = []
+  for page_number, page in enumerate(pages, start=1):
+    result.append({'BlockType': 'PAGE', 'Page': page_number})
+    for line in page.splitlines():
+      if not line.strip():
+        continue
+      result.append({'BlockType': 'LINE', 'Page': page_number, 'Text': line})
+      result.extend({'BlockType': 'WORD', 'Page': page_number, 'Text': word} for word in line.split())
+  return result
+
+# rough token count used by the fakes (about 4 characters per token), so they don't depend on a tokenizer
+_EMAIL = re.compile(r'[A-Za-z0-9._%+\-]+@[A-Za-z0-9\-]+(?:\.[A-Za-z0-9\-]+)*\.[A-Za-z]{2,}')
+
+def estimate_tokens(text):
+  return max(1, len(text) // 4)
+
+# fake Amazon Bedrock runtime client for the text completion API and the Messages API of Claude
+# the completion echoes the last <text> of the prompt in <response> tags (like a masking prompt with no PII found),
+# or its first words (at most max_tokens_to_sample) in <summary> tags when the prompt asks for a summary,
+# or the email addresses in the text in <entities> tags when the prompt asks for a list of PII
+# calls take base_latency plus a latency per input and output token, and raise ThrottlingException above the given limits (0 for no limit)
+# model_latency maps model ids to a factor all latencies of a call to that model are multiplied by, e.g. the relative latencies of the models in models.py
+class FakeBedrock:
+  def __init__(self, base_latency=0.0, input_token_latency=0.0, output_token_latency=0.0, max_concurrency=0, requests_per_minute=0, tokens_per_minute=0, model_latency=None):
+    self.model_latency = model_latency or {}
+    self.base_latency = base_latency
+    self.input_token_latency = input_token_latency
+    self.output_token_latency = output_token_latency
+    self.max_concurrency = max_concurrency
+    self.requests_per_minute = requests_per_minute
+    self.tokens_per_minute = tokens_per_minute
+    self.calls = 0
+    self.calls_by_model = {}
+    self.throttles = 0
+    self.input_tokens = 0
+    self.output_tokens = 0
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self._recent = deque() # (time, tokens) of the calls accepted in the last minute
+    self._lock = threading.Lock()
+
+  def completion(self, prompt, max_tokens):
+    text = prompt[prompt.rfind('<text>') + len('<text>'):prompt.rfind('</text>')]
+    # the prompt templates put the text on its own lines
+    text = text[1:] if text.startswith('\n') else text
+    text = text[:-1] if text.endswith('\n') else text
+    if '<summary>' in prompt:
+      return '<summary>%s</summary>' % ' '.join(text.split()[:min(max_tokens, 100)])
+    if '<entities>' in prompt:
+      emails = sorted(set(_EMAIL.findall(text)))
+      return '<entities>%s</entities>' % json.dumps([[email, '[email address]'] for email in emails])
+    return '<response>%s</response>' % text
+
+  def _start(self, operation, model_id, input_tokens, max_tokens):
+    with self._lock:
+      now = time.monotonic()
+      while self._recent and self._recent[0][0] < now - 60:
+        self._recent.popleft()
+      over_concurrency = self.max_concurrency and self.in_flight >= self.max_concurrency
+      over_requests = self.requests_per_minute and len(self._recent) >= self.requests_per_minute
+      over_tokens = self.tokens_per_minute and sum(tokens for _, tokens in self._recent) + input_tokens + max_tokens > self.tokens_per_minute
+      if over_concurrency or over_requests or over_tokens:
+        self.throttles += 1
+        raise client_error('ThrottlingException', 'Too many requests, please wait before trying again.', operation)
+      self._recent.append((now, input_tokens + max_tokens))
+      self.calls += 1
+      self.calls_by_model[model_id] = self.calls_by_model.get(model_id, 0) + 1
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+  def _finish(self, input_tokens, output_tokens):
+    with self._lock:
+      self.in_flight -= 1
+      self.input_tokens += input_tokens
+      self.output_tokens += output_tokens
+
+  # a text completion request has a prompt, a Messages API request a user message
+  def _request(self, body, modelId, operation):
+    request = json.loads(body)
+    if 'messages' in request:
+      prompt = request['messages'][-1]['content']
+      max_tokens = request['max_tokens']
+    else:
+      prompt = request['prompt']
+      max_tokens = request['max_tokens_to_sample']
+    input_tokens = estimate_tokens(prompt)
+    self._start(operation, modelId, input_tokens, max_tokens)
+    completion = self.completion(prompt, max_tokens)
+    return 'messages' in request, input_tokens, completion, estimate_tokens(completion)
+
+  def _headers(self, input_tokens, output_tokens, latency):
+    return {
+      'x-amzn-bedrock-input-token-count': str(input_tokens),
+      'x-amzn-bedrock-output-token-count': str(output_tokens),
+      'x-amzn-bedrock-invocation-latency': str(int(latency * 1000))
+    }
+
+  def invoke_model(self, body, modelId, accept='application/json', contentType='application/json'):
+    messages, input_tokens, completion, output_tokens = self._request(body, modelId, 'InvokeModel')
+    latency = (self.base_latency + input_tokens * self.input_token_latency + output_tokens * self.output_token_latency) * self.model_latency.get(modelId, 1.0)
+    if messages:
+      result = {'content': [{'type': 'text', 'text': completion}], 'stop_reason': 'end_turn'}
+    else:
+      result = {'completion': completion, 'stop_reason': 'stop_sequence'}
+    try:
+      time.sleep(latency)
+    finally:
+      self._finish(input_tokens, output_tokens)
+    return {
+      'body': io.BytesIO(json.dumps(result).encode('utf-8')),
+      'contentType': 'application/json',
+      'ResponseMetadata': {'HTTPStatusCode': 200, 'HTTPHeaders': self._headers(input_tokens, output_tokens, latency)}
+    }
+
+  # the completion is streamed in pieces of about 20 tokens, paced by the output token latency
+  # Messages API streams have content_block_delta events for the pieces and end with a message_stop event
+  def invoke_model_with_response_stream(self, body, modelId, accept='application/json', contentType='application/json'):
+    messages, input_tokens, completion, output_tokens = self._request(body, modelId, 'InvokeModelWithResponseStream')
+    factor = self.model_latency.get(modelId, 1.0)
+    invocation_metrics = {'inputTokenCount': input_tokens, 'outputTokenCount': output_tokens}
+    def events():
+      try:
+        time.sleep((self.base_latency + input_tokens * self.input_token_latency) * factor)
+        starts = range(0, len(completion), 80)
+        for start in starts:
+          piece = completion[start:start + 80]
+          time.sleep(estimate_tokens(piece) * self.output_token_latency * factor)
+          if messages:
+            payload = {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': piece}}
+          else:
+            payload = {'completion': piece}
+            if start == starts[-1]:
+              # like Amazon Bedrock, the last event carries the invocation metrics
+              payload['amazon-bedrock-invocationMetrics'] = invocation_metrics
+          yield {'chunk': {'bytes': json.dumps(payload).encode('utf-8')}}
+        if messages:
+          yield {'chunk': {'bytes': json.dumps({'type': 'message_stop', 'amazon-bedrock-invocationMetrics': invocation_metrics}).encode('utf-8')}}
+      finally:
+        self._finish(input_tokens, output_tokens)
+    return {'body': events(), 'contentType': contentType, 'ResponseMetadata': {'HTTPStatusCode': 200, 'HTTPHeaders': {}}}
+
+  def stats(self):
+    return {
+      'calls': self.calls,
+      'calls_by_model': self.calls_by_model,
+      'throttles': self.throttles,
+      'input_tokens': self.input_tokens,
+      'output_tokens': self.output_tokens,
+      'max_in_flight': self.max_in_flight
+    }
+
+class NoSuchKey(ClientError):
+  pass
+
+# S3 object body, read in parts like botocore's StreamingBody
+class FakeStreamingBody:
+  def __init__(self, data):
+    self._stream = io.BytesIO(data)
+
+  def read(self, amt=None):
+    return self._stream.read(amt)
+
+  def iter_chunks(self, chunk_size=1024):
+    return iter(lambda: self.read(chunk_size), b'')
+
+  def close(self):
+    self._stream.close()
+
+# paginator for list operations that return NextContinuationToken, like the boto3 paginators
+class FakePaginator:
+  def __init__(self, operation):
+    self.operation = operation
+
+  def paginate(self, **kwargs):
+    while True:
+      page = self.operation(**kwargs)
+      yield page
+      if not page.get('IsTruncated'):
+        return
+      kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+# fake Amazon S3 client holding objects in memory, with single part and multipart uploads, listing by prefix and presigned URLs
+class FakeS3:
+  class exceptions:
+    NoSuchKey = NoSuchKey
+
+  def __init__(self, latency=0.0):
+    self.latency = latency # seconds added to every call
+    self.objects = {}
+    self.uploads = {}
+    self.calls = 0
+    self._upload_ids = itertools.count(1)
+    self._lock = threading.Lock()
+
+  def _call(self):
+    with self._lock:
+      self.calls += 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def put_object(self, Bucket, Key, Body=b'', ContentType='binary/octet-stream', **kwargs):
+    self._call()
+    if isinstance(Body, str):
+      Body = Body.encode('utf-8')
+    elif hasattr(Body, 'read'):
+      Body = Body.read()
+    self.objects[(Bucket, Key)] = (bytes(Body), ContentType, datetime.datetime.now(datetime.timezone.utc))
+    return {'ETag': '"%s"' % len(self.objects)}
+
+  def get_object(self, Bucket, Key, **kwargs):
+    self._call()
+    if (Bucket, Key) not in self.objects:
+      raise NoSuchKey({'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, 'GetObject')
+    data, content_type, last_modified = self.objects[(Bucket, Key)]
+    return {'Body': FakeStreamingBody(data), 'ContentType': content_type, 'ContentLength': len(data), 'LastModified': last_modified}
+
+  # list objects by prefix in key order, up to MaxKeys per page
+  def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, **kwargs):
+    self._call()
+    keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix) and (ContinuationToken is None or key > ContinuationToken))
+    page = keys[:MaxKeys]
+    response = {'KeyCount': len(page), 'IsTruncated': len(keys) > MaxKeys}
+    if page:
+      response['Contents'] = [{'Key': key, 'Size': len(self.objects[(Bucket, key)][0]), 'LastModified': self.objects[(Bucket, key)][2]} for key in page]
+    if response['IsTruncated']:
+      response['NextContinuationToken'] = page[-1]
+    return response
+
+  def get_paginator(self, operation_name):
+    return FakePaginator(getattr(self, operation_name))
+
+  def create_multipart_upload(self, Bucket, Key, ContentType='binary/octet-stream', **kwargs):
+    self._call()
+    upload_id = 'upload-%s' % next(self._upload_ids)
+    self.uploads[upload_id] = {'key': (Bucket, Key), 'content_type': ContentType, 'parts': {}}
+    return {'UploadId': upload_id}
+
+  def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+    self._call()
+    self.uploads[UploadId]['parts'][PartNumber] = bytes(Body)
+    return {'ETag': '"%s-%s"' % (UploadId, PartNumber)}
+
+  def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+    self._call()
+    upload = self.uploads.pop(UploadId)
+    data = b''.join(upload['parts'][part['PartNumber']] for part in MultipartUpload['Parts'])
+    self.objects[(Bucket, Key)] = (data, upload['content_type'], datetime.datetime.now(datetime.timezone.utc))
+    return {'Bucket': Bucket, 'Key': Key}
+
+  def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+    self._call()
+    self.uploads.pop(UploadId, None)
+    return {}
+
+  # a URL that looks like a presigned URL, the object can be read with get_object
+  def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600, **kwargs):
+    return 'https://%s.s3.amazonaws.com/%s?X-Amz-Expires=%s' % (Params['Bucket'], Params['Key'], ExpiresIn)
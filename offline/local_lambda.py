@@ -0,0 +1,37 @@
+# Load the Lambda functions of this repository into a local Python process
+import importlib.util
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIRS = {
+  'pii-api': os.path.join(REPO_ROOT, 'Architectures', 'PII_Masking', 'PII_Masking_API', 'lambda'),
+  'pii-document-upload': os.path.join(REPO_ROOT, 'Architectures', 'PII_Masking', 'PII_Masking_Document_Upload', 'lambda'),
+  'summarization-api': os.path.join(REPO_ROOT, 'Architectures', 'Summarization', 'Summarization_API', 'lambda'),
+  'summarization-document-upload': os.path.join(REPO_ROOT, 'Architectures', 'Summarization', 'Summarization_Document_Upload', 'lambda'),
+}
+
+# import module_name (e.g. 'lambda' or 'extraction') from the lambda folder of the given function
+# the lambda folders contain helper modules with the same names, so those are removed from sys.modules before and after loading
+# the loaded module keeps references to the helper modules it imported
+def load_module(function, module_name='lambda'):
+  lambda_dir = LAMBDA_DIRS[function]
+  # boto3 clients are created on first use and need a region, no AWS call is made when creating them
+  os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+  local_modules = [name[:-3] for name in os.listdir(lambda_dir) if name.endswith('.py')]
+  for name in local_modules:
+    sys.modules.pop(name, None)
+  sys.path.insert(0, lambda_dir)
+  try:
+    spec = importlib.util.spec_from_file_location('%s_%s' % (function.replace('-', '_'), module_name), os.path.join(lambda_dir, module_name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+  finally:
+    sys.path.remove(lambda_dir)
+    for name in local_modules:
+      sys.modules.pop(name, None)
+  return module
+
+# replace the AWS client a loaded function uses for service_name, e.g. with one of the stand-ins in fakes.py
+def set_client(module, service_name, client):
+  module.configure_client.__globals__['set_client'](service_name, client)
@@ -0,0 +1,107 @@
+# Benchmark of the PDF text extraction of the Document_Upload functions: the text layer read locally, against Amazon Textract for every page
+# documents are built from the test documents that come with the functions: the_beatles_wiki_pg_1.pdf has a text layer,
+# and ExampleHomeownerInsurancePlan.jpeg is put on a page of its own, as a scanned page without one
+# the local path is measured for real, Textract calls are answered by the fake Textract client with the given latencies
+# usage: python offline/pdf_extraction_benchmark.py [--pages 1,10,50] [--kinds text,scanned,mixed] [--processes 1,4] [--page-latency 0.25] [--json]
+import argparse
+import io
+import json
+import os
+import time
+from fakes import FakeTextract
+from local_lambda import LAMBDA_DIRS, load_module
+
+_FUNCTION = 'summarization-document-upload'
+_BUCKET = 'benchmark-bucket'
+_KEY = 'documents/benchmark.pdf'
+_TEXT_PDF = os.path.join(os.path.dirname(LAMBDA_DIRS['summarization-document-upload']), 'test_documents', 'the_beatles_wiki_pg_1.pdf')
+_SCANNED_JPEG = os.path.join(os.path.dirname(LAMBDA_DIRS['pii-document-upload']), 'test_documents', 'ExampleHomeownerInsurancePlan.jpeg')
+_SCANNED_TEXT = 'Homeowner insurance plan\nScanned page read by the fake Textract\n'
+_MIXED_SCANNED_EVERY = 10 # every 10th page of a mixed document is scanned
+_PAGE_SIZE = (612, 792) # US Letter, in points
+
+# a PDF of num_pages pages and the text of each page, kind is text (every page has a text layer), scanned (no page has one) or mixed
+# a scanned page shows the JPEG image scaled to the page and has no text layer
+def make_pdf(extraction, kind, num_pages):
+  import pypdfium2
+  source = pypdfium2.PdfDocument(_TEXT_PDF)
+  text, _ = extraction.read_page(source, 0)
+  document = pypdfium2.PdfDocument.new()
+  pages = []
+  for index in range(num_pages):
+    if kind == 'scanned' or (kind == 'mixed' and index % _MIXED_SCANNED_EVERY == _MIXED_SCANNED_EVERY - 1):
+      page = document.new_page(*_PAGE_SIZE, index=index)
+      image = pypdfium2.PdfImage.new(document)
+      image.load_jpeg(_SCANNED_JPEG, inline=True)
+      width, height = image.get_size()
+      scale = min(_PAGE_SIZE[0] / width, _PAGE_SIZE[1] / height)
+      image.set_matrix(pypdfium2.PdfMatrix().scale(width * scale, height * scale))
+      page.insert_obj(image)
+      page.gen_content()
+      pages.append(_SCANNED_TEXT)
+    else:
+      document.import_pages(source, [0], index)
+      pages.append(text)
+  data = io.BytesIO()
+  document.save(data)
+  return data.getvalue(), pages
+
+def best_time(fn, repeat):
+  seconds = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = fn()
+    seconds.append(time.perf_counter() - start)
+  return min(seconds), result
+
+def measure(extraction, kind, num_pages, processes, args):
+  data, pages = make_pdf(extraction, kind, num_pages)
+  textract = FakeTextract(polls_until_done=0, latency=args.call_latency, page_latency=args.page_latency, ocr=lambda document: _SCANNED_TEXT)
+  textract.add_document(_BUCKET, _KEY, pages)
+  extraction.get_client.__globals__['set_client']('textract', textract)
+  case = {'kind': kind, 'pages': num_pages, 'bytes': len(data)}
+  for num_processes in processes:
+    extraction._NUM_PROCESSES = num_processes
+    read = lambda: list(extraction.iter_pdf_pages({'Body': io.BytesIO(data), 'ContentLength': len(data)}, _BUCKET, _KEY))
+    calls = textract.calls
+    case['local_%s' % num_processes], local_pages = best_time(read, args.repeat)
+    case['local_textract_calls'] = (textract.calls - calls) // args.repeat
+  calls = textract.calls
+  case['textract'], textract_pages = best_time(lambda: list(extraction.iter_textract_pages(textract, _BUCKET, _KEY, 'application/pdf')), args.repeat)
+  case['textract_calls'] = (textract.calls - calls) // args.repeat
+  if local_pages != textract_pages:
+    raise RuntimeError('The local path and Textract read different text from the %s document of %s pages' % (kind, num_pages))
+  return case
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare reading the text layer of PDFs locally with reading every page with Textract')
+  parser.add_argument('--pages', default='1,10,50', help='comma separated page counts of the documents')
+  parser.add_argument('--kinds', default='text,scanned,mixed', help='comma separated kinds of documents: text, scanned, or mixed (every %sth page scanned)' % _MIXED_SCANNED_EVERY)
+  parser.add_argument('--processes', default='1,4', help='comma separated numbers of processes reading the text layer')
+  parser.add_argument('--call-latency', type=float, default=0.1, help='seconds per call of the fake Textract')
+  parser.add_argument('--page-latency', type=float, default=0.25, help='seconds of text detection per page in the fake Textract')
+  parser.add_argument('--poll-interval', type=float, help='seconds between status checks of a Textract job (default: the function\'s)')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest run is reported')
+  parser.add_argument('--json', action='store_true', help='print the results as JSON')
+  args = parser.parse_args()
+
+  extraction = load_module(_FUNCTION, 'extraction')
+  if args.poll_interval is not None:
+    extraction._POLL_INTERVAL_SECONDS = args.poll_interval
+  processes = [int(num_processes) for num_processes in args.processes.split(',')]
+  cases = [measure(extraction, kind, int(num_pages), processes, args) for kind in args.kinds.split(',') for num_pages in args.pages.split(',')]
+  if args.json:
+    print(json.dumps(cases, indent=2))
+    return
+  # seconds per document, the local columns are per number of processes, calls are Textract calls per document
+  header = '%8s %6s %10s %s %12s %10s %14s' % ('kind', 'pages', 'bytes', ' '.join('%10s' % ('local %sp' % n) for n in processes), 'local calls', 'textract', 'textract calls')
+  print(header)
+  print('-' * len(header))
+  for case in cases:
+    print('%8s %6d %10d %s %12d %10.3f %14d' % (
+      case['kind'], case['pages'], case['bytes'], ' '.join('%10.3f' % case['local_%s' % n] for n in processes),
+      case['local_textract_calls'], case['textract'], case['textract_calls']
+    ))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,136 @@
+# Measure the cold-start cost of the Lambda functions: the time to import lambda.py (what runs before the handler) and the time of the initialization done on first use
+# every run happens in a fresh Python process started with -X importtime, so the cost of each imported module is reported too
+# usage: python offline/startup_time.py [--function pii-api] [--runs 3] [--top 8] [--json]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from local_lambda import LAMBDA_DIRS, load_module
+
+_PHASE_MARKER = 'startup_time phase: '
+# initialization each function does on first use, in the order a request needs it
+_FIRST_USE = {
+  'pii-api': ['tokenizer', 'bedrock-runtime'],
+  'pii-document-upload': ['s3', 'tokenizer', 'bedrock-runtime', 'textract'],
+  'summarization-api': ['tokenizer', 'bedrock-runtime'],
+  'summarization-document-upload': ['s3', 'tokenizer', 'bedrock-runtime', 'textract'],
+}
+
+def first_use(module, step):
+  if step == 'tokenizer':
+    # the PII masking functions keep the tokenizer in their masking engine
+    return module.engine.tokenizer if hasattr(module, 'engine') else module.get_tokenizer()
+  return module.configure_client.__globals__['get_client'](step)
+
+# runs in the child process: time each phase and print the timings as JSON on stdout
+# phases are marked on stderr so the -X importtime lines can be attributed to them
+def measure(function):
+  timings = []
+  def run_phase(name, fn):
+    sys.stderr.write(_PHASE_MARKER + name + '\n')
+    sys.stderr.flush()
+    start = time.perf_counter()
+    error = None
+    try:
+      result = fn()
+    except Exception as e:
+      result = None
+      error = '%s: %s' % (type(e).__name__, e)
+    timings.append({'phase': name, 'seconds': time.perf_counter() - start, 'error': error})
+    return result
+
+  module = run_phase('import lambda.py', lambda: load_module(function))
+  if module is not None:
+    for step in _FIRST_USE[function]:
+      run_phase('first use: ' + step, lambda: first_use(module, step))
+  sys.stderr.write(_PHASE_MARKER + 'done\n')
+  print(json.dumps(timings))
+
+# parse -X importtime output into {phase: {top-level module: cumulative seconds}}
+# only imports at nesting level 0 are kept, their cumulative time includes everything they imported
+def parse_importtime(stderr):
+  phases = {}
+  phase = None
+  for line in stderr.splitlines():
+    if line.startswith(_PHASE_MARKER):
+      phase = line[len(_PHASE_MARKER):]
+      phases[phase] = {}
+      continue
+    if phase is None or not line.startswith('import time:') or 'imported package' in line:
+      continue
+    _, cumulative, name = line[len('import time:'):].split('|')
+    if name.startswith('  '):
+      continue
+    phases[phase][name.strip()] = int(cumulative) / 1e6
+  return phases
+
+def run_once(function):
+  env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+  process = subprocess.run(
+    [sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--child', function],
+    capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__))
+  )
+  if process.returncode != 0:
+    raise RuntimeError('Measurement of %s failed:\n%s' % (function, process.stderr[-2000:]))
+  return json.loads(process.stdout.splitlines()[-1]), parse_importtime(process.stderr)
+
+# run the measurement runs times for a function and report the median of every phase and module
+def measure_function(function, runs):
+  phase_seconds = {}
+  module_seconds = {}
+  errors = {}
+  for _ in range(runs):
+    timings, imports = run_once(function)
+    for timing in timings:
+      phase_seconds.setdefault(timing['phase'], []).append(timing['seconds'])
+      if timing['error']:
+        errors[timing['phase']] = timing['error']
+    for phase, modules in imports.items():
+      for name, seconds in modules.items():
+        module_seconds.setdefault(phase, {}).setdefault(name, []).append(seconds)
+  return {
+    'function': function,
+    'phases': [
+      {
+        'phase': phase,
+        'seconds': statistics.median(seconds),
+        'error': errors.get(phase),
+        'imports': {name: statistics.median(values) for name, values in module_seconds.get(phase, {}).items()}
+      }
+      for phase, seconds in phase_seconds.items()
+    ]
+  }
+
+def print_report(report, top):
+  print(report['function'])
+  for phase in report['phases']:
+    print('  %-28s %8.1f ms%s' % (phase['phase'], phase['seconds'] * 1000, '  (%s)' % phase['error'][:100] if phase['error'] else ''))
+    slowest = sorted(phase['imports'].items(), key=lambda item: item[1], reverse=True)[:top]
+    for name, seconds in slowest:
+      print('      %-24s %8.1f ms' % (name, seconds * 1000))
+  print('  %-28s %8.1f ms' % ('total', sum(phase['seconds'] for phase in report['phases']) * 1000))
+
+def main():
+  parser = argparse.ArgumentParser(description='Report import and initialization time of the Lambda functions')
+  parser.add_argument('--function', action='append', choices=sorted(LAMBDA_DIRS), help='function to measure, can be repeated (default: all)')
+  parser.add_argument('--runs', type=int, default=3, help='number of fresh processes per function, the median is reported')
+  parser.add_argument('--top', type=int, default=8, help='number of slowest top-level imports listed per phase')
+  parser.add_argument('--json', action='store_true', help='print the report as JSON, e.g. to keep it for comparison with later runs')
+  parser.add_argument('--child', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.child:
+    measure(args.child)
+    return
+
+  reports = [measure_function(function, args.runs) for function in args.function or sorted(LAMBDA_DIRS)]
+  if args.json:
+    print(json.dumps(reports, indent=2))
+    return
+  for report in reports:
+    print_report(report, args.top)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,87 @@
+# Micro-benchmark of the tokenization done by the PII masking functions, comparing the previous path with the single-pass tokenization in tokenization.py
+# previous path: the document is encoded and its token offsets decoded token by token, and every chunk is encoded again to size the model output;
+# a document read page by page is encoded again each time the buffered pages are split
+# single pass: the document is encoded once, in pieces on several threads, and chunk token counts come from the token offsets
+# usage: python offline/tokenization_benchmark.py [--sizes 100KB,1MB,10MB] [--chunk-size 2000] [--threads 1,4] [--repeat 3] [--json]
+import argparse
+import json
+import time
+from benchmark import format_size, make_document, parse_size
+from local_lambda import load_module
+
+_FUNCTION = 'pii-document-upload'
+_DEFAULT_SIZES = '100KB,1MB,10MB'
+_LINES_PER_PAGE = 40
+
+# the previous split_text: decode_with_offsets walks the tokens in Python
+def previous_split_text(text, tokenizer, chunk_size, chunking):
+  tokens = tokenizer.encode(text, disallowed_special=())
+  _, offsets = tokenizer.decode_with_offsets(tokens)
+  return [chunk for _, chunk in chunking.split_offsets(text, offsets, chunk_size)]
+
+# the previous split_stream: each page is encoded for a running count, and the whole buffer again whenever it is split
+def previous_split_stream(pages, tokenizer, chunk_size, chunking):
+  buffer = ''
+  buffer_tokens = 0
+  for page in pages:
+    buffer += page
+    buffer_tokens += len(tokenizer.encode(page, disallowed_special=()))
+    if buffer_tokens > chunk_size:
+      chunks = previous_split_text(buffer, tokenizer, chunk_size, chunking)
+      yield from chunks[:-1]
+      buffer, buffer_tokens = chunks[-1]
+  yield from previous_split_text(buffer, tokenizer, chunk_size, chunking)
+
+def best_time(fn, repeat):
+  seconds = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    seconds.append(time.perf_counter() - start)
+  return min(seconds)
+
+def measure(tokenizer, chunking, tokenization, size, chunk_size, threads, repeat):
+  text = make_document(_FUNCTION, size)
+  lines = text.splitlines(True)
+  pages = [''.join(lines[i:i + _LINES_PER_PAGE]) for i in range(0, len(lines), _LINES_PER_PAGE)]
+  recount = lambda chunks: [len(tokenizer.encode(chunk.text, disallowed_special=())) for chunk in chunks]
+  case = {'size': size, 'tokens': len(tokenization.encode_offsets(text, tokenizer))}
+  # whole text (API functions): split, then count the tokens of each chunk
+  case['text_previous'] = best_time(lambda: recount(previous_split_text(text, tokenizer, chunk_size, chunking)), repeat)
+  for num_threads in threads:
+    split = lambda: chunking.split_offsets(text, tokenization.encode_offsets(text, tokenizer, num_threads=num_threads), chunk_size)
+    case['text_single_pass_%s' % num_threads] = best_time(split, repeat)
+  # pages (Document_Upload functions)
+  case['stream_previous'] = best_time(lambda: recount(list(previous_split_stream(pages, tokenizer, chunk_size, chunking))), repeat)
+  case['stream_single_pass'] = best_time(lambda: list(chunking.split_stream(pages, tokenizer, chunk_size)), repeat)
+  return case
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare the previous tokenization path of the PII masking functions with single-pass tokenization')
+  parser.add_argument('--sizes', default=_DEFAULT_SIZES, help='comma separated document sizes (default: %s)' % _DEFAULT_SIZES)
+  parser.add_argument('--chunk-size', type=int, default=2000, help='tokens per chunk')
+  parser.add_argument('--threads', default='1,4', help='comma separated numbers of threads encoding the pieces of a text')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest run is reported')
+  parser.add_argument('--json', action='store_true', help='print the results as JSON')
+  args = parser.parse_args()
+
+  tokenizer = load_module(_FUNCTION).get_tokenizer()
+  chunking = load_module(_FUNCTION, 'chunking')
+  tokenization = load_module(_FUNCTION, 'tokenization')
+  threads = [int(num_threads) for num_threads in args.threads.split(',')]
+  cases = [measure(tokenizer, chunking, tokenization, parse_size(size), args.chunk_size, threads, args.repeat) for size in args.sizes.split(',')]
+  if args.json:
+    print(json.dumps(cases, indent=2))
+    return
+  # seconds per document, the single pass columns of the text case are per number of threads
+  header = '%8s %10s %14s %s %14s %14s' % ('size', 'tokens', 'text previous', ' '.join('%14s' % ('1 pass %s thr' % n) for n in threads), 'pages previous', 'pages 1 pass')
+  print(header)
+  print('-' * len(header))
+  for case in cases:
+    print('%8s %10d %14.3f %s %14.3f %14.3f' % (
+      format_size(case['size']), case['tokens'], case['text_previous'],
+      ' '.join('%14.3f' % case['text_single_pass_%s' % n] for n in threads), case['stream_previous'], case['stream_single_pass']
+    ))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,132 @@
+# Benchmark of the tokenizer backends of tokenization.py (vendored, anthropic, estimate): load time, encoding speed, and token counts against the exact Anthropic tokenizer
+# texts are built from what comes with the functions: prose (the test fixtures), json (the raw API test requests) and code (the functions' own Python files)
+# the load time is measured in a fresh Python process per run, so it includes importing the libraries the backend needs
+# agreement is the fraction of prefixes of each text, around the given token limit, for which a backend takes the same fits/doesn't fit decision as the Anthropic tokenizer,
+# like the choice between a single stuff prompt and map-reduce
+# usage: python offline/tokenizer_benchmark.py [--backends vendored,anthropic,estimate] [--sizes 10KB,1MB] [--limit 8000] [--repeat 3] [--json]
+import argparse
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from benchmark import fixture_text, format_size, parse_size
+from local_lambda import LAMBDA_DIRS, load_module
+
+_FUNCTION = 'summarization-document-upload'
+_DEFAULT_BACKENDS = 'vendored,anthropic,estimate'
+_DEFAULT_SIZES = '10KB,1MB'
+_PREFIXES = 41 # prefixes per text for the agreement, from half to one and a half times the limit
+# runs in a fresh process: import tokenization.py and load the backend named by TOKENIZER, prints the seconds it took
+_LOAD_SCRIPT = '''
+import sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import tokenization
+tokenization.tokenizer_from_environment()
+print(time.perf_counter() - start)
+'''
+
+def read_files(pattern):
+  texts = []
+  for path in sorted(glob.glob(pattern)):
+    with open(path, encoding='utf-8') as f:
+      texts.append(f.read())
+  return '\n\n'.join(texts)
+
+# the text of each kind, repeated up to num_bytes
+def make_texts(num_bytes):
+  corpora = {
+    'prose': '\n\n'.join(fixture_text(function) for function in ['pii-api', 'summarization-api']),
+    'json': read_files(os.path.join(os.path.dirname(LAMBDA_DIRS['pii-api']), 'test_requests', '*.txt')),
+    'code': read_files(os.path.join(LAMBDA_DIRS[_FUNCTION], '*.py'))
+  }
+  texts = {}
+  for kind, corpus in corpora.items():
+    data = corpus.encode('utf-8')
+    texts[kind] = (data * (num_bytes // len(data) + 1))[:num_bytes].decode('utf-8', 'ignore')
+  return texts
+
+def load_seconds(backend, runs):
+  env = dict(os.environ, TOKENIZER=backend)
+  seconds = []
+  for _ in range(runs):
+    output = subprocess.run([sys.executable, '-c', _LOAD_SCRIPT, LAMBDA_DIRS[_FUNCTION]], env=env, capture_output=True, text=True, check=True).stdout
+    seconds.append(float(output))
+  return statistics.median(seconds)
+
+def best_time(fn, repeat):
+  seconds = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = fn()
+    seconds.append(time.perf_counter() - start)
+  return min(seconds), result
+
+def count(tokenizer, text):
+  return len(tokenizer.encode(text, disallowed_special=()))
+
+# prefixes of text whose exact counts are spread around limit, found from the characters per token of the whole text
+def limit_prefixes(text, exact_tokens, limit):
+  chars_per_token = len(text) / max(1, exact_tokens)
+  lengths = [int(limit * chars_per_token * (0.5 + i / (_PREFIXES - 1))) for i in range(_PREFIXES)]
+  return [text[:length] for length in lengths if length <= len(text)]
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare the load time, speed and accuracy of the tokenizer backends')
+  parser.add_argument('--backends', default=_DEFAULT_BACKENDS, help='comma separated backends (default: %s)' % _DEFAULT_BACKENDS)
+  parser.add_argument('--sizes', default=_DEFAULT_SIZES, help='comma separated text sizes (default: %s)' % _DEFAULT_SIZES)
+  parser.add_argument('--limit', type=int, default=8000, help='token limit of the fits/doesn\'t fit decisions')
+  parser.add_argument('--load-runs', type=int, default=5, help='fresh processes per backend for the load time, the median is reported')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest run is reported')
+  parser.add_argument('--json', action='store_true', help='print the results as JSON')
+  args = parser.parse_args()
+
+  backends = args.backends.split(',')
+  tokenization = load_module(_FUNCTION, 'tokenization')
+  tokenizers = {}
+  for backend in backends + ['anthropic']:
+    os.environ['TOKENIZER'] = backend
+    tokenizers[backend] = tokenization.tokenizer_from_environment()
+  exact = tokenizers['anthropic']
+
+  loads = {backend: load_seconds(backend, args.load_runs) for backend in backends}
+  cases = []
+  for size in args.sizes.split(','):
+    for kind, text in make_texts(parse_size(size)).items():
+      exact_tokens = count(exact, text)
+      prefixes = limit_prefixes(text, exact_tokens, args.limit)
+      exact_fits = [count(exact, prefix) <= args.limit for prefix in prefixes]
+      for backend in backends:
+        tokenizer = tokenizers[backend]
+        seconds, tokens = best_time(lambda: count(tokenizer, text), args.repeat)
+        offsets_seconds, _ = best_time(lambda: tokenization.encode_offsets(text, tokenizer), args.repeat)
+        fits = [count(tokenizer, prefix) <= args.limit for prefix in prefixes]
+        cases.append({
+          'size': len(text.encode('utf-8')), 'kind': kind, 'backend': backend, 'tokens': tokens, 'exact_tokens': exact_tokens,
+          'error': (tokens - exact_tokens) / max(1, exact_tokens), 'count': seconds, 'offsets': offsets_seconds,
+          'agreement': sum(a == b for a, b in zip(fits, exact_fits)) / len(prefixes) if prefixes else None
+        })
+  if args.json:
+    print(json.dumps({'load': loads, 'cases': cases}, indent=2))
+    return
+  # seconds in a fresh process to import tokenization.py and load the backend
+  for backend in backends:
+    print('load %-10s %8.3f s' % (backend, loads[backend]))
+  print()
+  # count and offsets are seconds per text, error is the token count relative to the Anthropic tokenizer's,
+  # there is no agreement for texts shorter than the limit
+  header = '%8s %6s %10s %10s %8s %10s %10s %10s' % ('size', 'kind', 'backend', 'tokens', 'error', 'count', 'offsets', 'agreement')
+  print(header)
+  print('-' * len(header))
+  for case in cases:
+    agreement = '-' if case['agreement'] is None else '%.0f%%' % (100 * case['agreement'])
+    print('%8s %6s %10s %10d %+7.1f%% %10.4f %10.4f %10s' % (
+      format_size(case['size']), case['kind'], case['backend'], case['tokens'], 100 * case['error'],
+      case['count'], case['offsets'], agreement
+    ))
+
+if __name__ == '__main__':
+  main()
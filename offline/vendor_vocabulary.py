@@ -0,0 +1,24 @@
+# Write the vocabulary of the Claude tokenizer into the lambda folder of each function (claude.vocab), for the vendored tokenizer in tokenization.py
+# sam build writes it into the built functions (see the Makefile of each function), this is for running the functions from the repository,
+# where tokenization.py otherwise converts the tokenizer.json of the anthropic package on every load
+# usage: python offline/vendor_vocabulary.py [--tokenizer-json path/to/tokenizer.json]
+import argparse
+import importlib.util
+import os
+from local_lambda import LAMBDA_DIRS, load_module
+
+_FILE_NAME = 'claude.vocab'
+
+def main():
+  parser = argparse.ArgumentParser(description='Write the vocabulary of the Claude tokenizer into the lambda folder of each function')
+  parser.add_argument('--tokenizer-json', help='tokenizer.json of the Claude tokenizer (default: the one of the installed anthropic package)')
+  args = parser.parse_args()
+  if args.tokenizer_json is None and importlib.util.find_spec('anthropic') is None:
+    parser.error('install the anthropic package (pip install anthropic==0.5.0) or pass --tokenizer-json')
+  for function, lambda_dir in sorted(LAMBDA_DIRS.items()):
+    path = os.path.join(lambda_dir, _FILE_NAME)
+    num_tokens = load_module(function, 'tokenization').write_vocabulary(path, args.tokenizer_json)
+    print('%s: %s tokens written to %s' % (function, num_tokens, path))
+
+if __name__ == '__main__':
+  main()